@@ -1,7 +1,8 @@
 from django.contrib import admin
-from .models import Ad, AdImage, Favourite
+from .models import Ad, AdImage, Favourite, AdRegionStats
 # Register your models here.
 
 admin.site.register(Ad)
 admin.site.register(AdImage)
 admin.site.register(Favourite)
+admin.site.register(AdRegionStats)
@@ -0,0 +1,124 @@
+import random
+from django.core.cache import cache
+from .location_service import LocationService, normalize_location_query
+
+
+class LocationAutocomplete:
+    """
+    Prefix index over cached location searches.
+    Every entry is stored under its normalized prefix, so a longer query
+    (e.g. "berlin" after "berl") is answered by filtering the results of
+    the longest cached prefix instead of calling nominatim again.
+    """
+    KEY_PREFIX = 'location_prefix:'
+    MIN_PREFIX_LENGTH = 3
+
+    # Minimum filtered results required to serve from a shorter prefix
+    MIN_FILTERED_RESULTS = 3
+
+    # Retention grows with popularity: base timeout plus one more period
+    # per POPULARITY_STEP hits, capped at MAX_TIMEOUT
+    BASE_TIMEOUT = 86400
+    MAX_TIMEOUT = 86400 * 7
+    POPULARITY_STEP = 10
+    # Only one hit in HIT_SAMPLE_RATE is written back, counted as HIT_SAMPLE_RATE hits,
+    # so popular prefixes are not rewritten to the cache on every keystroke
+    HIT_SAMPLE_RATE = 10
+
+    @classmethod
+    def search(cls, query, limit=10):
+        normalized = normalize_location_query(query)
+        if len(normalized) < cls.MIN_PREFIX_LENGTH:
+            return []
+
+        # Fetch every candidate prefix in one cache round trip
+        prefixes = cls._prefixes(normalized)
+        entries = cache.get_many([cls._key(prefix) for prefix in prefixes])
+
+        hit = cls._lookup(normalized, prefixes, entries, limit)
+        if hit:
+            prefix, entry, results = hit
+            if entry is not None:
+                cache.set(cls._key(prefix), entry, cls._timeout(entry['hits']))
+            return results
+
+        results = LocationService.fetch_search_results(query)
+        if results is None:
+            return []
+
+        if results:
+            cache.set(cls._key(normalized), {
+                      'results': results, 'hits': 0}, cls.BASE_TIMEOUT)
+        return results[:limit]
+
+    @classmethod
+    async def asearch(cls, query, limit=10):
+        # Async version of search
+        normalized = normalize_location_query(query)
+        if len(normalized) < cls.MIN_PREFIX_LENGTH:
+            return []
+
+        prefixes = cls._prefixes(normalized)
+        entries = await cache.aget_many([cls._key(prefix) for prefix in prefixes])
+
+        hit = cls._lookup(normalized, prefixes, entries, limit)
+        if hit:
+            prefix, entry, results = hit
+            if entry is not None:
+                await cache.aset(cls._key(prefix), entry, cls._timeout(entry['hits']))
+            return results
+
+        results = await LocationService.afetch_search_results(query)
+        if results is None:
+            return []
+
+        if results:
+            await cache.aset(cls._key(normalized), {
+                             'results': results, 'hits': 0}, cls.BASE_TIMEOUT)
+        return results[:limit]
+
+    @classmethod
+    def _prefixes(cls, normalized):
+        # Candidate prefixes, longest first
+        return [normalized[:i] for i in range(len(normalized), cls.MIN_PREFIX_LENGTH - 1, -1)]
+
+    @classmethod
+    def _lookup(cls, normalized, prefixes, entries, limit):
+        # Find the longest cached prefix able to answer the query
+        # Returns (prefix, entry with updated hits or None if this hit is not sampled, results) or None
+        for prefix in prefixes:
+            entry = entries.get(cls._key(prefix))
+            if entry is None:
+                continue
+
+            if prefix == normalized:
+                results = entry['results'][:limit]
+            else:
+                matches = [place for place in entry['results']
+                           if cls.matches(place, normalized)]
+                if len(matches) < min(limit, cls.MIN_FILTERED_RESULTS):
+                    continue
+                results = matches[:limit]
+
+            if random.randrange(cls.HIT_SAMPLE_RATE):
+                return prefix, None, results
+            entry['hits'] = entry.get('hits', 0) + cls.HIT_SAMPLE_RATE
+            return prefix, entry, results
+        return None
+
+    @staticmethod
+    def matches(place, normalized_query):
+        # Every query word must be present in the place name,
+        # the last one may be incomplete and only has to be a prefix
+        words = normalize_location_query(place.get('display_name')).split()
+        *complete, last = normalized_query.split()
+        return (all(word in words for word in complete)
+                and any(word.startswith(last) for word in words))
+
+    @classmethod
+    def _timeout(cls, hits):
+        return min(cls.BASE_TIMEOUT * (1 + hits // cls.POPULARITY_STEP), cls.MAX_TIMEOUT)
+
+    @classmethod
+    def _key(cls, prefix):
+        return f"{cls.KEY_PREFIX}{prefix.replace(' ', '_')}"
@@ -0,0 +1,300 @@
+import codecs
+import csv
+import hashlib
+import json
+from decimal import Decimal
+from django.db import transaction
+from django.db.models import Model
+from django.utils import timezone
+from catalog.models import Brand, ModelCar, BodyType, FuelType, DriveType, Transmission, Color, InteriorMaterial
+from subscription.utils import get_user_ad_limit, get_user_ad_usage
+from .location_service import LocationService
+from .models import Ad
+from .region_stats import mark_region_stats_dirty
+from .serializers import AdImportRowSerializer
+
+IMPORT_FORMATS = ('csv', 'jsonl')
+IMPORT_BATCH_SIZE = 500
+# Rows accepted by the API endpoint, larger feeds go through the import_ads command
+MAX_IMPORT_ROWS = 5000
+# Ad fields written by geocoding
+GEOCODE_FIELDS = ['full_address', 'latitude', 'longitude', 'city', 'state',
+                  'country', 'country_code', 'postcode', 'location']
+
+
+class CatalogLookup:
+    """
+    Catalog names preloaded into dictionaries, one query per catalog table.
+    Names are matched case insensitive, models within their brand.
+    """
+    FIELDS = ['brand', 'model', 'body_type', 'fuel_type', 'drive_type', 'transmission',
+              'exterior_color', 'interior_color', 'interior_material']
+    MODELS = {
+        'brand': Brand,
+        'body_type': BodyType,
+        'fuel_type': FuelType,
+        'drive_type': DriveType,
+        'transmission': Transmission,
+        'exterior_color': Color,
+        'interior_color': Color,
+        'interior_material': InteriorMaterial,
+    }
+
+    def __init__(self):
+        self.by_name = {}
+        for model_class in set(self.MODELS.values()):
+            self.by_name[model_class] = {obj.name.lower(): obj for obj in model_class.objects.all()}
+        self.car_models = {(car_model.brand_id, car_model.name.lower()): car_model
+                           for car_model in ModelCar.objects.all()}
+
+    def resolve(self, field, name, brand=None):
+        # Catalog object by name, None if not found. Model needs the already resolved brand
+        name = name.strip().lower()
+        if field == 'model':
+            return self.car_models.get((brand.id, name)) if brand else None
+        return self.by_name[self.MODELS[field]].get(name)
+
+
+def read_feed(file, feed_format):
+    """
+    Rows of a binary feed file as (line number, dict or error message).
+    Read line by line, empty CSV cells are treated as missing values.
+    """
+    text = codecs.iterdecode(file, 'utf-8-sig', errors='replace')
+    if feed_format == 'csv':
+        reader = csv.DictReader(text)
+        for row in reader:
+            yield reader.line_num, {key: value for key, value in row.items() if key and value not in ('', None)}
+        return
+
+    for number, line in enumerate(text, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield number, 'Invalid JSON.'
+            continue
+        yield number, row if isinstance(row, dict) else 'Row must be a JSON object.'
+
+
+def import_ads(user, rows, batch_size=IMPORT_BATCH_SIZE, max_rows=None, geocode=True):
+    """
+    Validate and create ads from feed rows for the user.
+    Rows are validated and inserted in batches with bulk_create, each unique location
+    is geocoded once, the ad limit is checked once for the whole import.
+    With geocode=False ads are stored without coordinates, see geocode_pending_ads.
+    Returns (created count, list of row errors).
+    """
+    catalog = CatalogLookup()
+    remaining = max(0, get_user_ad_limit(user) - get_user_ad_usage(user))
+    locations = {} if geocode else None
+    created = 0
+    errors = []
+
+    batch = []
+    for count, (number, row) in enumerate(rows, start=1):
+        if max_rows is not None and count > max_rows:
+            errors.append({'row': number, 'errors': {'detail': f'Maximum {max_rows} rows per import.'}})
+            break
+        if isinstance(row, str):
+            errors.append({'row': number, 'errors': {'detail': row}})
+            continue
+
+        serializer = AdImportRowSerializer(data=row, context={'catalog': catalog})
+        if not serializer.is_valid():
+            errors.append({'row': number, 'errors': serializer.errors})
+            continue
+        if remaining <= 0:
+            errors.append({'row': number, 'errors': {'detail': 'Ad limit reached.'}})
+            continue
+
+        remaining -= 1
+        batch.append(Ad(user=user, **serializer.validated_data))
+        if len(batch) >= batch_size:
+            created += _create_batch(batch, locations)
+            batch = []
+
+    if batch:
+        created += _create_batch(batch, locations)
+    return created, errors
+
+
+def geocode_ads(ads, locations):
+    # Locations are geocoded once per import, results are shared by all rows with the same text
+    for ad in ads:
+        if not ad.location:
+            continue
+        key = ad.location.strip().lower()
+        if key not in locations:
+            results = LocationService.search_location(ad.location, limit=1)
+            locations[key] = results[0] if results else None
+        if locations[key]:
+            ad.set_location_from_geocode(locations[key])
+
+
+def geocode_pending_ads(user_id, batch_size=IMPORT_BATCH_SIZE):
+    """
+    Geocode ads of the user, that have location text but no coordinates yet,
+    e.g. imported by the API, which leaves geocoding to a background task.
+    Returns number of geocoded ads.
+    """
+    queryset = (Ad.objects.filter(user_id=user_id, latitude__isnull=True)
+                .exclude(location__isnull=True).exclude(location=''))
+    locations = {}
+    last_id = 0
+    geocoded = 0
+    while True:
+        # Keyset pagination, only one batch is held in memory at a time
+        ads = list(queryset.filter(pk__gt=last_id).order_by('pk').only('id', 'location')[:batch_size])
+        if not ads:
+            return geocoded
+        last_id = ads[-1].pk
+
+        geocode_ads(ads, locations)
+        ads = [ad for ad in ads if ad.latitude is not None]
+        Ad.objects.bulk_update(ads, GEOCODE_FIELDS)
+        # bulk_update skips post_save, so region stats are marked here
+        mark_region_stats_dirty({ad.country_code for ad in ads})
+        geocoded += len(ads)
+
+
+def _create_batch(ads, locations):
+    # locations is None when geocoding is left to geocode_pending_ads
+    if locations is not None:
+        geocode_ads(ads, locations)
+    with transaction.atomic():
+        Ad.objects.bulk_create(ads)
+    # bulk_create skips post_save, so region stats are marked here
+    mark_region_stats_dirty({ad.country_code for ad in ads})
+    return len(ads)
+
+
+# Fields written on a synced update, feed values plus everything derived from them
+SYNC_UPDATE_FIELDS = AdImportRowSerializer.Meta.fields + [
+    'full_address', 'latitude', 'longitude', 'city', 'state', 'country', 'country_code', 'postcode',
+    'external_id', 'feed_hash', 'updated_at',
+]
+
+
+def feed_hash(validated_data):
+    """
+    Hash of normalized row values, equal for rows that would produce the same ad.
+    Catalog objects are hashed by id, decimals with the model's decimal places.
+    """
+    normalized = {}
+    for name in AdImportRowSerializer.Meta.fields:
+        value = validated_data.get(name)
+        if isinstance(value, Model):
+            value = value.pk
+        elif isinstance(value, Decimal):
+            value = f'{value:.{Ad._meta.get_field(name).decimal_places}f}'
+        elif isinstance(value, str):
+            value = value.strip()
+        normalized[name] = value
+    return hashlib.sha256(json.dumps(normalized, sort_keys=True).encode()).hexdigest()
+
+
+def sync_ads(user, rows, batch_size=IMPORT_BATCH_SIZE, max_rows=None, geocode=True):
+    """
+    Bring the user's feed ads in line with a full inventory feed.
+    Rows are keyed by external_id, or by vin when it is missing. Each row is compared with
+    the stored hash of its ad, only new, changed and missing vehicles are written, in batches.
+    Ads created without a feed are never touched, except that one with the same vin as a new
+    vehicle is adopted by the feed instead of being duplicated. Invalid rows keep their existing ad.
+    Missing vehicles are deleted only if every row could be read and keyed, so an empty,
+    truncated or malformed feed never wipes the inventory.
+    With geocode=False written ads are left without coordinates, see geocode_pending_ads.
+    Returns dict with created, updated, deleted, unchanged counts and row errors.
+    """
+    catalog = CatalogLookup()
+    existing = {external_id: (ad_id, stored_hash, country_code) for external_id, ad_id, stored_hash, country_code in
+                Ad.objects.filter(user=user, external_id__isnull=False)
+                .values_list('external_id', 'id', 'feed_hash', 'country_code')}
+    # Ads imported or created before the first sync, matched by vin
+    keyless = {}
+    for ad_id, vin, country_code in (Ad.objects.filter(user=user, external_id__isnull=True, vin__isnull=False)
+                                     .order_by('id').values_list('id', 'vin', 'country_code')):
+        keyless.setdefault(vin.strip().upper(), (ad_id, country_code))
+    seen = set()
+    # False once a row is unreadable or has no key, its vehicle is unknown
+    complete = True
+    inserts, updates = [], []
+    unchanged = 0
+    errors = []
+
+    for count, (number, row) in enumerate(rows, start=1):
+        if max_rows is not None and count > max_rows:
+            errors.append({'row': number, 'errors': {'detail': f'Maximum {max_rows} rows per import.'}})
+            # Rest of the feed is unknown
+            complete = False
+            break
+        if isinstance(row, str):
+            errors.append({'row': number, 'errors': {'detail': row}})
+            complete = False
+            continue
+
+        key = str(row.get('external_id') or row.get('vin') or '').strip()[:100]
+        if not key:
+            errors.append({'row': number, 'errors': {'external_id': ['external_id or vin is required.']}})
+            complete = False
+            continue
+        if key in seen:
+            errors.append({'row': number, 'errors': {'external_id': [f'Duplicate external id "{key}".']}})
+            continue
+        seen.add(key)
+
+        serializer = AdImportRowSerializer(data=row, context={'catalog': catalog})
+        if not serializer.is_valid():
+            errors.append({'row': number, 'errors': serializer.errors})
+            continue
+
+        row_hash = feed_hash(serializer.validated_data)
+        vin = (serializer.validated_data.get('vin') or '').strip().upper()
+        if key not in existing and vin in keyless:
+            # Adopted ad is written as a changed one and gets the feed key
+            ad_id, country_code = keyless.pop(vin)
+            existing[key] = (ad_id, None, country_code)
+        if key not in existing:
+            inserts.append((number, Ad(user=user, external_id=key, feed_hash=row_hash, **serializer.validated_data)))
+        elif existing[key][1] != row_hash:
+            updates.append(Ad(id=existing[key][0], user=user, external_id=key, feed_hash=row_hash,
+                              **serializer.validated_data))
+        else:
+            unchanged += 1
+
+    # Nothing can be deleted safely from an incomplete feed or one without any keyed row
+    deleted_ids = [ad_id for key, (ad_id, _, _) in existing.items()
+                   if key not in seen] if complete and seen else []
+    # Deletes free ad slots before the limit is applied to new vehicles
+    remaining = max(0, get_user_ad_limit(user) - get_user_ad_usage(user) + len(deleted_ids))
+    for number, _ in inserts[remaining:]:
+        errors.append({'row': number, 'errors': {'detail': 'Ad limit reached.'}})
+    inserts = [ad for _, ad in inserts[:remaining]]
+
+    locations = {} if geocode else None
+    for start in range(0, len(deleted_ids), batch_size):
+        Ad.objects.filter(id__in=deleted_ids[start:start + batch_size]).delete()
+    for start in range(0, len(updates), batch_size):
+        batch = updates[start:start + batch_size]
+        if locations is not None:
+            geocode_ads(batch, locations)
+        now = timezone.now()
+        for ad in batch:
+            ad.updated_at = now
+        with transaction.atomic():
+            Ad.objects.bulk_update(batch, SYNC_UPDATE_FIELDS)
+        # bulk_update skips post_save, old and new countries are marked here
+        mark_region_stats_dirty({ad.country_code for ad in batch} |
+                                {existing[ad.external_id][2] for ad in batch})
+    created = 0
+    for start in range(0, len(inserts), batch_size):
+        created += _create_batch(inserts[start:start + batch_size], locations)
+
+    return {
+        'created': created,
+        'updated': len(updates),
+        'deleted': len(deleted_ids),
+        'unchanged': unchanged,
+        'errors': errors,
+    }
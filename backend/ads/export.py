@@ -0,0 +1,100 @@
+import csv
+import json
+from itertools import islice
+from asgiref.sync import sync_to_async
+from django.core.serializers.json import DjangoJSONEncoder
+from .filters import AdFilter
+from .models import Ad
+
+EXPORT_FORMATS = ('csv', 'jsonl')
+EXPORT_CHUNK_SIZE = 2000
+
+# Exported column and the values() lookup it is read from
+EXPORT_COLUMNS = [
+    ('id', 'id'),
+    ('title', 'title'),
+    ('price', 'price'),
+    ('year', 'year'),
+    ('mileage', 'mileage'),
+    ('condition', 'condition'),
+    ('brand', 'brand__name'),
+    ('model', 'model__name'),
+    ('body_type', 'body_type__name'),
+    ('fuel_type', 'fuel_type__name'),
+    ('drive_type', 'drive_type__name'),
+    ('transmission', 'transmission__name'),
+    ('exterior_color', 'exterior_color__name'),
+    ('power', 'power'),
+    ('owner_count', 'owner_count'),
+    ('city', 'city'),
+    ('state', 'state'),
+    ('country_code', 'country_code'),
+    ('latitude', 'latitude'),
+    ('longitude', 'longitude'),
+    ('user_id', 'user_id'),
+    ('created_at', 'created_at'),
+    ('updated_at', 'updated_at'),
+]
+
+
+class Echo:
+    # File-like object for csv.writer, that returns rows instead of buffering them
+    def write(self, value):
+        return value
+
+
+def filter_ads(params):
+    """
+    Ads matching AdFilter params, same filters as the ads list.
+    Returns (queryset, errors), errors is None if params are valid.
+    """
+    filterset = AdFilter(params, queryset=Ad.objects.all())
+    if not filterset.is_valid():
+        return None, filterset.errors
+    return filterset.qs, None
+
+
+def export_rows(queryset, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Ad rows as tuples in EXPORT_COLUMNS order.
+    values() projection read with iterator(), so memory doesn't depend on number of ads.
+    """
+    lookups = [lookup for _, lookup in EXPORT_COLUMNS]
+    return queryset.order_by('id').values_list(*lookups).iterator(chunk_size=chunk_size)
+
+
+def csv_lines(rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow([column for column, _ in EXPORT_COLUMNS])
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def jsonl_lines(rows):
+    columns = [column for column, _ in EXPORT_COLUMNS]
+    for row in rows:
+        yield json.dumps(dict(zip(columns, row)), cls=DjangoJSONEncoder) + '\n'
+
+
+def export_lines(queryset, export_format, chunk_size=EXPORT_CHUNK_SIZE):
+    rows = export_rows(queryset, chunk_size)
+    return csv_lines(rows) if export_format == 'csv' else jsonl_lines(rows)
+
+
+async def aexport_lines(queryset, export_format, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    export_lines for ASGI, where Django would load a sync iterator into memory at once.
+    Each chunk of lines is read in the thread of the database connection, so the cursor stays open
+    between chunks and only one chunk is held in memory.
+    """
+    lines = export_lines(queryset, export_format, chunk_size)
+    next_chunk = sync_to_async(lambda: ''.join(islice(lines, chunk_size)))
+    try:
+        while True:
+            chunk = await next_chunk()
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        # Closes the server-side cursor when the client disconnects early
+        await sync_to_async(lines.close)()
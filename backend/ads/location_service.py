@@ -1,8 +1,14 @@
+import asyncio
 import os
+import re
+import unicodedata
+import weakref
 from dotenv import load_dotenv
+import httpx
 import requests
 from typing import Optional, Dict, List
 import logging
+from django.conf import settings
 from django.core.cache import cache
 
 load_dotenv()
@@ -10,6 +16,17 @@ load_dotenv()
 logger = logging.getLogger(__name__)
 
 
+def normalize_location_query(query):
+    """
+    Normalize a location query for cache keys and prefix matching:
+    strip accents, casefold, drop punctuation and collapse whitespace.
+    """
+    decomposed = unicodedata.normalize('NFKD', query or '')
+    folded = ''.join(
+        char for char in decomposed if not unicodedata.combining(char)).casefold()
+    return ' '.join(re.sub(r'[^\w]+', ' ', folded).split())
+
+
 class LocationService:
     NOMINATIUM_URL = 'https://nominatim.openstreetmap.org/'
 
@@ -17,79 +34,225 @@ class LocationService:
         'User-Agent': os.getenv('USER_AGENT')
     }
 
+    # Upstream is always asked for this many results, so one cache entry
+    # can serve any limit up to it
+    MAX_SEARCH_RESULTS = 10
+    MAX_BULK_POINTS = 50
+    CACHE_TIMEOUT = 86400
+    REQUEST_TIMEOUT = 5
+
+    # Cached marker for lookups that returned nothing
+    NOT_FOUND = 'not_found'
+
+    # One pooled async client per event loop, httpx connections can't move between loops
+    _async_clients = weakref.WeakKeyDictionary()
+
     @classmethod
     def search_location(cls, query, limit=5) -> List[Dict]:
         # query - text for searching
         # limit - maximum numbers of result
 
-        # Generate cache key based on search query
-        cache_key = f"location_search{query.lower().replace(' ', '_')}"
-        cached_result = cache.get(cache_key)
+        cached_result = cls.get_cached_search(query)
 
         if cached_result:
-            return cached_result
+            return cached_result[:limit]
 
-        try:
-            # Params for nomination API
-            params = {
-                'q': query,
-                'format': 'json',
-                'limit': limit,
-                'addressdetails': 1,
-                'accept-language': 'en',
-            }
+        result = cls.fetch_search_results(query)
+        if result is None:
+            return []
+
+        # Cache result for 24 hours
+        cache.set(cls._search_cache_key(query), result, cls.CACHE_TIMEOUT)
+        return result[:limit]
+
+    @classmethod
+    async def asearch_location(cls, query, limit=5) -> List[Dict]:
+        # Async version of search_location
+        cached_result = await cache.aget(cls._search_cache_key(query))
+
+        if cached_result:
+            return cached_result[:limit]
+
+        result = await cls.afetch_search_results(query)
+        if result is None:
+            return []
+
+        await cache.aset(cls._search_cache_key(query), result, cls.CACHE_TIMEOUT)
+        return result[:limit]
+
+    @classmethod
+    def get_cached_search(cls, query) -> Optional[List[Dict]]:
+        # Cached search results without touching upstream
+        return cache.get(cls._search_cache_key(query))
 
+    @staticmethod
+    def _search_cache_key(query):
+        # Generate cache key based on normalized search query
+        return f"location_search:{normalize_location_query(query).replace(' ', '_')}"
+
+    @classmethod
+    def _search_params(cls, query):
+        # Params for nomination API
+        return {
+            'q': query,
+            'format': 'json',
+            'limit': cls.MAX_SEARCH_RESULTS,
+            'addressdetails': 1,
+            'accept-language': 'en',
+        }
+
+    @classmethod
+    def fetch_search_results(cls, query) -> Optional[List[Dict]]:
+        # Query nominatim directly, returns None if upstream request failed
+        try:
             response = requests.get(
-                f"{cls.NOMINATIUM_URL}/search", params=params, headers=cls.HEADERS, timeout=5)
+                f"{cls.NOMINATIUM_URL}/search", params=cls._search_params(query), headers=cls.HEADERS, timeout=cls.REQUEST_TIMEOUT)
             response.raise_for_status()
-            result = []
 
             # Convert response to normalized structure
-            for i in response.json():
-                location_data = {
-                    'display_name': i.get('display_name'),
-                    'latitude': float(i.get('lat')),
-                    'longitude': float(i.get('lon')),
-                    'address': {
-                        'city': i.get('address', {}).get('city') or i.get('address', {}).get('town') or i.get('address', {}).get('village'),
-                        'state': i.get('address', {}).get('state'),
-                        'country': i.get('address', {}).get('country'),
-                        'country_code': i.get('address', {}).get('country_code', '').upper(),
-                        'postcode': i.get('address', {}).get('postcode')
-                    },
-                    'place_id': i.get('place_id'),
-                    'osm_type': i.get('osm_type'),
-                    'osm_id': i.get('osm_id')
-                }
-                result.append(location_data)
-
-            # Cache result for 24 hours
-            cache.set(cache_key, result, 86400)
-            return result
+            return [cls.parse_place(i) for i in response.json()]
 
         except requests.RequestException as e:
             logger.error(f'Error searching location: {e}')
-            return []
+            return None
+
+    @classmethod
+    async def afetch_search_results(cls, query) -> Optional[List[Dict]]:
+        # Async version of fetch_search_results
+        try:
+            response = await cls._async_client().get(f"{cls.NOMINATIUM_URL}/search", params=cls._search_params(query))
+            response.raise_for_status()
+
+            return [cls.parse_place(i) for i in response.json()]
+
+        except httpx.HTTPError as e:
+            logger.error(f'Error searching location: {e}')
+            return None
+
+    @classmethod
+    def _async_client(cls):
+        # Shared by all requests on the running loop, so connections to nominatim are reused
+        loop = asyncio.get_running_loop()
+        client = cls._async_clients.get(loop)
+        if client is None or client.is_closed:
+            # httpx rejects empty header values, requests silently drops them
+            headers = {key: value for key, value in cls.HEADERS.items() if value}
+            client = httpx.AsyncClient(headers=headers, timeout=cls.REQUEST_TIMEOUT)
+            cls._async_clients[loop] = client
+        return client
+
+    @classmethod
+    async def aclose_client(cls):
+        # Called on server shutdown (see backend/asgi.py)
+        client = cls._async_clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.aclose()
+
+    @staticmethod
+    def parse_place(data) -> Dict:
+        # Convert single nominatim place into normalized structure
+        address = data.get('address', {})
+        return {
+            'display_name': data.get('display_name'),
+            'latitude': float(data.get('lat')),
+            'longitude': float(data.get('lon')),
+            'address': {
+                'city': address.get('city') or address.get('town') or address.get('village'),
+                'state': address.get('state'),
+                'country': address.get('country'),
+                'country_code': address.get('country_code', '').upper(),
+                'postcode': address.get('postcode')
+            },
+            'place_id': data.get('place_id'),
+            'osm_type': data.get('osm_type'),
+            'osm_id': data.get('osm_id')
+        }
+
+    @classmethod
+    def quantize_coordinates(cls, latitude, longitude):
+        # Snap coordinates to the center of a grid cell,
+        # so nearby points share one cache entry and one upstream lookup
+        grid = settings.LOCATION_REVERSE_GRID_SIZE
+        return (round(round(latitude / grid) * grid, 6),
+                round(round(longitude / grid) * grid, 6))
+
+    @staticmethod
+    def _reverse_cache_key(latitude, longitude):
+        return f"reverse_geocode_{latitude}_{longitude}"
 
     @classmethod
     def reverse_geocode(cls, latitude, longitude):
         # Convert coordinates to detailed location data
+        latitude, longitude = cls.quantize_coordinates(latitude, longitude)
 
-        cache_key = f"reverse_geocode_{latitude}_{longitude}"
+        cache_key = cls._reverse_cache_key(latitude, longitude)
         cached_result = cache.get(cache_key)
 
-        if cached_result:
-            return cached_result
+        if cached_result is not None:
+            return None if cached_result == cls.NOT_FOUND else cached_result
+
+        location_data = cls.fetch_reverse_geocode(latitude, longitude)
+        cache.set(cache_key, *cls._reverse_cache_entry(location_data))
+        return location_data
+
+    @classmethod
+    async def areverse_geocode(cls, latitude, longitude):
+        # Async version of reverse_geocode
+        latitude, longitude = cls.quantize_coordinates(latitude, longitude)
+
+        cache_key = cls._reverse_cache_key(latitude, longitude)
+        cached_result = await cache.aget(cache_key)
+
+        if cached_result is not None:
+            return None if cached_result == cls.NOT_FOUND else cached_result
+
+        location_data = await cls.afetch_reverse_geocode(latitude, longitude)
+        await cache.aset(cache_key, *cls._reverse_cache_entry(location_data))
+        return location_data
+
+    @classmethod
+    def bulk_reverse_geocode(cls, points):
+        # Resolve list of (latitude, longitude) pairs, results keep input order
+        # Each grid cell is looked up once, cached cells are read in one round trip
+        cells = [cls.quantize_coordinates(lat, lon) for lat, lon in points]
+        cache_keys = {cell: cls._reverse_cache_key(*cell) for cell in cells}
+        cached = cache.get_many(list(cache_keys.values()))
+
+        resolved = {}
+        # Uncached cells share one session, so the upstream connection is reused
+        with requests.Session() as session:
+            for cell, cache_key in cache_keys.items():
+                if cache_key in cached:
+                    value = cached[cache_key]
+                    resolved[cell] = None if value == cls.NOT_FOUND else value
+                else:
+                    resolved[cell] = cls.fetch_reverse_geocode(*cell, session=session)
+                    cache.set(cache_key, *cls._reverse_cache_entry(resolved[cell]))
+
+        return [resolved[cell] for cell in cells]
+
+    @classmethod
+    def _reverse_cache_entry(cls, location_data):
+        # Value and timeout to cache, misses are cached too, but only briefly
+        if location_data is None:
+            return cls.NOT_FOUND, settings.LOCATION_NEGATIVE_CACHE_TIMEOUT
+        return location_data, cls.CACHE_TIMEOUT
+
+    @staticmethod
+    def _reverse_params(latitude, longitude):
+        return {
+            'lat': latitude,
+            'lon': longitude,
+            'format': 'json',
+            'addressdetails': 1
+        }
 
+    @classmethod
+    def fetch_reverse_geocode(cls, latitude, longitude, session=None) -> Optional[Dict]:
+        # Query nominatim directly, returns None if nothing found or request failed
         try:
-            params = {
-                'lat': latitude,
-                'lon': longitude,
-                'format': 'json',
-                'addressdetails': 1
-            }
-            response = requests.get(
-                f'{cls.NOMINATIUM_URL}/reverse', params=params, headers=cls.HEADERS, timeout=5)
+            response = (session or requests).get(
+                f'{cls.NOMINATIUM_URL}/reverse', params=cls._reverse_params(latitude, longitude), headers=cls.HEADERS, timeout=cls.REQUEST_TIMEOUT)
             response.raise_for_status()
 
             data = response.json()
@@ -97,29 +260,31 @@ class LocationService:
             if 'error' in data:
                 return None
 
-            location_data = {
-                'display_name': data.get('display_name'),
-                'latitude': float(data.get('lat')),
-                'longitude': float(data.get('lon')),
-                'address': {
-                    'city': data.get('address', {}).get('city') or data.get('address', {}).get('town') or data.get('address', {}).get('village'),
-                    'state': data.get('address', {}).get('state'),
-                    'country': data.get('address', {}).get('country'),
-                    'country_code': data.get('address', {}).get('country_code', '').upper(),
-                    'postcode': data.get('address', {}).get('postcode')
-                },
-                'place_id': data.get('place_id'),
-                'osm_type': data.get('osm_type'),
-                'osm_id': data.get('osm_id')
-            }
-
-            cache.set(cache_key, location_data, 86400)
-            return location_data
+            return cls.parse_place(data)
 
         except requests.RequestException as e:
             logger.error(f'Error reverse geocoding: {e}')
             return None
 
+    @classmethod
+    async def afetch_reverse_geocode(cls, latitude, longitude) -> Optional[Dict]:
+        # Async version of fetch_reverse_geocode
+        try:
+            response = await cls._async_client().get(
+                f'{cls.NOMINATIUM_URL}/reverse', params=cls._reverse_params(latitude, longitude))
+            response.raise_for_status()
+
+            data = response.json()
+
+            if 'error' in data:
+                return None
+
+            return cls.parse_place(data)
+
+        except httpx.HTTPError as e:
+            logger.error(f'Error reverse geocoding: {e}')
+            return None
+
     @classmethod
     def get_coordinates(cls, location_str):
         # Returns only first result coordinates for a given location
@@ -0,0 +1,135 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from account.models import User
+from ads.models import Ad
+from ads.location_service import LocationService
+from ads.region_stats import mark_region_stats_dirty
+
+# Fields written back for every geocoded row
+AD_FIELDS = ['full_address', 'latitude', 'longitude', 'city', 'state',
+             'country', 'country_code', 'postcode', 'location']
+USER_FIELDS = ['full_address', 'latitude', 'longitude', 'city', 'state',
+               'country', 'country_code', 'postcode', 'company_office']
+
+
+class RateLimiter:
+    """
+    Thread safe limiter, that allows at most `rate` calls per second
+    """
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate > 0 else 0
+        self.next_call = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = max(0, self.next_call - now)
+            self.next_call = max(now, self.next_call) + self.interval
+        if delay:
+            time.sleep(delay)
+
+
+class Command(BaseCommand):
+    help = 'Geocode ads and company profiles, that have location text but no coordinates'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--target', choices=['ads', 'users', 'all'], default='all',
+                            help='Which rows to backfill')
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help='Rows loaded and updated per batch')
+        parser.add_argument('--concurrency', type=int, default=2,
+                            help='Maximum parallel geocoding requests')
+        parser.add_argument('--rate', type=float, default=1.0,
+                            help='Maximum upstream requests per second')
+        parser.add_argument('--checkpoint', default=str(settings.BASE_DIR / '.backfill_locations.json'),
+                            help='File storing last processed id per target')
+        parser.add_argument('--reset', action='store_true',
+                            help='Ignore saved checkpoint and start from the beginning')
+
+    def handle(self, *args, **options):
+        self.chunk_size = options['chunk_size']
+        self.concurrency = options['concurrency']
+        self.limiter = RateLimiter(options['rate'])
+        self.checkpoint_path = Path(options['checkpoint'])
+        self.checkpoint = {} if options['reset'] else self._load_checkpoint()
+
+        targets = {
+            'ads': (Ad.objects.exclude(location__isnull=True).exclude(location=''),
+                    'location', AD_FIELDS),
+            'users': (User.objects.filter(account_type=User.ACCOUNT_COMPANY)
+                      .exclude(company_office__isnull=True).exclude(company_office=''),
+                      'company_office', USER_FIELDS),
+        }
+
+        for name, (queryset, source_field, fields) in targets.items():
+            if options['target'] in (name, 'all'):
+                self._backfill(name, queryset.filter(
+                    latitude__isnull=True), source_field, fields)
+
+    def _backfill(self, name, queryset, source_field, fields):
+        last_id = self.checkpoint.get(name, 0)
+        processed = updated = 0
+
+        while True:
+            # Keyset pagination, only one chunk is held in memory at a time
+            rows = list(queryset.filter(pk__gt=last_id).order_by(
+                'pk').values_list('pk', source_field)[:self.chunk_size])
+            if not rows:
+                break
+
+            # Each unique location string is resolved once per chunk
+            unique_locations = {location for _, location in rows}
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                resolved = dict(zip(unique_locations, executor.map(
+                    self._geocode, unique_locations)))
+
+            instances = []
+            for pk, location in rows:
+                geocode_data = resolved[location]
+                if geocode_data:
+                    instance = queryset.model(
+                        pk=pk, **{source_field: location})
+                    instance.set_location_from_geocode(geocode_data)
+                    instances.append(instance)
+
+            queryset.model.objects.bulk_update(instances, fields)
+            # bulk_update skips model signals, regional stats are marked here
+            if queryset.model is Ad:
+                mark_region_stats_dirty(
+                    {instance.country_code for instance in instances})
+
+            processed += len(rows)
+            updated += len(instances)
+            last_id = rows[-1][0]
+            self._save_checkpoint(name, last_id)
+            self.stdout.write(
+                f'{name}: processed {processed}, updated {updated}, last id {last_id}')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'{name}: done, {updated} of {processed} rows geocoded.'))
+
+    def _geocode(self, location):
+        # Cached results skip the rate limiter
+        cached = LocationService.get_cached_search(location)
+        if cached:
+            return cached[0]
+
+        self.limiter.wait()
+        results = LocationService.search_location(location, limit=1)
+        return results[0] if results else None
+
+    def _load_checkpoint(self):
+        if self.checkpoint_path.exists():
+            return json.loads(self.checkpoint_path.read_text())
+        return {}
+
+    def _save_checkpoint(self, name, last_id):
+        self.checkpoint[name] = last_id
+        self.checkpoint_path.write_text(json.dumps(self.checkpoint))
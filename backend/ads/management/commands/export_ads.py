@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.http import QueryDict
+from ads.export import EXPORT_CHUNK_SIZE, EXPORT_FORMATS, export_lines, filter_ads
+
+
+class Command(BaseCommand):
+    help = 'Stream ads matching AdFilter params to a CSV or JSON Lines file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=EXPORT_FORMATS, default='csv',
+                            help='Output format')
+        parser.add_argument('--output',
+                            help='File to write, stdout if omitted')
+        parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE,
+                            help='Rows fetched from the database per batch')
+        parser.add_argument('--filter', action='append', default=[], metavar='NAME=VALUE',
+                            help='AdFilter param, can be repeated, e.g. --filter brand=1 --filter price_max=20000')
+
+    def handle(self, *args, **options):
+        params = QueryDict(mutable=True)
+        for item in options['filter']:
+            name, separator, value = item.partition('=')
+            if not separator:
+                raise CommandError(f'Invalid filter "{item}", expected NAME=VALUE')
+            params.appendlist(name, value)
+
+        queryset, errors = filter_ads(params)
+        if errors:
+            raise CommandError(f'Invalid filters: {dict(errors)}')
+
+        lines = export_lines(queryset, options['format'], options['chunk_size'])
+        if not options['output']:
+            for line in lines:
+                self.stdout.write(line, ending='')
+            return
+
+        count = 0
+        with open(options['output'], 'w', newline='', encoding='utf-8') as file:
+            for line in lines:
+                file.write(line)
+                count += 1
+        # CSV has a header line
+        rows = count - 1 if options['format'] == 'csv' else count
+        self.stderr.write(f'Exported {rows} ads to {options["output"]}')
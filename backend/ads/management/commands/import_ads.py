@@ -0,0 +1,43 @@
+import json
+from django.core.management.base import BaseCommand, CommandError
+from account.models import User
+from ads.bulk_import import IMPORT_BATCH_SIZE, IMPORT_FORMATS, import_ads, read_feed, sync_ads
+
+
+class Command(BaseCommand):
+    help = 'Create ads for a user from a CSV or JSON Lines inventory feed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('feed', help='Path to the feed file')
+        parser.add_argument('--user', required=True,
+                            help='Email of the account, that owns the imported ads')
+        parser.add_argument('--format', choices=IMPORT_FORMATS,
+                            help='Feed format, detected from the file extension if omitted')
+        parser.add_argument('--sync', action='store_true',
+                            help='Treat the feed as full inventory: update changed ads, delete missing ones')
+        parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE,
+                            help='Rows validated and inserted per batch')
+
+    def handle(self, *args, **options):
+        user = User.objects.filter(email=options['user']).first()
+        if user is None:
+            raise CommandError(f'User {options["user"]} does not exist')
+
+        feed_format = options['format'] or options['feed'].rsplit('.', 1)[-1].lower()
+        if feed_format not in IMPORT_FORMATS:
+            raise CommandError('Unsupported feed format, use --format csv or jsonl')
+
+        with open(options['feed'], 'rb') as feed:
+            rows = read_feed(feed, feed_format)
+            if options['sync']:
+                result = sync_ads(user, rows, options['batch_size'])
+            else:
+                created, errors = import_ads(user, rows, options['batch_size'])
+                result = {'created': created, 'errors': errors}
+
+        for error in result['errors']:
+            self.stderr.write(f"row {error['row']}: {json.dumps(error['errors'])}")
+        summary = ', '.join(f'{action} {result[action]}' for action in ('updated', 'deleted', 'unchanged')
+                            if action in result)
+        self.stdout.write(f"Created {result['created']} ads{', ' + summary if summary else ''}, "
+                          f"{len(result['errors'])} rows failed")
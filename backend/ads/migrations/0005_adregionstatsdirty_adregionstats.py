@@ -0,0 +1,43 @@
+# Generated by Django 4.2.16 on 2026-10-19 13:17
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0004_alter_brand_name'),
+        ('ads', '0004_alter_ad_air_conditioning_alter_ad_airbag_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AdRegionStatsDirty',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('country_code', models.CharField(max_length=2, unique=True)),
+                ('marked_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='AdRegionStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('level', models.CharField(choices=[('country', 'Country'), ('state', 'State'), ('city', 'City')], max_length=10)),
+                ('country_code', models.CharField(max_length=2)),
+                ('state', models.CharField(blank=True, default='', max_length=150)),
+                ('city', models.CharField(blank=True, default='', max_length=150)),
+                ('ad_count', models.PositiveIntegerField(default=0)),
+                ('median_price', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('min_price', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('max_price', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('brand', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='catalog.brand')),
+            ],
+            options={
+                'ordering': ['-ad_count'],
+                'indexes': [models.Index(fields=['level', 'country_code', 'state'], name='ads_adregio_level_e46c55_idx'), models.Index(fields=['country_code'], name='ads_adregio_country_c3f4af_idx')],
+            },
+        ),
+    ]
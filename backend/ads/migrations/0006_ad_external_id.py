@@ -0,0 +1,27 @@
+# Generated by Django 4.2.16 on 2026-10-19 14:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ads', '0005_adregionstatsdirty_adregionstats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ad',
+            name='external_id',
+            field=models.CharField(blank=True, max_length=100, null=True),
+        ),
+        migrations.AddField(
+            model_name='ad',
+            name='feed_hash',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='ad',
+            constraint=models.UniqueConstraint(condition=models.Q(('external_id__isnull', False)), fields=('user', 'external_id'), name='unique_ad_external_id'),
+        ),
+    ]
@@ -85,6 +85,10 @@ class Ad(models.Model):
 
     full_address = models.CharField(max_length=300, null=True, blank=True)
 
+    # Dealer feed sync: id of the vehicle in the dealer's feed and hash of its last synced values
+    external_id = models.CharField(max_length=100, null=True, blank=True)
+    feed_hash = models.CharField(max_length=64, null=True, blank=True)
+
     def __str__(self):
         return f'Ad {self.id}: {self.user.email} - {self.brand} - {self.model}'
 
@@ -159,6 +163,10 @@ class Ad(models.Model):
 
             models.Index(fields=['user', 'created_at']),
         ]
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'external_id'], condition=models.Q(
+                external_id__isnull=False), name='unique_ad_external_id'),
+        ]
 
 
 class AdImage(models.Model):
@@ -185,3 +193,53 @@ class Favourite(models.Model):
 
     def __str__(self):
         return f'{self.user.email} - {self.ad.id}'
+
+
+class AdRegionStats(models.Model):
+    """
+    Materialized rollup of ads per region and brand.
+    Rows are rebuilt per country by ads.tasks.refresh_region_stats,
+    brand=None rows hold totals for all brands.
+    """
+    LEVEL_COUNTRY = 'country'
+    LEVEL_STATE = 'state'
+    LEVEL_CITY = 'city'
+    LEVELS = (
+        (LEVEL_COUNTRY, 'Country'),
+        (LEVEL_STATE, 'State'),
+        (LEVEL_CITY, 'City'),
+    )
+
+    level = models.CharField(max_length=10, choices=LEVELS)
+    country_code = models.CharField(max_length=2)
+    state = models.CharField(max_length=150, blank=True, default='')
+    city = models.CharField(max_length=150, blank=True, default='')
+    brand = models.ForeignKey(
+        Brand, on_delete=models.CASCADE, null=True, blank=True)
+
+    ad_count = models.PositiveIntegerField(default=0)
+    median_price = models.DecimalField(max_digits=12, decimal_places=2)
+    min_price = models.DecimalField(max_digits=12, decimal_places=2)
+    max_price = models.DecimalField(max_digits=12, decimal_places=2)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['-ad_count']
+        indexes = [
+            models.Index(fields=['level', 'country_code', 'state']),
+            models.Index(fields=['country_code']),
+        ]
+
+    def __str__(self):
+        region = ', '.join(part for part in (
+            self.city, self.state, self.country_code) if part)
+        return f'{region} ({self.brand or "all brands"}): {self.ad_count} ads'
+
+
+class AdRegionStatsDirty(models.Model):
+    # Countries whose ads changed since the last rollup refresh
+    country_code = models.CharField(max_length=2, unique=True)
+    marked_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'{self.country_code} marked at {self.marked_at}'
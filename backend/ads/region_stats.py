@@ -0,0 +1,102 @@
+from collections import Counter, defaultdict
+from decimal import Decimal
+from django.db import transaction
+from django.db.models import Count, Max, Min
+from .models import Ad, AdRegionStats, AdRegionStatsDirty
+
+# Ad fields that affect the regional rollup
+STATS_FIELDS = {'country_code', 'state', 'city', 'brand', 'price'}
+
+
+def mark_region_stats_dirty(country_codes):
+    """
+    Queue countries for the next incremental refresh (single insert query)
+    """
+    codes = {code for code in country_codes if code}
+    if codes:
+        AdRegionStatsDirty.objects.bulk_create(
+            [AdRegionStatsDirty(country_code=code) for code in codes], ignore_conflicts=True)
+
+
+def _regions(state, city, brand_id):
+    # Rollup rows an ad belongs to: every level, for its brand and for all brands
+    state, city = state or '', city or ''
+    for region in ((AdRegionStats.LEVEL_COUNTRY, '', ''),
+                   (AdRegionStats.LEVEL_STATE, state, ''),
+                   (AdRegionStats.LEVEL_CITY, state, city)):
+        yield region + (None,)
+        yield region + (brand_id,)
+
+
+def refresh_country_stats(country_code):
+    """
+    Rebuild every rollup row of one country from its ads.
+    Counts and price range are grouped in SQL per city and brand, then rolled up.
+    Medians come from one streamed pass over prices in ascending order,
+    which keeps only the middle prices of each group.
+    """
+    ads = Ad.objects.filter(country_code=country_code)
+
+    # region -> [ad count, min price, max price]
+    groups = {}
+    rows = (ads.order_by().values('state', 'city', 'brand_id')
+            .annotate(count=Count('id'), low=Min('price'), high=Max('price'))
+            .values_list('state', 'city', 'brand_id', 'count', 'low', 'high'))
+    for state, city, brand_id, count, low, high in rows:
+        for region in _regions(state, city, brand_id):
+            group = groups.setdefault(region, [0, low, high])
+            group[0] += count
+            group[1], group[2] = min(group[1], low), max(group[2], high)
+
+    # One middle position for odd counts, two for even ones
+    positions = {region: {(count - 1) // 2, count // 2} for region, (count, _, _) in groups.items()}
+    seen = Counter()
+    middles = defaultdict(list)
+    prices = (ads.order_by('price')
+              .values_list('state', 'city', 'brand_id', 'price')
+              .iterator(chunk_size=2000))
+    for state, city, brand_id, price in prices:
+        for region in _regions(state, city, brand_id):
+            if seen[region] in positions.get(region, ()):
+                middles[region].append(price)
+            seen[region] += 1
+
+    stats = []
+    for (level, state, city, brand_id), (count, low, high) in groups.items():
+        middle = middles[level, state, city, brand_id]
+        if not middle:
+            # Ads changed between the two queries, the next refresh picks the group up
+            continue
+        stats.append(AdRegionStats(
+            level=level, country_code=country_code, state=state, city=city, brand_id=brand_id,
+            ad_count=count, min_price=low, max_price=high,
+            median_price=(sum(middle) / len(middle)).quantize(Decimal('0.01'))))
+
+    with transaction.atomic():
+        AdRegionStats.objects.filter(country_code=country_code).delete()
+        AdRegionStats.objects.bulk_create(stats, batch_size=1000)
+    return len(stats)
+
+
+def refresh_region_stats(full=False):
+    """
+    Refresh rollup for countries marked dirty, or for all countries if full=True.
+    Returns number of refreshed countries.
+    """
+    if full:
+        country_codes = set(Ad.objects.exclude(country_code__isnull=True).exclude(
+            country_code='').values_list('country_code', flat=True).distinct())
+        # Countries without ads anymore must be cleared as well
+        country_codes |= set(AdRegionStats.objects.values_list(
+            'country_code', flat=True).distinct())
+        AdRegionStatsDirty.objects.all().delete()
+    else:
+        country_codes = list(
+            AdRegionStatsDirty.objects.values_list('country_code', flat=True))
+
+    for country_code in country_codes:
+        # Marker is removed before refresh, so changes made meanwhile mark it again
+        AdRegionStatsDirty.objects.filter(country_code=country_code).delete()
+        refresh_country_stats(country_code)
+
+    return len(country_codes)
@@ -2,7 +2,7 @@ from rest_framework import serializers
 from catalog.serializers import BrandSerializer, ModelCarSerializer, BodyTypeSerializer, FuelTypeSerializer, DriveTypeSerializer, TransmissionSerializer, ColorSerializer, InteriorMaterialSerializer
 from catalog.models import Brand, ModelCar, BodyType, FuelType, DriveType, Transmission, Color, InteriorMaterial
 from account.serializers import UserBasicSerializer, UserShortSerializer
-from .models import Ad, AdImage, Favourite
+from .models import Ad, AdImage, Favourite, AdRegionStats
 
 
 class AdImageSerializer(serializers.ModelSerializer):
@@ -75,6 +75,42 @@ class AdSerializer(serializers.ModelSerializer):
         read_only_fields = ['id', 'user', 'created_at', 'updated_at']
 
 
+# One row of a bulk import feed, catalog values are given by name
+class AdImportRowSerializer(serializers.ModelSerializer):
+    brand = serializers.CharField()
+    model = serializers.CharField()
+    body_type = serializers.CharField(required=False)
+    fuel_type = serializers.CharField(required=False)
+    drive_type = serializers.CharField(required=False)
+    transmission = serializers.CharField(required=False)
+    exterior_color = serializers.CharField(required=False)
+    interior_color = serializers.CharField(required=False)
+    interior_material = serializers.CharField(required=False)
+
+    class Meta:
+        model = Ad
+        fields = [
+            'title', 'description', 'brand', 'model', 'body_type', 'fuel_type', 'drive_type', 'transmission',
+            'exterior_color', 'interior_color', 'interior_material', 'year', 'mileage', 'power', 'capacity',
+            'battery_power', 'battery_capacity', 'price', 'vin', 'location', 'warranty', 'airbag',
+            'air_conditioning', 'number_of_seats', 'number_of_doors', 'condition', 'owner_count', 'is_first_owner',
+        ]
+
+    def validate(self, attrs):
+        # Names are resolved with the preloaded catalog from context, no queries per row
+        catalog = self.context['catalog']
+        errors = {}
+        for field in catalog.FIELDS:
+            if field in attrs:
+                value = catalog.resolve(field, attrs[field], attrs.get('brand'))
+                if value is None:
+                    errors[field] = [f'Unknown {field.replace("_", " ")} "{attrs[field]}".']
+                attrs[field] = value
+        if errors:
+            raise serializers.ValidationError(errors)
+        return attrs
+
+
 # Less detailed serializer, that optimized for listing Ads
 class AdListSerializer(serializers.ModelSerializer):
     # Dispaly fields as string instead of nested objects
@@ -102,3 +138,13 @@ class FavouriteSerializer(serializers.ModelSerializer):
         model = Favourite
         fields = ['id', 'ad', 'created_at']
         read_only_fields = ['id', 'created_at']
+
+
+class AdRegionStatsSerializer(serializers.ModelSerializer):
+    """Serializer for regional ad stats rollup rows"""
+    brand = serializers.StringRelatedField()
+
+    class Meta:
+        model = AdRegionStats
+        fields = ['level', 'country_code', 'state', 'city', 'brand', 'brand_id',
+                  'ad_count', 'median_price', 'min_price', 'max_price', 'updated_at']
@@ -0,0 +1,26 @@
+from django.db.models.signals import post_init, post_save, post_delete
+from django.dispatch import receiver
+from .models import Ad
+from .region_stats import STATS_FIELDS, mark_region_stats_dirty
+
+
+@receiver(post_init, sender=Ad)
+def remember_ad_country(sender, instance, **kwargs):
+    # Keep loaded country, so moving an ad also refreshes its old country
+    # __dict__ is used to avoid loading deferred fields
+    instance._loaded_country_code = instance.__dict__.get('country_code')
+
+
+@receiver(post_save, sender=Ad)
+def ad_saved(sender, instance, update_fields=None, **kwargs):
+    if update_fields and not STATS_FIELDS.intersection(update_fields):
+        return
+    mark_region_stats_dirty(
+        {instance.country_code, instance._loaded_country_code})
+    instance._loaded_country_code = instance.country_code
+
+
+@receiver(post_delete, sender=Ad)
+def ad_deleted(sender, instance, **kwargs):
+    mark_region_stats_dirty(
+        {instance.country_code, instance._loaded_country_code})
@@ -5,6 +5,8 @@ from celery import shared_task
 from django.core.files.storage import default_storage
 from .utils import create_watermarked_file, validate_image_file
 from .models import AdImage
+from .region_stats import refresh_region_stats as refresh_region_stats_rollup
+from .bulk_import import geocode_pending_ads
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 django.setup()
@@ -60,3 +62,24 @@ def process_image_watermark(image_id, watermark_text='AutoHunt', opacity=0.7):
         error_msg = f'Error with {image_id} id: {str(e)}'
         logger.error(error_msg)
         return error_msg
+
+
+@shared_task(name='ads.tasks.refresh_region_stats')
+def refresh_region_stats(full=False):
+    """
+    Periodic celery task that refreshes regional ad stats rollup
+    """
+    refreshed = refresh_region_stats_rollup(full=full)
+    logger.info(f'Region stats refreshed for {refreshed} countries.')
+    return refreshed
+
+
+@shared_task(name='ads.tasks.geocode_imported_ads')
+def geocode_imported_ads(user_id):
+    """
+    Celery task that geocodes ads imported from a feed, so the upload request
+    doesn't wait for nominatim
+    """
+    geocoded = geocode_pending_ads(user_id)
+    logger.info(f'Geocoded {geocoded} imported ads of user id={user_id}.')
+    return geocoded
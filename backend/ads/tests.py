@@ -4,10 +4,26 @@ from rest_framework.test import APITestCase, APIClient
 from rest_framework import status
 from django.urls import reverse
 from decimal import Decimal
-from .models import Ad, AdImage, Favourite
+from .models import Ad, AdImage, Favourite, AdRegionStats, AdRegionStatsDirty
+from .region_stats import refresh_region_stats
 from catalog.models import Brand, ModelCar, BodyType, FuelType
 from django.core.exceptions import ValidationError
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.files.uploadedfile import SimpleUploadedFile
+from unittest.mock import patch, MagicMock, AsyncMock
+import httpx
+from asgiref.sync import async_to_sync
+from rest_framework_simplejwt.tokens import AccessToken
+import io
+import json
+import tempfile
+import os
 from .filters import AdFilter
+from .location_service import LocationService, normalize_location_query
+from .autocomplete import LocationAutocomplete
+from .export import aexport_lines
+from .tasks import geocode_imported_ads
 
 User = get_user_model()
 
@@ -642,13 +658,13 @@ class LocationAPITests(APITestCase):
         # Test for searching location with less than 3 letters
         response = self.client.get(self.url, {'q': 'Ky'})
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data['results']), 0)
+        self.assertEqual(len(response.json()['results']), 0)
 
     def test_search_location__with_empty_query(self):
         # Test for searching location with an empty query
         response = self.client.get(self.url, {'q': ''})
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data['results']), 0)
+        self.assertEqual(len(response.json()['results']), 0)
 
     def test_reverse_geocode_invalid_coordinates(self):
         # Test for reverse geocoding with invalid coordinates
@@ -659,3 +675,666 @@ class LocationAPITests(APITestCase):
         # Test for reverse geocoding without parameters
         response = self.client.get(self.rv_url)
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @patch('ads.location_service.httpx.AsyncClient.get', new_callable=AsyncMock)
+    def test_search_location_async(self, mock_get):
+        # Test for async search endpoint using async http client
+        cache.clear()
+        mock_get.return_value = httpx_response([nominatim_place('Kyiv, Ukraine')])
+
+        response = self.client.get(self.url, {'q': 'Kyiv'})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['results'][0]['address']['city'], 'Kyiv')
+
+    @patch('ads.location_service.httpx.AsyncClient.get', new_callable=AsyncMock)
+    def test_reverse_geocode_async_not_found(self, mock_get):
+        # Test for async reverse endpoint when nothing is found
+        cache.clear()
+        mock_get.return_value = httpx_response({'error': 'Unable to geocode'})
+
+        response = self.client.get(self.rv_url, {'lat': 10.0, 'lon': 10.0})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    @patch('ads.location_service.httpx.AsyncClient.get', new_callable=AsyncMock)
+    def test_async_client_is_reused(self, mock_get):
+        # Test for async lookups on one loop sharing a pooled client
+        mock_get.return_value = httpx_response({'error': 'Unable to geocode'})
+
+        async def scenario():
+            first = LocationService._async_client()
+            await LocationService.afetch_reverse_geocode(10.0, 10.0)
+            self.assertIs(LocationService._async_client(), first)
+            await LocationService.aclose_client()
+            self.assertTrue(first.is_closed)
+
+        async_to_sync(scenario)()
+
+    def test_search_location_method_not_allowed(self):
+        # Test for rejecting non GET requests
+        response = self.client.post(self.url, {'q': 'Kyiv'})
+        self.assertEqual(response.status_code,
+                         status.HTTP_405_METHOD_NOT_ALLOWED)
+
+
+    def test_location_views_use_drf_authentication_and_throttles(self):
+        # Test for logged in users throttled per user, invalid tokens rejected
+        user = User.objects.create_user(
+            email='geo@email.com', username='geo@email.com', password='321qwerty',
+            first_name='Geo', last_name='User', phone_number='+1234500000')
+        cache.clear()
+
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(user)}')
+        response = self.client.get(self.url, {'q': 'Ky'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIsNotNone(cache.get(f'throttle_user_{user.id}'))
+        self.assertIsNone(cache.get('throttle_anon_127.0.0.1'))
+
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer invalid')
+        response = self.client.get(self.url, {'q': 'Ky'})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+def httpx_response(data):
+    return httpx.Response(200, json=data, request=httpx.Request('GET', LocationService.NOMINATIUM_URL))
+
+
+def nominatim_place(name, lat='52.52', lon='13.40'):
+    # Build a raw nominatim search item
+    return {'display_name': name, 'lat': lat, 'lon': lon,
+            'address': {'city': name.split(',')[0], 'country_code': 'de'},
+            'place_id': 1, 'osm_type': 'node', 'osm_id': 1}
+
+
+def nominatim_response(items):
+    response = MagicMock()
+    response.json.return_value = items
+    return response
+
+
+class LocationAutocompleteTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_normalize_location_query(self):
+        # Test for unicode folding and whitespace normalization
+        self.assertEqual(normalize_location_query(
+            '  Zürich,   Schweiz '), 'zurich schweiz')
+
+    @patch('ads.location_service.requests.get')
+    def test_longer_prefix_served_from_cache(self, mock_get):
+        # Test for serving a longer prefix from cached shorter prefix results
+        mock_get.return_value = nominatim_response([
+            nominatim_place('Berlin, Germany'),
+            nominatim_place('Berlingen, Switzerland'),
+            nominatim_place('Berlin Heights, United States'),
+            nominatim_place('Berlevag, Norway'),
+        ])
+
+        LocationAutocomplete.search('Berl')
+        results = LocationAutocomplete.search('Berlin')
+
+        self.assertEqual(mock_get.call_count, 1)
+        self.assertEqual(len(results), 3)
+        self.assertNotIn('Berlevag, Norway', [
+                         r['display_name'] for r in results])
+
+    @patch('ads.location_service.requests.get')
+    def test_too_few_filtered_results_fall_through(self, mock_get):
+        # Test for querying upstream when filtered prefix results are insufficient
+        mock_get.return_value = nominatim_response([
+            nominatim_place('Berlin, Germany'),
+            nominatim_place('Berlevag, Norway'),
+        ])
+
+        LocationAutocomplete.search('Berl')
+        LocationAutocomplete.search('Berlin')
+
+        self.assertEqual(mock_get.call_count, 2)
+
+    @patch('ads.location_service.requests.get')
+    def test_popular_entry_retention_grows(self, mock_get):
+        # Test for extending timeout of frequently requested prefixes
+        mock_get.return_value = nominatim_response(
+            [nominatim_place('Berlin, Germany')])
+
+        LocationAutocomplete.search('berlin ')
+        # Hits outside the sample are served without a cache write
+        with patch('ads.autocomplete.random.randrange', return_value=1), \
+                patch('ads.autocomplete.cache.set') as mock_set:
+            LocationAutocomplete.search('Berlin')
+        mock_set.assert_not_called()
+
+        # A sampled hit stands for HIT_SAMPLE_RATE hits
+        with patch('ads.autocomplete.random.randrange', return_value=0), \
+                patch('ads.autocomplete.cache.set') as mock_set:
+            LocationAutocomplete.search('BERLIN')
+
+        self.assertEqual(mock_get.call_count, 1)
+        self.assertEqual(
+            mock_set.call_args[0][2], LocationAutocomplete.BASE_TIMEOUT * 2)
+
+    @patch('ads.location_service.requests.get')
+    def test_search_location_shares_cache_between_limits(self, mock_get):
+        # Test for limit=1 and limit=10 searches sharing one cache entry
+        mock_get.return_value = nominatim_response(
+            [nominatim_place(f'Kyiv {i}, Ukraine') for i in range(5)])
+
+        self.assertEqual(len(LocationService.search_location('Kyiv', limit=1)), 1)
+        self.assertEqual(len(LocationService.search_location('kyiv', limit=10)), 5)
+        self.assertEqual(mock_get.call_count, 1)
+
+
+class ReverseGeocodeCacheTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.bulk_url = reverse('bulk-reverse-geocode')
+        self.admin = User.objects.create_user(
+            email='admin@email.com',
+            password='321qwerty',
+            first_name='Admin',
+            last_name='User',
+            phone_number='+1234567000',
+            is_staff=True
+        )
+
+    @patch('ads.location_service.requests.get')
+    def test_nearby_points_share_cache_entry(self, mock_get):
+        # Test for quantizing coordinates into one cache cell
+        mock_get.return_value = nominatim_response(
+            nominatim_place('Berlin, Germany'))
+
+        LocationService.reverse_geocode(52.520001, 13.400001)
+        result = LocationService.reverse_geocode(52.520204, 13.399811)
+
+        self.assertEqual(mock_get.call_count, 1)
+        self.assertEqual(result['display_name'], 'Berlin, Germany')
+
+    @patch('ads.location_service.requests.get')
+    def test_not_found_is_cached(self, mock_get):
+        # Test for negative caching of lookups without result
+        mock_get.return_value = nominatim_response(
+            {'error': 'Unable to geocode'})
+
+        self.assertIsNone(LocationService.reverse_geocode(0.0, 0.0))
+        self.assertIsNone(LocationService.reverse_geocode(0.0, 0.0))
+        self.assertEqual(mock_get.call_count, 1)
+
+    @patch('ads.location_service.requests.Session.get')
+    def test_bulk_reverse_geocode(self, mock_get):
+        # Test for bulk endpoint resolving each grid cell once
+        mock_get.return_value = nominatim_response(
+            nominatim_place('Berlin, Germany'))
+
+        self.client.force_authenticate(user=self.admin)
+        points = [{'lat': 52.52, 'lon': 13.40},
+                  {'lat': 52.5201, 'lon': 13.4001},
+                  {'lat': 48.85, 'lon': 2.35}]
+        response = self.client.post(
+            self.bulk_url, {'points': points}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['results']), 3)
+        self.assertEqual(mock_get.call_count, 2)
+
+    def test_bulk_reverse_geocode_requires_admin(self):
+        # Test for bulk endpoint being available to admins only
+        response = self.client.post(
+            self.bulk_url, {'points': [{'lat': 1, 'lon': 1}]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_bulk_reverse_geocode_invalid_points(self):
+        # Test for bulk endpoint with invalid coordinates
+        self.client.force_authenticate(user=self.admin)
+        response = self.client.post(
+            self.bulk_url, {'points': [{'lat': 91, 'lon': 1}]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class BackfillLocationsCommandTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(
+            email='dealer@email.com',
+            password='321qwerty',
+            first_name='Dealer',
+            last_name='User',
+            phone_number='+1234567111',
+            account_type=User.ACCOUNT_COMPANY,
+            company_office='Berlin'
+        )
+        self.brand = Brand.objects.create(name='Buick')
+        self.model = ModelCar.objects.create(
+            name='Grand National', brand=self.brand)
+        for i in range(5):
+            Ad.objects.create(user=self.user, title=f'Car {i}', brand=self.brand, model=self.model,
+                              year=1987, mileage=100, price=Decimal('1000'),
+                              location='Berlin' if i % 2 else 'Hamburg')
+
+        checkpoint = tempfile.NamedTemporaryFile(suffix='.json', delete=False)
+        checkpoint.close()
+        os.remove(checkpoint.name)
+        self.checkpoint = checkpoint.name
+        self.addCleanup(lambda: os.path.exists(
+            self.checkpoint) and os.remove(self.checkpoint))
+
+    def run_command(self, **options):
+        call_command('backfill_locations', checkpoint=self.checkpoint,
+                     rate=0, stdout=io.StringIO(), **options)
+
+    @patch('ads.location_service.requests.get')
+    def test_backfill_geocodes_rows(self, mock_get):
+        # Test for backfilling ads and company profiles in chunks
+        mock_get.side_effect = lambda url, params, **kwargs: nominatim_response(
+            [nominatim_place(f"{params['q']}, Germany")])
+
+        self.run_command(chunk_size=2)
+
+        self.assertFalse(Ad.objects.filter(latitude__isnull=True).exists())
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.city, 'Berlin')
+        # Berlin and Hamburg are resolved once each
+        self.assertEqual(mock_get.call_count, 2)
+
+    @patch('ads.location_service.requests.get')
+    def test_backfill_resumes_from_checkpoint(self, mock_get):
+        # Test for skipping rows before the saved checkpoint
+        mock_get.return_value = nominatim_response(
+            [nominatim_place('Hamburg, Germany')])
+        last_id = Ad.objects.order_by('pk').values_list('pk', flat=True)[2]
+        with open(self.checkpoint, 'w') as f:
+            json.dump({'ads': last_id}, f)
+
+        self.run_command(target='ads')
+
+        self.assertEqual(Ad.objects.filter(latitude__isnull=False).count(), 2)
+        with open(self.checkpoint) as f:
+            self.assertEqual(json.load(f)['ads'], Ad.objects.order_by(
+                '-pk').values_list('pk', flat=True)[0])
+
+
+class AdRegionStatsTests(APITestCase):
+    def setUp(self):
+        self.url = reverse('ad-region-stats')
+        self.user = User.objects.create_user(
+            email='test@email.com',
+            username='test@email.com',
+            password='321qwerty',
+            first_name='Test',
+            last_name='User',
+            phone_number='+1234567890'
+        )
+        self.admin = User.objects.create_user(
+            email='admin@email.com',
+            username='admin@email.com',
+            password='321qwerty',
+            first_name='Admin',
+            last_name='User',
+            phone_number='+1234567000',
+            is_staff=True
+        )
+        self.brand = Brand.objects.create(name='Buick')
+        self.other_brand = Brand.objects.create(name='Ford')
+        self.model = ModelCar.objects.create(
+            name='Grand National', brand=self.brand)
+
+    def create_ad(self, price, city='Berlin', brand=None):
+        return Ad.objects.create(user=self.user, title='Car', brand=brand or self.brand, model=self.model,
+                                 year=1987, mileage=100, price=Decimal(price),
+                                 country_code='DE', state=city, city=city)
+
+    def test_ad_changes_mark_country_dirty(self):
+        # Test for signals queueing changed countries
+        ad = self.create_ad('1000')
+        self.assertTrue(AdRegionStatsDirty.objects.filter(
+            country_code='DE').exists())
+
+        refresh_region_stats()
+        self.assertFalse(AdRegionStatsDirty.objects.exists())
+
+        ad.country_code = 'FR'
+        ad.save()
+        self.assertEqual(set(AdRegionStatsDirty.objects.values_list(
+            'country_code', flat=True)), {'DE', 'FR'})
+
+    def test_refresh_computes_rollup(self):
+        # Test for counts and median price per region and brand
+        self.create_ad('1000')
+        self.create_ad('3000')
+        self.create_ad('8000', city='Hamburg', brand=self.other_brand)
+
+        self.assertEqual(refresh_region_stats(), 1)
+
+        country = AdRegionStats.objects.get(
+            level=AdRegionStats.LEVEL_COUNTRY, brand__isnull=True)
+        self.assertEqual(country.ad_count, 3)
+        self.assertEqual(country.median_price, Decimal('3000.00'))
+
+        berlin = AdRegionStats.objects.get(
+            level=AdRegionStats.LEVEL_CITY, city='Berlin', brand=self.brand)
+        self.assertEqual(berlin.ad_count, 2)
+        self.assertEqual(berlin.median_price, Decimal('2000.00'))
+        self.assertEqual(berlin.max_price, Decimal('3000.00'))
+
+    def test_deleted_ads_leave_rollup(self):
+        # Test for removing rollup rows after last ad is deleted
+        ad = self.create_ad('1000')
+        refresh_region_stats()
+        ad.delete()
+        refresh_region_stats()
+        self.assertFalse(AdRegionStats.objects.exists())
+
+    def test_region_stats_endpoint(self):
+        # Test for admin endpoint reading rollup rows
+        self.create_ad('1000')
+        self.create_ad('8000', city='Hamburg')
+        refresh_region_stats()
+
+        self.client.force_authenticate(user=self.admin)
+        response = self.client.get(
+            self.url, {'level': 'city', 'country_code': 'de'})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['results']), 2)
+
+        response = self.client.get(self.url, {'brand': 'all'})
+        self.assertEqual(response.data['results'][0]['brand'], 'Buick')
+
+    def test_region_stats_endpoint_requires_admin(self):
+        # Test for regular users being denied
+        self.client.force_authenticate(user=self.user)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class AdExportTests(APITestCase):
+    def setUp(self):
+        self.url = reverse('ad-export')
+        self.user = User.objects.create_user(
+            email='test@email.com',
+            username='test@email.com',
+            password='321qwerty',
+            first_name='Test',
+            last_name='User',
+            phone_number='+1234567890'
+        )
+        self.admin = User.objects.create_user(
+            email='admin@email.com',
+            username='admin@email.com',
+            password='321qwerty',
+            first_name='Admin',
+            last_name='User',
+            phone_number='+1234567000',
+            is_staff=True
+        )
+        self.brand = Brand.objects.create(name='Buick')
+        self.model = ModelCar.objects.create(
+            name='Grand National', brand=self.brand)
+        for price in ('1000', '3000', '8000'):
+            Ad.objects.create(user=self.user, title='Car, "classic"', brand=self.brand, model=self.model,
+                              year=1987, mileage=100, price=Decimal(price))
+
+    def test_export_requires_admin(self):
+        # Test for export available to admins only
+        self.client.force_authenticate(user=self.user)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_export_csv_streams_filtered_ads(self):
+        # Test for CSV export with AdFilter params
+        self.client.force_authenticate(user=self.admin)
+        response = self.client.get(self.url, {'price_max': 5000})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[0].startswith('id,title,price'))
+        self.assertIn('"Car, ""classic""",1000.00', lines[1])
+
+    def test_export_jsonl(self):
+        # Test for JSON Lines export with one ad per line
+        self.client.force_authenticate(user=self.admin)
+        response = self.client.get(self.url, {'output': 'jsonl'})
+
+        rows = [json.loads(line) for line in b''.join(
+            response.streaming_content).decode().splitlines()]
+        self.assertEqual([row['price'] for row in rows], ['1000.00', '3000.00', '8000.00'])
+        self.assertEqual(rows[0]['brand'], 'Buick')
+
+    def test_export_streams_async_under_asgi(self):
+        # Test for ASGI requests getting an async iterator read in chunks
+        token = str(AccessToken.for_user(self.admin))
+
+        async def scenario():
+            response = await self.async_client.get(
+                self.url, {'output': 'jsonl'}, headers={'authorization': f'Bearer {token}'})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertTrue(response.is_async)
+            return b''.join([chunk async for chunk in response.streaming_content])
+
+        rows = [json.loads(line) for line in async_to_sync(scenario)().decode().splitlines()]
+        self.assertEqual([row['price'] for row in rows], ['1000.00', '3000.00', '8000.00'])
+
+        async def collect():
+            return [chunk async for chunk in aexport_lines(Ad.objects.all(), 'csv', chunk_size=2)]
+
+        # Header and first ad, then the other two
+        chunks = async_to_sync(collect)()
+        self.assertEqual([len(chunk.splitlines()) for chunk in chunks], [2, 2])
+
+    def test_export_invalid_params(self):
+        # Test for invalid output and filter params
+        self.client.force_authenticate(user=self.admin)
+        self.assertEqual(self.client.get(self.url, {'output': 'xml'}).status_code,
+                         status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get(self.url, {'price_max': 'cheap'}).status_code,
+                         status.HTTP_400_BAD_REQUEST)
+
+    def test_export_command_writes_file(self):
+        # Test for management command exporting filtered ads to a file
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'ads.jsonl')
+            call_command('export_ads', '--format', 'jsonl', '--output', path,
+                         '--filter', 'price_min=2000', stderr=io.StringIO())
+            with open(path, encoding='utf-8') as file:
+                rows = [json.loads(line) for line in file]
+
+        self.assertEqual(len(rows), 2)
+
+
+class AdBulkImportTests(APITestCase):
+    def setUp(self):
+        self.url = reverse('ads-bulk-import')
+        self.user = User.objects.create_user(
+            email='dealer@email.com',
+            username='dealer@email.com',
+            password='321qwerty',
+            first_name='Dealer',
+            last_name='User',
+            phone_number='+1234567111',
+            account_type=User.ACCOUNT_COMPANY,
+        )
+        self.brand = Brand.objects.create(name='Buick')
+        self.model = ModelCar.objects.create(
+            name='Grand National', brand=self.brand)
+        self.fuel_type = FuelType.objects.create(name='Petrol')
+        self.geocode = {
+            'display_name': 'Berlin, Germany',
+            'latitude': '52.520008',
+            'longitude': '13.404954',
+            'address': {'city': 'Berlin', 'country': 'Germany', 'country_code': 'DE'},
+        }
+        # Geocoding task is run explicitly by the tests
+        patcher = patch('ads.views.geocode_imported_ads.delay')
+        self.geocode_later = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def upload(self, name, content):
+        self.client.force_authenticate(user=self.user)
+        return self.client.post(self.url, {'file': SimpleUploadedFile(name, content.encode())}, format='multipart')
+
+    @patch.object(LocationService, 'search_location')
+    def test_import_csv_resolves_names_and_geocodes_once(self, search_location):
+        # Test for CSV feed with catalog names, each unique location geocoded once in the background
+        search_location.return_value = [self.geocode]
+        feed = ('title,brand,model,fuel_type,year,mileage,price,location,warranty\n'
+                'Car 1,buick,Grand National,Petrol,1987,100,1000,Berlin,true\n'
+                'Car 2,Buick,grand national,,1988,200,2000, berlin,\n'
+                'Car 3,Ford,Mustang,,1988,200,2000,,\n')
+        response = self.upload('inventory.csv', feed)
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['created'], 2)
+        self.assertEqual(len(response.data['errors']), 1)
+        self.assertEqual(response.data['errors'][0]['row'], 4)
+        self.assertIn('brand', response.data['errors'][0]['errors'])
+        # Upload request doesn't wait for nominatim
+        search_location.assert_not_called()
+        self.geocode_later.assert_called_once_with(self.user.id)
+        self.assertFalse(Ad.objects.filter(user=self.user, latitude__isnull=False).exists())
+
+        self.assertEqual(geocode_imported_ads(self.user.id), 2)
+        search_location.assert_called_once()
+        ads = Ad.objects.filter(user=self.user).order_by('title')
+        self.assertEqual(ads[0].fuel_type, self.fuel_type)
+        self.assertTrue(ads[0].warranty)
+        self.assertEqual(ads[1].country_code, 'DE')
+        self.assertTrue(AdRegionStatsDirty.objects.filter(country_code='DE').exists())
+
+    def test_import_enforces_ad_limit_for_whole_feed(self):
+        # Test for rows over the remaining ad limit reported as errors
+        for i in range(9):
+            Ad.objects.create(user=self.user, title=f'Car {i}', brand=self.brand, model=self.model,
+                              year=1987, mileage=100, price=Decimal('1000'))
+        feed = ''.join(json.dumps({'title': f'New {i}', 'brand': 'Buick', 'model': 'Grand National',
+                                   'price': '1000'}) + '\n' for i in range(3))
+        response = self.upload('inventory.jsonl', feed + 'not json\n')
+
+        self.assertEqual(response.data['created'], 1)
+        self.assertEqual([error['errors'] for error in response.data['errors']],
+                         [{'detail': 'Ad limit reached.'}, {'detail': 'Ad limit reached.'},
+                          {'detail': 'Invalid JSON.'}])
+        self.assertEqual(Ad.objects.filter(user=self.user).count(), 10)
+
+    def test_import_succeeds_without_task_broker(self):
+        # Test for imported ads kept when the geocoding task cannot be sent
+        self.geocode_later.side_effect = ConnectionError('broker down')
+        response = self.upload('inventory.csv', 'title,brand,model,price,location\nCar,Buick,Grand National,1000,Berlin\n')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Ad.objects.filter(user=self.user, latitude__isnull=True).count(), 1)
+
+    def test_import_rejects_unknown_format(self):
+        # Test for feed format detection
+        response = self.upload('inventory.xml', '<ads/>')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_import_command(self):
+        # Test for management command importing a feed file for a user
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'inventory.csv')
+            with open(path, 'w', encoding='utf-8') as file:
+                file.write('title,brand,model,price\nCar,Buick,Grand National,1000\n')
+            out = io.StringIO()
+            call_command('import_ads', path, '--user', self.user.email, stdout=out, stderr=io.StringIO())
+
+        self.assertIn('Created 1 ads', out.getvalue())
+        self.assertEqual(Ad.objects.filter(user=self.user).count(), 1)
+
+
+class AdFeedSyncTests(APITestCase):
+    def setUp(self):
+        self.url = reverse('ads-sync-feed')
+        self.user = User.objects.create_user(
+            email='dealer@email.com',
+            username='dealer@email.com',
+            password='321qwerty',
+            first_name='Dealer',
+            last_name='User',
+            phone_number='+1234567111',
+            account_type=User.ACCOUNT_COMPANY,
+        )
+        self.brand = Brand.objects.create(name='Buick')
+        self.model = ModelCar.objects.create(
+            name='Grand National', brand=self.brand)
+        patcher = patch('ads.views.geocode_imported_ads.delay')
+        self.geocode_later = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def sync(self, rows):
+        self.client.force_authenticate(user=self.user)
+        feed = ''.join(json.dumps({'brand': 'Buick', 'model': 'Grand National', **row}) + '\n' for row in rows)
+        return self.client.post(self.url, {'file': SimpleUploadedFile('feed.jsonl', feed.encode())},
+                                format='multipart')
+
+    def test_sync_applies_only_changes(self):
+        # Test for feed sync inserting, updating and deleting only changed vehicles
+        manual = Ad.objects.create(user=self.user, title='Manual', brand=self.brand, model=self.model,
+                                   year=1987, mileage=100, price=Decimal('1000'))
+        response = self.sync([{'external_id': 'A', 'title': 'Car A', 'price': '1000'},
+                              {'external_id': 'B', 'title': 'Car B', 'price': '2000'},
+                              {'vin': 'VIN123', 'title': 'Car C', 'price': '3000'}])
+        self.assertEqual(response.data['created'], 3)
+
+        ad_a = Ad.objects.get(user=self.user, external_id='A')
+        response = self.sync([{'external_id': 'A', 'title': 'Car A', 'price': '1000.00'},
+                              {'external_id': 'B', 'title': 'Car B', 'price': '2500'}])
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual({key: response.data[key] for key in ('created', 'updated', 'deleted', 'unchanged')},
+                         {'created': 0, 'updated': 1, 'deleted': 1, 'unchanged': 1})
+        self.assertEqual(Ad.objects.get(user=self.user, external_id='B').price, Decimal('2500'))
+        self.assertFalse(Ad.objects.filter(external_id='VIN123').exists())
+        # Unchanged and manually created ads are not written
+        self.assertEqual(Ad.objects.get(id=ad_a.id).updated_at, ad_a.updated_at)
+        self.assertTrue(Ad.objects.filter(id=manual.id).exists())
+
+    def test_sync_invalid_row_keeps_existing_ad(self):
+        # Test for rows failing validation not deleting their ads
+        self.sync([{'external_id': 'A', 'title': 'Car A', 'price': '1000'}])
+        response = self.sync([{'external_id': 'A', 'title': 'Car A', 'price': 'cheap'},
+                              {'external_id': 'A', 'title': 'Again', 'price': '1000'},
+                              {'title': 'No key', 'price': '1000'}])
+
+        self.assertEqual(response.data['deleted'], 0)
+        self.assertEqual(len(response.data['errors']), 3)
+        self.assertTrue(Ad.objects.filter(external_id='A').exists())
+
+    def test_sync_adopts_ads_without_feed_key_by_vin(self):
+        # Test for imported or manually created ads matched by vin instead of duplicated
+        imported = Ad.objects.create(user=self.user, title='Imported', brand=self.brand, model=self.model,
+                                     year=1987, mileage=100, price=Decimal('1000'), vin='1G4GJ1174HP4')
+        response = self.sync([{'external_id': 'A', 'vin': '1g4gj1174hp4 ', 'title': 'Car A', 'price': '1200'},
+                              {'external_id': 'B', 'title': 'Car B', 'price': '2000'}])
+
+        self.assertEqual((response.data['created'], response.data['updated']), (1, 1))
+        imported.refresh_from_db()
+        self.assertEqual((imported.external_id, imported.title), ('A', 'Car A'))
+        self.assertEqual(Ad.objects.filter(user=self.user).count(), 2)
+
+        response = self.sync([{'external_id': 'A', 'vin': '1g4gj1174hp4 ', 'title': 'Car A', 'price': '1200'},
+                              {'external_id': 'B', 'title': 'Car B', 'price': '2000'}])
+        self.assertEqual(response.data['unchanged'], 2)
+
+    def upload(self, name, content):
+        self.client.force_authenticate(user=self.user)
+        return self.client.post(self.url, {'file': SimpleUploadedFile(name, content.encode())},
+                                format='multipart')
+
+    def test_sync_incomplete_feed_deletes_nothing(self):
+        # Test for empty feed, bad CSV header and corrupt JSON line not deleting missing vehicles
+        self.sync([{'external_id': 'A', 'title': 'Car A', 'price': '1000'},
+                   {'external_id': 'B', 'title': 'Car B', 'price': '2000'}])
+
+        feeds = [
+            ('feed.jsonl', ''),
+            ('feed.csv', 'title,brand,model,price\n'),
+            ('feed.csv', 'id;title;brand;model;price\nA;Car A;Buick;Grand National;1000\n'),
+            ('feed.jsonl', json.dumps({'external_id': 'A', 'title': 'Car A', 'brand': 'Buick',
+                                       'model': 'Grand National', 'price': '1000'}) + '\n{"external_id": "B", \n'),
+        ]
+        for name, content in feeds:
+            with self.subTest(content=content):
+                response = self.upload(name, content)
+                self.assertEqual(response.data['deleted'], 0)
+                self.assertEqual(Ad.objects.filter(user=self.user, external_id__in=['A', 'B']).count(), 2)
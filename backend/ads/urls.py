@@ -1,13 +1,18 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import AdViewSet, FavouriteViewSet, search_location, reverse_geocode
+from .views import AdViewSet, FavouriteViewSet, search_location, reverse_geocode, bulk_reverse_geocode, AdRegionStatsView, AdExportView
 
 router = DefaultRouter()
 router.register('ads', AdViewSet, basename='ads')
 router.register('favourites', FavouriteViewSet, basename='favourites')
 
 urlpatterns = [
+    path('ads/stats/regions/', AdRegionStatsView.as_view(),
+         name='ad-region-stats'),
+    path('ads/export/', AdExportView.as_view(), name='ad-export'),
     path('', include(router.urls)),
     path('locations/search/', search_location, name='search-location'),
-    path('locations/reverse/', reverse_geocode, name='reverse-geocode')
+    path('locations/reverse/', reverse_geocode, name='reverse-geocode'),
+    path('locations/reverse/bulk/', bulk_reverse_geocode,
+         name='bulk-reverse-geocode'),
 ]
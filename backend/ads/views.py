@@ -1,54 +1,123 @@
+import logging
 from rest_framework import viewsets, status
-from rest_framework.exceptions import PermissionDenied
-from rest_framework.permissions import AllowAny, IsAuthenticated
+from rest_framework.exceptions import PermissionDenied, AuthenticationFailed
+from rest_framework.permissions import AllowAny, IsAuthenticated, IsAdminUser
 from rest_framework.decorators import action, api_view, permission_classes
 from rest_framework.permissions import AllowAny
 from rest_framework.response import Response
+from rest_framework.views import APIView
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.http import JsonResponse, StreamingHttpResponse
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework.filters import SearchFilter, OrderingFilter
 from django.shortcuts import get_object_or_404
-from .models import Ad, AdImage, Favourite
-from .serializers import AdSerializer, AdListSerializer, AdImageSerializer, FavouriteSerializer
+from .models import Ad, AdImage, Favourite, AdRegionStats
+from .serializers import AdSerializer, AdListSerializer, AdImageSerializer, FavouriteSerializer, AdRegionStatsSerializer
 from .filters import AdFilter
 from .utils import validate_image_file
-from .tasks import process_image_watermark
+from .tasks import process_image_watermark, geocode_imported_ads
 from .pagination import AdPagination
 from account.throttles import CreateAdThrottle, UploadThrottle
 from subscription.utils import can_user_create_ad, get_user_ad_stats
 from .location_service import LocationService
+from .autocomplete import LocationAutocomplete
+from .export import EXPORT_FORMATS, aexport_lines, export_lines, filter_ads
+from .bulk_import import IMPORT_FORMATS, MAX_IMPORT_ROWS, import_ads, read_feed, sync_ads
 
+logger = logging.getLogger(__name__)
 
-@api_view(['GET'])
-@permission_classes([AllowAny])
-def search_location(request):
-    query = request.query_params.get('q', '')
+
+# Location lookups are native async views, so slow nominatim requests
+# wait on the event loop instead of holding a thread from the sync pool
+async def _check_location_request(request):
+    # Plain django views skip DRF, so method check, authentication and throttling are done here
+    if request.method != 'GET':
+        return JsonResponse({'detail': f'Method "{request.method}" not allowed.'}, status=status.HTTP_405_METHOD_NOT_ALLOWED)
+    return await sync_to_async(_authenticate_and_throttle)(request)
+
+
+def _authenticate_and_throttle(request):
+    """
+    Default DRF authentication and throttle classes applied like in APIView,
+    so logged in users keep their per user quota. Returns error response or None.
+    """
+    drf_request = Request(request, authenticators=[
+        authenticator() for authenticator in api_settings.DEFAULT_AUTHENTICATION_CLASSES])
+    try:
+        request.user = drf_request.user
+    except AuthenticationFailed as e:
+        detail = e.detail if isinstance(e.detail, dict) else {'detail': e.detail}
+        return JsonResponse(detail, status=e.status_code)
+
+    for throttle_class in api_settings.DEFAULT_THROTTLE_CLASSES:
+        if not throttle_class().allow_request(drf_request, None):
+            return JsonResponse({'detail': 'Request was throttled.'}, status=status.HTTP_429_TOO_MANY_REQUESTS)
+    return None
+
+
+async def search_location(request):
+    error_response = await _check_location_request(request)
+    if error_response:
+        return error_response
+
+    query = request.GET.get('q', '')
 
     if not query or len(query) < 3:
-        return Response({'results': []})
+        return JsonResponse({'results': []})
+
+    results = await LocationAutocomplete.asearch(query=query, limit=10)
+    return JsonResponse({'results': results})
 
-    results = LocationService.search_location(query=query, limit=10)
-    return Response({'results': results})
 
+async def reverse_geocode(request):
+    error_response = await _check_location_request(request)
+    if error_response:
+        return error_response
 
-@api_view(['GET'])
-@permission_classes([AllowAny])
-def reverse_geocode(request):
     try:
-        lat = float(request.query_params.get('lat'))
-        lon = float(request.query_params.get('lon'))
+        lat = float(request.GET.get('lat'))
+        lon = float(request.GET.get('lon'))
 
         if not LocationService.validate_coordinates(lat, lon):
-            return Response({'detail': 'Invalid coordinates'}, status=status.HTTP_400_BAD_REQUEST)
+            return JsonResponse({'detail': 'Invalid coordinates'}, status=status.HTTP_400_BAD_REQUEST)
 
-        result = LocationService.reverse_geocode(lat, lon)
+        result = await LocationService.areverse_geocode(lat, lon)
 
         if result:
-            return Response(result)
-        return Response({'detail': 'Location not found.'}, status=status.HTTP_404_NOT_FOUND)
+            return JsonResponse(result)
+        return JsonResponse({'detail': 'Location not found.'}, status=status.HTTP_404_NOT_FOUND)
 
     except (ValueError, TypeError):
+        return JsonResponse({'detail': 'Invalid parameters'}, status=status.HTTP_400_BAD_REQUEST)
+
+
+@api_view(['POST'])
+@permission_classes([IsAdminUser])
+def bulk_reverse_geocode(request):
+    # Resolve many points in one call, used for admin backfills
+    points = request.data.get('points')
+
+    if not isinstance(points, list) or not points:
+        return Response({'detail': 'points must be a non-empty list.'}, status=status.HTTP_400_BAD_REQUEST)
+
+    if len(points) > LocationService.MAX_BULK_POINTS:
+        return Response({'detail': f'Maximum {LocationService.MAX_BULK_POINTS} points per request.'}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        coordinates = [(float(point['lat']), float(point['lon']))
+                       for point in points]
+    except (KeyError, ValueError, TypeError):
         return Response({'detail': 'Invalid parameters'}, status=status.HTTP_400_BAD_REQUEST)
 
+    if not all(LocationService.validate_coordinates(lat, lon) for lat, lon in coordinates):
+        return Response({'detail': 'Invalid coordinates'}, status=status.HTTP_400_BAD_REQUEST)
+
+    results = LocationService.bulk_reverse_geocode(coordinates)
+    return Response({'results': results})
+
 
 class AdViewSet(viewsets.ModelViewSet):
     """
@@ -78,7 +147,7 @@ class AdViewSet(viewsets.ModelViewSet):
 
     # Dynamicly choose permissions per action
     def get_permissions(self):
-        if self.action in ['create', 'update', 'partial_update', 'destroy', 'add_image', 'remove_image']:
+        if self.action in ['create', 'update', 'partial_update', 'destroy', 'add_image', 'remove_image', 'bulk_import', 'sync_feed']:
             # Only authenticated users can modify ads
             return [IsAuthenticated()]
         else:
@@ -87,7 +156,7 @@ class AdViewSet(viewsets.ModelViewSet):
     def get_throttles(self):
         if self.action == 'create':
             return [CreateAdThrottle()]
-        elif self.action == 'add_image':
+        elif self.action in ('add_image', 'bulk_import', 'sync_feed'):
             return [UploadThrottle()]
         return super().get_throttles()
 
@@ -194,6 +263,54 @@ class AdViewSet(viewsets.ModelViewSet):
         #     new_images.append(serializer.data)
         # return Response(new_images, status=status.HTTP_201_CREATED)
 
+    # Custom action, that creates many ads from a CSV or JSON Lines inventory feed
+    @action(detail=False, methods=['post'])
+    def bulk_import(self, request):
+        rows, error_response = self._read_feed(request)
+        if error_response:
+            return error_response
+
+        created, errors = import_ads(request.user, rows, max_rows=MAX_IMPORT_ROWS, geocode=False)
+        if created:
+            self._geocode_later(request.user)
+        return Response({'created': created, 'errors': errors},
+                        status=status.HTTP_201_CREATED if created else status.HTTP_400_BAD_REQUEST)
+
+    # Custom action, that syncs dealer ads with a full inventory feed, only changes are written
+    @action(detail=False, methods=['post'])
+    def sync_feed(self, request):
+        rows, error_response = self._read_feed(request)
+        if error_response:
+            return error_response
+
+        result = sync_ads(request.user, rows, max_rows=MAX_IMPORT_ROWS, geocode=False)
+        if result['created'] or result['updated']:
+            self._geocode_later(request.user)
+        return Response(result, status=status.HTTP_200_OK)
+
+    @staticmethod
+    def _geocode_later(user):
+        # Up to MAX_IMPORT_ROWS locations are too many for nominatim within one request,
+        # ads are saved right away and geocoded by celery (or later by backfill_locations)
+        try:
+            geocode_imported_ads.delay(user.id)
+        except Exception as e:
+            logger.error(f'Error sending geocoding task for user id={user.id}: {e}')
+
+    @staticmethod
+    def _read_feed(request):
+        # Rows of the uploaded feed, format from feed_format param or file extension
+        feed = request.FILES.get('file')
+        if not feed:
+            return None, Response({'detail': 'No file provided'}, status=status.HTTP_400_BAD_REQUEST)
+
+        feed_format = request.data.get('feed_format') or feed.name.rsplit('.', 1)[-1].lower()
+        if feed_format == 'ndjson':
+            feed_format = 'jsonl'
+        if feed_format not in IMPORT_FORMATS:
+            return None, Response({'detail': 'Unsupported feed format, use csv or jsonl.'}, status=status.HTTP_400_BAD_REQUEST)
+        return read_feed(feed, feed_format), None
+
     # Custom action for delete a specific image
     @action(detail=True, methods=['delete'])
     def remove_image(self, request, pk=None):
@@ -251,3 +368,69 @@ class FavouriteViewSet(viewsets.ViewSet):
         favourite = get_object_or_404(Favourite, ad=ad, user=request.user)
         favourite.delete()
         return Response({'detail': 'Ad removed from favourites'}, status=status.HTTP_204_NO_CONTENT)
+
+
+class AdRegionStatsView(APIView):
+    """
+    Admin API endpoint for regional ad stats.
+    Served from the AdRegionStats rollup, so cost depends on number of regions, not ads.
+    GET params: level (country/state/city), country_code, state, city,
+    brand (id, "all" for every brand, omitted for totals of all brands)
+    """
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        level = request.query_params.get('level', AdRegionStats.LEVEL_COUNTRY)
+        if level not in dict(AdRegionStats.LEVELS):
+            return Response({'detail': 'Invalid level.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        queryset = AdRegionStats.objects.filter(
+            level=level).select_related('brand')
+
+        country_code = request.query_params.get('country_code')
+        if country_code:
+            queryset = queryset.filter(country_code=country_code.upper())
+
+        for field in ('state', 'city'):
+            value = request.query_params.get(field)
+            if value:
+                queryset = queryset.filter(**{field: value})
+
+        brand = request.query_params.get('brand')
+        if not brand:
+            queryset = queryset.filter(brand__isnull=True)
+        elif brand == 'all':
+            queryset = queryset.filter(brand__isnull=False)
+        elif brand.isdigit():
+            queryset = queryset.filter(brand_id=brand)
+        else:
+            return Response({'detail': 'Invalid brand.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        serializer = AdRegionStatsSerializer(queryset, many=True)
+        return Response({'level': level, 'results': serializer.data}, status=status.HTTP_200_OK)
+
+
+class AdExportView(APIView):
+    """
+    Admin API endpoint streaming all ads matching AdFilter params as CSV or JSON Lines.
+    Rows are read in chunks and written as they are produced, memory stays constant.
+    GET params: output (csv/jsonl), AdFilter params
+    """
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        export_format = request.query_params.get('output', 'csv')
+        if export_format not in EXPORT_FORMATS:
+            return Response({'detail': 'Invalid output.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        queryset, errors = filter_ads(request.query_params)
+        if errors:
+            return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+
+        content_type = 'text/csv' if export_format == 'csv' else 'application/x-ndjson'
+        # ASGI servers need an async iterator to stream, WSGI ones a sync one
+        lines = aexport_lines if isinstance(request._request, ASGIRequest) else export_lines
+        response = StreamingHttpResponse(
+            lines(queryset, export_format), content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="ads.{export_format}"'
+        return response
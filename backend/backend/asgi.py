@@ -9,6 +9,19 @@ django_asgi_app = get_asgi_application()
 
 from chat.routing import websocket_urlpatterns
 from chat.middleware import JWTMiddleware
+from ads.location_service import LocationService
+
+
+async def lifespan(scope, receive, send):
+    # Pooled http clients are closed when the server shuts down
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await LocationService.aclose_client()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
 
 application = ProtocolTypeRouter({
     'http': django_asgi_app,
@@ -20,4 +33,6 @@ application = ProtocolTypeRouter({
             )
         )
     ),
+
+    'lifespan': lifespan,
 })
@@ -2,6 +2,7 @@ from pathlib import Path
 import os
 from dotenv import load_dotenv
 from datetime import timedelta
+from celery.schedules import crontab
 load_dotenv()
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -45,6 +46,20 @@ CHANNEL_LAYERS = {
     }
 }
 
+# Ephemeral chat state (presence, websocket user snapshots),
+# kept in redis with TTL and shared by all processes
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'chat': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': 'redis://redis:6379/1' if os.getenv('DOCKER_ENV') else 'redis://127.0.0.1:6379/1',
+        # Cached state is optional, redis outage behaves like a cache miss
+        'OPTIONS': {'IGNORE_EXCEPTIONS': True},
+    },
+}
+
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
@@ -196,6 +211,30 @@ MEDIA_ROOT = 'static/images'
 
 CORS_ALLOW_ALL_ORIGINS = True
 
+# Location service
+# Reverse geocoding cache grid in degrees (0.001 is about 100 m)
+LOCATION_REVERSE_GRID_SIZE = float(
+    os.getenv('LOCATION_REVERSE_GRID_SIZE', 0.001))
+# Failed or empty lookups are cached for a short time only
+LOCATION_NEGATIVE_CACHE_TIMEOUT = 300
+
+# Chat
+# Write-behind mode group commits messages of all connections in batches, a message
+# is broadcast once its batch is committed
+CHAT_WRITE_BEHIND = os.getenv('CHAT_WRITE_BEHIND', '') == 'True'
+# Seconds between batch inserts and maximum messages per insert
+CHAT_WRITE_BEHIND_INTERVAL = float(
+    os.getenv('CHAT_WRITE_BEHIND_INTERVAL', 0.05))
+CHAT_WRITE_BEHIND_BATCH_SIZE = 500
+# Failed batch inserts before waiting writers get the error, and maximum waiting messages
+CHAT_WRITE_BEHIND_MAX_RETRIES = 3
+CHAT_WRITE_BEHIND_MAX_PENDING = 5000
+# Messages older than this are moved to compressed monthly archive blocks
+CHAT_ARCHIVE_AFTER_DAYS = int(os.getenv('CHAT_ARCHIVE_AFTER_DAYS', 180))
+# Threads running websocket database and cache calls in parallel,
+# 0 keeps the single shared thread of database_sync_to_async
+CHAT_DB_THREADS = int(os.getenv('CHAT_DB_THREADS', 0))
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
@@ -220,6 +259,35 @@ CELERY_TIMEZONE = 'UTC'
 CELERY_TASK_ROUTES = {
     'ads.tasks.process_image_watermark': {'queue': 'celery'},
     'ads.tasks.bulk_process_images': {'queue': 'celery'},
+    'ads.tasks.refresh_region_stats': {'queue': 'celery'},
+    'ads.tasks.geocode_imported_ads': {'queue': 'celery'},
+    'chat.tasks.reconcile_unread_counters': {'queue': 'celery'},
+    'chat.tasks.archive_old_messages': {'queue': 'celery'},
+}
+
+# Periodic tasks for celery beat
+CELERY_BEAT_SCHEDULE = {
+    # Refresh regions with changed ads
+    'refresh-region-stats': {
+        'task': 'ads.tasks.refresh_region_stats',
+        'schedule': timedelta(minutes=5),
+    },
+    # Full rebuild once a day catches changes made without signals (bulk updates)
+    'rebuild-region-stats': {
+        'task': 'ads.tasks.refresh_region_stats',
+        'schedule': crontab(hour=3, minute=0),
+        'kwargs': {'full': True},
+    },
+    # Repair drift of per-user unread counters
+    'reconcile-unread-counters': {
+        'task': 'chat.tasks.reconcile_unread_counters',
+        'schedule': timedelta(hours=1),
+    },
+    # Move old messages out of the hot message table, in limited batches of chats
+    'archive-old-messages': {
+        'task': 'chat.tasks.archive_old_messages',
+        'schedule': timedelta(hours=1),
+    },
 }
 
 # Soft time limit in seconds. If task runs linger it will raise a softtimelimiexceeded exceptionsa
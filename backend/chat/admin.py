@@ -1,6 +1,9 @@
 from django.contrib import admin
-from .models import Chat, Message
+from .models import Chat, Message, UnreadCounter, ArchivedMessageBlock, ChatReadState
 
 # Register your models here.
 admin.site.register(Chat)
-admin.site.register(Message)
\ No newline at end of file
+admin.site.register(Message)
+admin.site.register(UnreadCounter)
+admin.site.register(ArchivedMessageBlock)
+admin.site.register(ChatReadState)
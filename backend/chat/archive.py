@@ -0,0 +1,179 @@
+import json
+import zlib
+from collections import Counter
+from datetime import timedelta
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from .models import ArchivedMessageBlock, Chat, Message
+from .utils import add_unread, get_read_watermarks, recipient_id
+
+User = get_user_model()
+
+# Fields kept for every archived message
+ARCHIVE_FIELDS = ['id', 'sender_id', 'content', 'uuid', 'created_at']
+
+
+def encode_rows(rows):
+    return zlib.compress(json.dumps(rows, separators=(',', ':')).encode())
+
+
+def decode_rows(data):
+    return json.loads(zlib.decompress(bytes(data)))
+
+
+def format_timestamp(value):
+    # Fixed width UTC format, so stored timestamps compare correctly as strings
+    return value.astimezone(timezone.utc).isoformat(timespec='microseconds')
+
+
+def row_key(row):
+    # Same order as the hot table: created_at, then id (timestamps are stored in UTC)
+    return row['created_at'], row['id']
+
+
+def month_start(value):
+    # First moment of the UTC month of value
+    return value.astimezone(timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def archive_chat(chat, cutoff):
+    """
+    Move messages of one chat older than cutoff into monthly blocks.
+    Months are archived oldest first, each in its own transaction, so only one month
+    of messages is held in memory at a time.
+    Unread messages are archived as read and removed from the recipient counter.
+    Returns number of archived messages.
+    """
+    archived = 0
+    while True:
+        oldest = (Message.objects.filter(chat=chat, created_at__lt=cutoff)
+                  .order_by('created_at').values_list('created_at', flat=True).first())
+        if oldest is None:
+            return archived
+
+        period = month_start(oldest)
+        next_period = (period + timedelta(days=32)).replace(day=1)
+        archived += _archive_period(chat, period.date(), min(next_period, cutoff))
+
+
+def _archive_period(chat, period, end):
+    # Nothing older than the period is left in the hot table, so the upper bound selects its messages
+    with transaction.atomic():
+        messages = list(Message.objects.filter(chat=chat, created_at__lt=end)
+                        .order_by('created_at', 'id').values(*ARCHIVE_FIELDS))
+        if not messages:
+            return 0
+
+        rows = []
+        unread = Counter()
+        watermarks = get_read_watermarks(chat)
+        for message in messages:
+            if (message['created_at'], message['id']) > watermarks[message['sender_id']]:
+                unread[recipient_id(chat, message['sender_id'])] += 1
+            rows.append({
+                **message,
+                'is_read': True,
+                'uuid': str(message['uuid']),
+                'created_at': format_timestamp(message['created_at']),
+            })
+
+        block = (ArchivedMessageBlock.objects.select_for_update().filter(chat=chat, period=period).first()
+                 or ArchivedMessageBlock(chat=chat, period=period))
+        if block.pk:
+            rows = sorted(decode_rows(block.data) + rows, key=row_key)
+
+        block.data = encode_rows(rows)
+        block.message_count = len(rows)
+        block.min_message_id = min(row['id'] for row in rows)
+        block.max_message_id = max(row['id'] for row in rows)
+        block.first_created_at = parse_datetime(rows[0]['created_at'])
+        block.last_created_at = parse_datetime(rows[-1]['created_at'])
+        block.save()
+
+        Message.objects.filter(
+            chat=chat, id__lte=max(message['id'] for message in messages), created_at__lt=end).delete()
+        for user_id, count in unread.items():
+            add_unread(user_id, -count)
+
+    return len(messages)
+
+
+def archive_old_messages(max_chats=500):
+    """
+    Archive messages older than CHAT_ARCHIVE_AFTER_DAYS, at most max_chats chats per call,
+    so one run stays within the task time limit. Returns (chats, messages) archived.
+    Chats of sold or deleted ads are not archived separately: ads have no sold state,
+    and deleting an ad deletes its chats.
+    """
+    cutoff = timezone.now() - timedelta(days=settings.CHAT_ARCHIVE_AFTER_DAYS)
+    chat_ids = list(Message.objects.filter(created_at__lt=cutoff)
+                    .order_by().values_list('chat_id', flat=True).distinct()[:max_chats])
+
+    archived = 0
+    for chat in Chat.objects.filter(id__in=chat_ids):
+        archived += archive_chat(chat, cutoff)
+    return len(chat_ids), archived
+
+
+def purge_archived_user(user_id):
+    """
+    Delete archived blocks of every chat of the user, called before the user is deleted.
+    Only participants send messages, so this removes all archived messages of the user.
+    """
+    return ArchivedMessageBlock.objects.filter(
+        Q(chat__buyer_id=user_id) | Q(chat__seller_id=user_id)).delete()[0]
+
+
+def _to_messages(chat, rows):
+    # Unsaved Message instances, so archived pages serialize like hot ones.
+    # Rows of missing senders are skipped, in case a user was removed without signals
+    senders = User.objects.in_bulk({row['sender_id'] for row in rows})
+    messages = []
+    for row in rows:
+        if row['sender_id'] in senders:
+            message = Message(id=row['id'], chat=chat, sender=senders[row['sender_id']], content=row['content'],
+                              uuid=row['uuid'], created_at=parse_datetime(row['created_at']))
+            message.archived = True
+            messages.append(message)
+    return messages
+
+
+def find_archived_cursor(chat, message_id):
+    # (created_at, id) of an archived message, None if it is not in the archive
+    blocks = ArchivedMessageBlock.objects.filter(
+        chat=chat, min_message_id__lte=message_id, max_message_id__gte=message_id)
+    for block in blocks:
+        for row in decode_rows(block.data):
+            if row['id'] == message_id:
+                return parse_datetime(row['created_at']), message_id
+    return None
+
+
+def archived_messages(chat, cursor=None, limit=50, newer=False):
+    """
+    Archived messages next to the cursor, nearest first.
+    Older ones by default, newer ones with newer=True. Without cursor starts from the newest (oldest) end.
+    Blocks are decompressed one by one, only until the limit is reached.
+    """
+    blocks = ArchivedMessageBlock.objects.filter(chat=chat)
+    if cursor and newer:
+        blocks = blocks.filter(last_created_at__gte=cursor[0])
+    elif cursor:
+        blocks = blocks.filter(first_created_at__lte=cursor[0])
+
+    rows = []
+    for block in blocks.order_by('period' if newer else '-period').iterator():
+        block_rows = decode_rows(block.data)
+        if cursor:
+            key = (format_timestamp(cursor[0]), cursor[1])
+            block_rows = [row for row in block_rows if (
+                row_key(row) > key if newer else row_key(row) < key)]
+        rows += block_rows if newer else block_rows[::-1]
+        if len(rows) >= limit:
+            break
+
+    return _to_messages(chat, rows[:limit])
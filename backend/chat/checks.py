@@ -0,0 +1,18 @@
+from django.core.checks import Error, Tags, register
+from .search import missing_search_triggers
+
+
+@register(Tags.database)
+def search_triggers_check(app_configs, databases=None, **kwargs):
+    # Database checks only run when databases are given, e.g. by migrate and check --database
+    errors = []
+    for alias in databases or []:
+        missing = missing_search_triggers(alias)
+        if missing:
+            errors.append(Error(
+                f'Message search triggers are missing: {", ".join(missing)}',
+                hint='A migration remade chat_message and dropped them, '
+                     'add a migration creating them again like chat 0007_message_search_index.',
+                id='chat.E001',
+            ))
+    return errors
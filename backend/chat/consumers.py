@@ -1,15 +1,244 @@
+import time
+from urllib.parse import parse_qs
+import msgpack
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
-from channels.db import database_sync_to_async
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.db.models import Q
 from .models import Chat, Message
+from .utils import create_message, mark_chat_as_read, get_unread_total, get_read_watermarks, is_message_read
+from .pagination import paginate_messages
+from .write_behind import message_writer
+from .db import chat_db, run_db
+from .presence import TYPING_INTERVAL, set_online, refresh_online, set_offline, get_online, get_online_many
+from .events import chat_group_name, user_group_name, new_message_events, read_events, notify_inbox
 
 User = get_user_model()
 
+# Subprotocol for MessagePack frames with compact message shape
+MSGPACK_SUBPROTOCOL = 'chat.msgpack'
 
-class ChatConsumer(AsyncJsonWebsocketConsumer):
+
+class AuthSubprotocolMixin:
+    async def accept(self, subprotocol=None, headers=None):
+        # Echo the subprotocol that carried the token (see JWTMiddleware)
+        await super().accept(subprotocol or self.scope.get('auth_subprotocol'), headers)
+
+
+class MsgpackProtocolMixin:
+    """
+    Opt-in binary protocol: clients request the 'chat.msgpack' subprotocol
+    and exchange MessagePack frames instead of JSON text.
+    Messages carry sender_id only, the sender profile is sent once per connection in a 'profile' frame.
+    """
+
+    @property
+    def use_msgpack(self):
+        return MSGPACK_SUBPROTOCOL in self.scope.get('subprotocols', [])
+
+    async def accept(self, subprotocol=None, headers=None):
+        # Profiles already sent on this connection
+        self.sent_profiles = set()
+        if self.use_msgpack:
+            subprotocol = MSGPACK_SUBPROTOCOL
+        await super().accept(subprotocol, headers)
+
+    async def receive(self, text_data=None, bytes_data=None, **kwargs):
+        if not (self.use_msgpack and bytes_data):
+            await super().receive(text_data, bytes_data, **kwargs)
+            return
+
+        try:
+            # Clients naturally key maps like last_ids by integer chat id
+            content = msgpack.unpackb(bytes_data, strict_map_key=False)
+        except ValueError:
+            content = None
+        if not isinstance(content, dict):
+            await self.send_json({'type': 'error', 'message': 'Invalid frame'})
+            return
+        await self.receive_json(content, **kwargs)
+
+    async def send_json(self, content, close=False):
+        if not self.use_msgpack:
+            await super().send_json(content, close)
+            return
+
+        if content.get('type') == 'chat_message':
+            content = await self.compact_message(content)
+        await self.send(bytes_data=msgpack.packb(content), close=close)
+
+    async def compact_message(self, content):
+        message = dict(content['message'])
+        sender = message.pop('sender')
+        if sender['id'] not in self.sent_profiles:
+            self.sent_profiles.add(sender['id'])
+            await self.send(bytes_data=msgpack.packb({'type': 'profile', 'user': sender}))
+        return {**content, 'message': {**message, 'sender_id': sender['id']}}
+
+
+def parse_last_id(value):
+    # Positive message id sent by the client, None if missing or invalid
+    try:
+        last_id = int(value)
+    except (TypeError, ValueError):
+        return None
+    return last_id if last_id > 0 else None
+
+
+class ChatActionsMixin:
+    """
+    Message sending, read receipts, replay and presence shared by single chat and multiplexed consumers.
+    Group events carry chat_id, so one socket can tell its chats apart.
+    """
+    # Longer gaps are not replayed, the client reloads the chat via REST instead
+    REPLAY_LIMIT = 200
+
+    async def send_chat_message(self, chat, text):
+        text = (text or '').strip()
+        if not text:
+            await self.send_json({'type': 'error', 'message': 'Message cannot be empty'})
+            return
+
+        message = await self.save_message(chat, text)
+
+        await self.channel_layer.group_send(
+            chat_group_name(chat.id),
+            {
+                'type': 'chat_message',
+                'chat_id': chat.id,
+                'message': self.message_payload(message, self.get_sender_payload(), False)
+            }
+        )
+        await notify_inbox(new_message_events(chat, message))
+
+    async def replay_messages(self, chat, last_id):
+        """
+        Send messages newer than last_id, the last one the client has seen,
+        so a reconnect after a network blip doesn't reload the whole chat.
+        Live messages may overlap with the replay, clients skip ids they already have.
+        """
+        await self.flush_messages()
+        missed = await self.get_missed_messages(chat, last_id)
+        if missed is None:
+            # Unknown message, the client has to reload the chat
+            await self.send_json({'type': 'replay_done', 'chat_id': chat.id, 'count': 0, 'reset': True})
+            return
+
+        messages, has_more = missed
+        for message in messages:
+            await self.chat_message({'chat_id': chat.id, 'message': message})
+        await self.send_json({
+            'type': 'replay_done',
+            'chat_id': chat.id,
+            'count': len(messages),
+            'reset': has_more
+        })
+
+    @chat_db
+    def get_missed_messages(self, chat, last_id):
+        page = paginate_messages(chat, after_id=last_id, page_size=self.REPLAY_LIMIT)
+        if page is None:
+            return None
+        messages, has_more = page
+        watermarks = get_read_watermarks(chat)
+        return [
+            self.message_payload(message, self.get_user_payload(message.sender),
+                                 getattr(message, 'archived', False) or is_message_read(message, watermarks))
+            for message in messages
+        ], has_more
+
+    @staticmethod
+    def message_payload(message, sender, is_read):
+        return {
+            'id': message.id,
+            'uuid': str(message.uuid),
+            'content': message.content,
+            'sender': sender,
+            'is_read': is_read,
+            'created_at': message.created_at.isoformat()
+        }
+
+    async def send_mark_read(self, chat):
+        await self.flush_messages()
+        updated = await self.mark_messages_as_read(chat)
+        if updated:
+            await notify_inbox(read_events(chat, self.user.id, updated))
+        await self.channel_layer.group_send(
+            chat_group_name(chat.id),
+            {
+                'type': 'mark_read',   # must match method name below
+                'chat_id': chat.id,
+                'user_id': self.user.id
+            }
+        )
+
+    async def join_presence(self, chat):
+        # Participants are notified only about the first connection of the user
+        if await set_online(chat.id, self.user.id):
+            await self.broadcast_presence(chat, True)
+
+    async def refresh_presence(self, chat):
+        if await refresh_online(chat.id, self.user.id):
+            await self.broadcast_presence(chat, True)
+
+    async def leave_presence(self, chat):
+        # User stays online while other connections to the chat are open
+        if await set_offline(chat.id, self.user.id):
+            await self.broadcast_presence(chat, False)
+
+    async def broadcast_presence(self, chat, online):
+        await self.channel_layer.group_send(chat_group_name(chat.id), {
+            'type': 'presence',
+            'chat_id': chat.id,
+            'user_id': self.user.id,
+            'online': online
+        })
+
+    def get_sender_payload(self):
+        # Built once per connection, sender profile doesn't change between messages
+        if not hasattr(self, '_sender_payload'):
+            self._sender_payload = self.get_user_payload(self.user)
+        return self._sender_payload
+
+    def get_user_payload(self, user):
+        profile_image_url = None
+        if user.profile_image:
+            headers = dict(self.scope.get('headers', []))
+            host = headers.get(b'host', b'localhost').decode('utf-8')
+            scheme = self.scope.get('scheme', 'ws')
+            http_scheme = 'https' if scheme == 'wss' else 'http'
+            profile_image_url = f'{http_scheme}://{host}{user.profile_image.url}'
+
+        return {
+            'id': user.id,
+            'first_name': user.first_name,
+            'last_name': user.last_name,
+            'email': user.email,
+            'profile_image': profile_image_url,
+        }
+
+    async def save_message(self, chat, content):
+        # Chat is loaded on connect, only its updated_at is bumped on insert
+        if settings.CHAT_WRITE_BEHIND:
+            # Waits for the batch commit, so the broadcast message has its id
+            message = Message(chat=chat, sender=self.user, content=content)
+            return await message_writer.write(message)
+        return await run_db(create_message, chat, self.user, content)
+
+    async def flush_messages(self):
+        # Pending messages of write-behind mode are persisted before reads and on disconnect
+        if settings.CHAT_WRITE_BEHIND:
+            await message_writer.flush()
+
+    @chat_db
+    def mark_messages_as_read(self, chat):
+        return mark_chat_as_read(chat.id, self.user)
+
+
+class ChatConsumer(ChatActionsMixin, MsgpackProtocolMixin, AuthSubprotocolMixin, AsyncJsonWebsocketConsumer):
     async def connect(self):
         self.chat_id = self.scope['url_route']['kwargs']['chat_id']
-        self.chat_group_name = f'chat_{self.chat_id}'
+        self.chat_group_name = chat_group_name(self.chat_id)
         self.user = self.scope['user']
 
         if not self.user.is_authenticated:
@@ -22,12 +251,26 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
 
         await self.channel_layer.group_add(self.chat_group_name, self.channel_name)
         await self.accept()
+        self.get_sender_payload()
+        self.typing_state = (False, 0)
+        # Snapshot is taken before this connection is counted
+        online_users = await get_online(self.chat.id, [self.chat.buyer_id, self.chat.seller_id])
+        await self.join_presence(self.chat)
         await self.send_json({
             'type': 'connection_established',
-            'message': 'Connected to chat'
+            'message': 'Connected to chat',
+            'online_users': online_users
         })
+        # Reconnecting clients pass the last message they have seen: ?last_id=<id>
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        last_id = parse_last_id(query.get('last_id', [None])[0])
+        if last_id:
+            await self.replay_messages(self.chat, last_id)
 
     async def disconnect(self, close_code):
+        await self.flush_messages()
+        if hasattr(self, 'typing_state'):
+            await self.leave_presence(self.chat)
         await self.channel_layer.group_discard(self.chat_group_name, self.channel_name)
 
     async def receive_json(self, content):
@@ -35,50 +278,23 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
             message_type = content.get('type', 'chat_message')
 
             if message_type == 'chat_message':
-                text = content.get('message', '').strip()
-                if not text:
-                    await self.send_json({'type': 'error', 'message': 'Message cannot be empty'})
-                    return
-
-                message = await self.save_message(text)
-
-                profile_image_url = None
-                if message.sender.profile_image:
-                    headers = dict(self.scope.get('headers', []))
-                    host = headers.get(b'host', b'localhost').decode('utf-8')
-                    scheme = self.scope.get('scheme', 'ws')
-                    http_scheme = 'https' if scheme == 'wss' else 'http'
-                    profile_image_url = f'{http_scheme}://{host}{message.sender.profile_image.url}'
-
-                await self.channel_layer.group_send(
-                    self.chat_group_name,
-                    {
-                        'type': 'chat_message',
-                        'message': {
-                            'id': message.id,
-                            'content': message.content,
-                            'sender': {
-                                'id': message.sender.id,
-                                'first_name': message.sender.first_name,
-                                'last_name': message.sender.last_name,
-                                'email': message.sender.email,
-                                'profile_image': profile_image_url,
-                            },
-                            'is_read': message.is_read,
-                            'created_at': message.created_at.isoformat()
-                        }
-                    }
-                )
+                await self.send_chat_message(self.chat, content.get('message'))
 
             elif message_type == 'mark_read':
-                await self.mark_messages_as_read()
-                await self.channel_layer.group_send(
-                    self.chat_group_name,
-                    {
-                        'type': 'mark_read',   # must match method name below
-                        'user_id': self.user.id
-                    }
-                )
+                await self.send_mark_read(self.chat)
+
+            elif message_type == 'heartbeat':
+                await self.refresh_presence(self.chat)
+
+            elif message_type == 'typing':
+                await self.send_typing(bool(content.get('is_typing', True)))
+
+            elif message_type == 'replay':
+                last_id = parse_last_id(content.get('last_id'))
+                if last_id is None:
+                    await self.send_json({'type': 'error', 'message': 'Invalid last_id'})
+                else:
+                    await self.replay_messages(self.chat, last_id)
 
         except Exception as e:
             await self.send_json({'type': 'error', 'message': str(e)})
@@ -96,23 +312,223 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
             'user_id': event['user_id']
         })
 
-    @database_sync_to_async
+    async def presence(self, event):
+        if event['user_id'] != self.user.id:
+            await self.send_json({
+                'type': 'presence',
+                'user_id': event['user_id'],
+                'online': event['online']
+            })
+
+    async def typing(self, event):
+        if event['user_id'] != self.user.id:
+            await self.send_json({
+                'type': 'typing',
+                'user_id': event['user_id'],
+                'is_typing': event['is_typing']
+            })
+
+    async def send_typing(self, is_typing):
+        # Repeated typing events are coalesced, state changes are always sent
+        last_state, last_sent = self.typing_state
+        now = time.monotonic()
+        if is_typing == last_state and now - last_sent < TYPING_INTERVAL:
+            return
+
+        self.typing_state = (is_typing, now)
+        await self.channel_layer.group_send(self.chat_group_name, {
+            'type': 'typing',
+            'chat_id': self.chat.id,
+            'user_id': self.user.id,
+            'is_typing': is_typing
+        })
+
+    @chat_db
     def is_chat_participant(self):
         try:
-            chat = Chat.objects.get(id=self.chat_id)
-            return self.user == chat.buyer or self.user == chat.seller
+            self.chat = Chat.objects.get(id=self.chat_id)
+            return self.user.id in (self.chat.buyer_id, self.chat.seller_id)
         except Chat.DoesNotExist:
             return False
 
-    @database_sync_to_async
-    def save_message(self, content):
-        chat = Chat.objects.get(id=self.chat_id)
-        message = Message.objects.create(
-            chat=chat, sender=self.user, content=content)
-        chat.save()
-        return message
-
-    @database_sync_to_async
-    def mark_messages_as_read(self):
-        Message.objects.filter(chat_id=self.chat_id, is_read=False).exclude(
-            sender=self.user).update(is_read=True)
+
+class MultiChatConsumer(ChatActionsMixin, MsgpackProtocolMixin, AuthSubprotocolMixin, AsyncJsonWebsocketConsumer):
+    """
+    One socket for many chats. Client subscribes and unsubscribes chat ids,
+    participation of a whole batch is checked with a single query.
+    """
+    MAX_SUBSCRIPTIONS = 100
+
+    async def connect(self):
+        self.user = self.scope['user']
+        # Subscribed chats by id
+        self.chats = {}
+
+        if not self.user.is_authenticated:
+            await self.close()
+            return
+
+        await self.accept()
+        self.get_sender_payload()
+        await self.send_json({
+            'type': 'connection_established',
+            'message': 'Connected to chats'
+        })
+
+    async def disconnect(self, close_code):
+        await self.flush_messages()
+        for chat_id, chat in list(getattr(self, 'chats', {}).items()):
+            await self.leave_presence(chat)
+            await self.channel_layer.group_discard(chat_group_name(chat_id), self.channel_name)
+
+    async def receive_json(self, content):
+        try:
+            message_type = content.get('type')
+
+            if message_type == 'subscribe':
+                await self.subscribe(content.get('chat_ids', []), content.get('last_ids'))
+
+            elif message_type == 'unsubscribe':
+                await self.unsubscribe(content.get('chat_ids', []))
+
+            elif message_type == 'heartbeat':
+                for chat in list(self.chats.values()):
+                    await self.refresh_presence(chat)
+
+            elif message_type in ('chat_message', 'mark_read', 'replay'):
+                chat_ids = self.parse_chat_ids([content.get('chat_id')])
+                chat = self.chats.get(chat_ids[0]) if chat_ids else None
+                if chat is None:
+                    await self.send_json({'type': 'error', 'message': 'Not subscribed to this chat'})
+                elif message_type == 'chat_message':
+                    await self.send_chat_message(chat, content.get('message'))
+                elif message_type == 'mark_read':
+                    await self.send_mark_read(chat)
+                elif parse_last_id(content.get('last_id')) is None:
+                    await self.send_json({'type': 'error', 'message': 'Invalid last_id'})
+                else:
+                    await self.replay_messages(chat, parse_last_id(content.get('last_id')))
+
+            else:
+                await self.send_json({'type': 'error', 'message': 'Unknown message type'})
+
+        except Exception as e:
+            await self.send_json({'type': 'error', 'message': str(e)})
+
+    async def subscribe(self, chat_ids, last_ids=None):
+        """
+        Join groups of the requested chats.
+        last_ids maps chat id to the last message seen by the client, missed messages are replayed.
+        """
+        requested = self.parse_chat_ids(chat_ids)
+        new_ids = [chat_id for chat_id in requested if chat_id not in self.chats]
+        new_ids = new_ids[:max(0, self.MAX_SUBSCRIPTIONS - len(self.chats))]
+
+        allowed = await self.get_participant_chats(new_ids)
+        for chat_id, chat in allowed.items():
+            await self.channel_layer.group_add(chat_group_name(chat_id), self.channel_name)
+        self.chats.update(allowed)
+        online = await get_online_many(
+            {chat_id: [chat.buyer_id, chat.seller_id] for chat_id, chat in allowed.items()})
+        for chat in allowed.values():
+            await self.join_presence(chat)
+
+        await self.send_json({
+            'type': 'subscribed',
+            'chat_ids': [chat_id for chat_id in requested if chat_id in self.chats],
+            'rejected': [chat_id for chat_id in requested if chat_id not in self.chats],
+            # Present participants of newly subscribed chats
+            'online_users': {str(chat_id): user_ids for chat_id, user_ids in online.items()},
+        })
+
+        for chat_id, last_id in (last_ids if isinstance(last_ids, dict) else {}).items():
+            chat_ids = self.parse_chat_ids([chat_id])
+            last_id = parse_last_id(last_id)
+            if chat_ids and chat_ids[0] in allowed and last_id:
+                await self.replay_messages(allowed[chat_ids[0]], last_id)
+
+    async def unsubscribe(self, chat_ids):
+        removed = []
+        for chat_id in self.parse_chat_ids(chat_ids):
+            chat = self.chats.pop(chat_id, None)
+            if chat is not None:
+                await self.leave_presence(chat)
+                await self.channel_layer.group_discard(chat_group_name(chat_id), self.channel_name)
+                removed.append(chat_id)
+
+        await self.send_json({'type': 'unsubscribed', 'chat_ids': removed})
+
+    @staticmethod
+    def parse_chat_ids(chat_ids):
+        # Unique integer ids in request order, invalid values are dropped
+        parsed = []
+        for chat_id in chat_ids if isinstance(chat_ids, list) else []:
+            try:
+                chat_id = int(chat_id)
+            except (TypeError, ValueError):
+                continue
+            if chat_id not in parsed:
+                parsed.append(chat_id)
+        return parsed
+
+    async def chat_message(self, event):
+        await self.send_json({
+            'type': 'chat_message',
+            'chat_id': event['chat_id'],
+            'message': event['message']
+        })
+
+    async def mark_read(self, event):
+        await self.send_json({
+            'type': 'mark_read',
+            'chat_id': event['chat_id'],
+            'user_id': event['user_id']
+        })
+
+    async def presence(self, event):
+        # Typing comes from single chat sockets only, presence from both kinds
+        if event['user_id'] != self.user.id:
+            await self.send_json(event)
+
+    async def typing(self, event):
+        if event['user_id'] != self.user.id:
+            await self.send_json(event)
+
+    @chat_db
+    def get_participant_chats(self, chat_ids):
+        if not chat_ids:
+            return {}
+        chats = Chat.objects.filter(Q(buyer=self.user) | Q(seller=self.user), id__in=chat_ids)
+        return {chat.id: chat for chat in chats}
+
+
+class InboxConsumer(AuthSubprotocolMixin, AsyncJsonWebsocketConsumer):
+    """
+    Per-user stream of compact events from all user chats,
+    so the chat list can be updated without polling
+    """
+
+    async def connect(self):
+        self.user = self.scope['user']
+
+        if not self.user.is_authenticated:
+            await self.close()
+            return
+
+        self.user_group_name = user_group_name(self.user.id)
+        await self.channel_layer.group_add(self.user_group_name, self.channel_name)
+        await self.accept()
+        await self.send_json({
+            'type': 'connection_established',
+            'unread_count': await run_db(get_unread_total, self.user.id)
+        })
+
+    async def disconnect(self, close_code):
+        if hasattr(self, 'user_group_name'):
+            await self.channel_layer.group_discard(self.user_group_name, self.channel_name)
+
+    async def inbox_message(self, event):
+        await self.send_json(event)
+
+    async def inbox_read(self, event):
+        await self.send_json(event)
@@ -0,0 +1,40 @@
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from channels.db import database_sync_to_async
+from django.conf import settings
+
+# Pools by size, so overriding CHAT_DB_THREADS (tests, load test) gets a matching pool
+_executors = {}
+
+
+def get_executor():
+    threads = settings.CHAT_DB_THREADS
+    if not threads:
+        return None
+    if threads not in _executors:
+        _executors[threads] = ThreadPoolExecutor(
+            max_workers=threads, thread_name_prefix='chat-db')
+    return _executors[threads]
+
+
+async def run_db(func, *args, **kwargs):
+    """
+    Run a blocking database or cache call from a consumer.
+    database_sync_to_async (and Django's async ORM and cache methods, which wrap
+    sync_to_async) run every call of the process on one shared thread, so concurrent chats
+    queue behind each other. With CHAT_DB_THREADS set, calls run in parallel on a bounded pool
+    instead, each pool thread keeps its own database connection.
+    Consumer code calls the cache through here too, never through cache.aget and friends.
+    """
+    executor = get_executor()
+    if executor is None:
+        return await database_sync_to_async(func)(*args, **kwargs)
+    return await database_sync_to_async(func, thread_sensitive=False, executor=executor)(*args, **kwargs)
+
+
+def chat_db(func):
+    # Decorator form of run_db, for consumer methods
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run_db(func, *args, **kwargs)
+    return wrapper
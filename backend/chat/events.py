@@ -0,0 +1,68 @@
+import logging
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+
+logger = logging.getLogger(__name__)
+
+# Inbox previews carry only the beginning of the message
+PREVIEW_LENGTH = 100
+
+
+def chat_group_name(chat_id):
+    return f'chat_{chat_id}'
+
+
+def user_group_name(user_id):
+    return f'user_{user_id}'
+
+
+def new_message_events(chat, message):
+    """
+    Inbox events for a new message, as (user_id, event) pairs.
+    Only the recipient gets the unread delta.
+    """
+    preview = {
+        'id': message.id,
+        'content': message.content[:PREVIEW_LENGTH],
+        'sender_id': message.sender_id,
+        'created_at': message.created_at.isoformat(),
+    }
+    return [
+        (user_id, {
+            'type': 'inbox_message',
+            'chat_id': chat.id,
+            'message': preview,
+            'unread_delta': 0 if user_id == message.sender_id else 1,
+        })
+        for user_id in (chat.buyer_id, chat.seller_id)
+    ]
+
+
+def read_events(chat, reader_id, count):
+    """
+    Inbox events for messages marked as read, as (user_id, event) pairs.
+    Reader gets the unread delta, the other participant gets a read receipt.
+    """
+    return [
+        (user_id, {
+            'type': 'inbox_read',
+            'chat_id': chat.id,
+            'reader_id': reader_id,
+            'unread_delta': -count if user_id == reader_id else 0,
+        })
+        for user_id in (chat.buyer_id, chat.seller_id)
+    ]
+
+
+async def notify_inbox(events):
+    channel_layer = get_channel_layer()
+    for user_id, event in events:
+        await channel_layer.group_send(user_group_name(user_id), event)
+
+
+def notify_inbox_sync(events):
+    # Used from REST views, inbox updates are best effort and never fail the request
+    try:
+        async_to_sync(notify_inbox)(events)
+    except Exception as e:
+        logger.error(f'Error sending inbox events: {e}')
@@ -0,0 +1,42 @@
+from decimal import Decimal
+from uuid import uuid4
+from account.models import User
+from ads.models import Ad
+from catalog.models import Brand, ModelCar
+from chat.models import Chat
+
+# Shared by the chat benchmark commands, rows are removed by delete_benchmark_chats
+EMAIL_DOMAIN = 'benchmark.example.com'
+
+
+def create_benchmark_chats(chats, sellers=1):
+    """
+    Create throwaway chats, each with its own buyer,
+    sellers are assigned round robin like dealers with many conversations
+    """
+    seller_users = [User.objects.create(email=f'seller-{i}@{EMAIL_DOMAIN}', username=f'seller-{i}@{EMAIL_DOMAIN}')
+                    for i in range(sellers)]
+    # Unique name, so an existing catalog entry is never reused or deleted afterwards
+    name = f'Benchmark {uuid4().hex[:12]}'
+    brand = Brand.objects.create(name=name)
+    model = ModelCar.objects.create(name=name, brand=brand)
+    ads = [Ad.objects.create(user=seller, title='Benchmark', brand=brand, model=model,
+                             year=2020, mileage=0, price=Decimal('1000.00'))
+           for seller in seller_users]
+
+    created = []
+    for i in range(chats):
+        buyer = User.objects.create(
+            email=f'buyer-{i}@{EMAIL_DOMAIN}', username=f'buyer-{i}@{EMAIL_DOMAIN}')
+        ad = ads[i % sellers]
+        created.append(Chat.objects.create(
+            ad=ad, buyer=buyer, seller=ad.user))
+    return created
+
+
+def delete_benchmark_chats(chats):
+    # Only rows created for the given chats, deleting users cascades to ads, chats, messages and counters
+    user_ids = {chat.buyer_id for chat in chats} | {chat.seller_id for chat in chats}
+    brand_ids = {chat.ad.brand_id for chat in chats}
+    User.objects.filter(pk__in=user_ids).delete()
+    Brand.objects.filter(pk__in=brand_ids).delete()
@@ -0,0 +1,78 @@
+import asyncio
+import time
+from statistics import quantiles
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from django.core.management.base import BaseCommand
+from chat.models import Message
+from chat.management.benchmark import create_benchmark_chats, delete_benchmark_chats
+from chat.utils import create_message
+from chat.write_behind import MessageWriteBehind
+
+
+class Command(BaseCommand):
+    help = ('Compare messages/sec and per message latency of direct inserts and write-behind group commit, '
+            'with one concurrent writer per throwaway chat like consumers of open connections')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=2000,
+                            help='Messages written in each mode')
+        parser.add_argument('--chats', type=int, default=10,
+                            help='Chats the messages are spread across, one concurrent writer per chat')
+
+    def handle(self, *args, **options):
+        total = options['messages']
+
+        # Not wrapped in a transaction, database_sync_to_async closes connections
+        # outside autocommit, so created rows are deleted afterwards instead
+        chats = create_benchmark_chats(options['chats'])
+        try:
+            direct = async_to_sync(self._run)(chats, total, self._direct_writer())
+            batched = async_to_sync(self._run)(chats, total, self._write_behind_writer())
+        finally:
+            delete_benchmark_chats(chats)
+
+        for name, (elapsed, latencies) in (('direct', direct), ('write-behind', batched)):
+            # Percentile cut points need at least two samples
+            cuts = quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+            self.stdout.write(
+                f'{name}: {total} messages in {elapsed:.3f}s, {total / elapsed:.0f} messages/sec, '
+                f'latency ms p50 {cuts[49] * 1000:.1f}, p99 {cuts[98] * 1000:.1f}')
+        self.stdout.write(self.style.SUCCESS(
+            f'write-behind is {direct[0] / batched[0]:.1f}x faster'))
+
+    @staticmethod
+    def _direct_writer():
+        # Current path: one thread pool hop and one insert per message
+        async def write(chat, text):
+            await database_sync_to_async(create_message)(chat, chat.buyer, text)
+        return write
+
+    @staticmethod
+    def _write_behind_writer():
+        # Same path as consumers, each writer waits until its batch is committed.
+        # Own writer instance, so the process-wide buffer is not touched
+        writer = MessageWriteBehind()
+
+        async def write(chat, text):
+            await writer.write(Message(chat=chat, sender=chat.buyer, content=text))
+        return write
+
+    @staticmethod
+    async def _run(chats, total, write):
+        """
+        Concurrent writers, one per chat, each sends its messages one after another.
+        Returns (elapsed seconds, latency of every message).
+        """
+        latencies = []
+
+        async def writer(index):
+            chat = chats[index]
+            for i in range(index, total, len(chats)):
+                started = time.perf_counter()
+                await write(chat, f'Message {i}')
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(writer(index) for index in range(len(chats))))
+        return time.perf_counter() - started, sorted(latencies)
@@ -0,0 +1,182 @@
+import asyncio
+import threading
+import time
+import tracemalloc
+from statistics import quantiles
+from asgiref.sync import async_to_sync
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.test.utils import override_settings
+from chat.management.benchmark import create_benchmark_chats, delete_benchmark_chats
+from chat.routing import websocket_urlpatterns
+
+
+class Command(BaseCommand):
+    help = ('Drive simulated buyers and sellers through ChatConsumer and report '
+            'latency percentiles, DB queries per message and memory per connection')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chats', type=int, default=20,
+                            help='Number of chats, each has its own buyer')
+        parser.add_argument('--sellers', type=int, default=2,
+                            help='Sellers shared across chats, each seller opens one socket per chat')
+        parser.add_argument('--messages', type=int, default=20,
+                            help='Messages sent in every chat, buyer and seller take turns')
+        parser.add_argument('--mark-read-every', type=int, default=5,
+                            help='Recipient sends mark_read after every N messages, 0 disables it')
+        parser.add_argument('--redis', metavar='HOST:PORT',
+                            help='Use redis channel layer and presence cache instead of in-memory ones')
+        parser.add_argument('--write-behind', action='store_true',
+                            help='Enable CHAT_WRITE_BEHIND for the run')
+        parser.add_argument('--db-threads', type=int, default=None,
+                            help='Override CHAT_DB_THREADS, 0 runs database calls on the shared thread')
+        parser.add_argument('--timeout', type=float, default=10,
+                            help='Seconds to wait for each delivery')
+
+    def handle(self, *args, **options):
+        if options['redis']:
+            host, port = options['redis'].split(':')
+            layers = {'default': {'BACKEND': 'channels_redis.core.RedisChannelLayer',
+                                  'CONFIG': {'hosts': [(host, int(port))]}}}
+            chat_cache = {'BACKEND': 'django_redis.cache.RedisCache',
+                          'LOCATION': f'redis://{host}:{port}/1'}
+        else:
+            layers = {'default': {
+                'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+            chat_cache = {
+                'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}
+        caches = {**settings.CACHES, 'chat': chat_cache}
+
+        self.options = options
+        self.db_threads = settings.CHAT_DB_THREADS if options['db_threads'] is None else options['db_threads']
+        # Queries are only counted while traffic is running, not during connect and setup
+        self.counting = False
+        self.queries = 0
+        self.queries_lock = threading.Lock()
+
+        chats = create_benchmark_chats(
+            options['chats'], max(1, min(options['sellers'], options['chats'])))
+        try:
+            with override_settings(CHANNEL_LAYERS=layers, CACHES=caches, CHAT_DB_THREADS=self.db_threads,
+                                   CHAT_WRITE_BEHIND=options['write_behind']):
+                # Connections opened by CHAT_DB_THREADS pool threads are counted too
+                connection_created.connect(self._watch_connection)
+                try:
+                    with connection.execute_wrapper(self._count_query):
+                        stats = async_to_sync(self._run)(chats)
+                finally:
+                    connection_created.disconnect(self._watch_connection)
+        finally:
+            delete_benchmark_chats(chats)
+
+        self._report(stats)
+
+    def _watch_connection(self, sender, connection, **kwargs):
+        if self._count_query not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self._count_query)
+
+    def _count_query(self, execute, sql, params, many, context):
+        if self.counting:
+            with self.queries_lock:
+                self.queries += 1
+        return execute(sql, params, many, context)
+
+    async def _run(self, chats):
+        # Sockets are authenticated by scope user, JWTMiddleware is not part of the run
+        application = URLRouter(websocket_urlpatterns)
+
+        # Memory measured from the first to the last accepted connection,
+        # it includes the communicator side, so it is an upper bound
+        tracemalloc.start()
+        memory_before = tracemalloc.get_traced_memory()[0]
+        pairs = await asyncio.gather(*[self._connect(application, chat) for chat in chats])
+        memory_per_connection = (tracemalloc.get_traced_memory()[
+                                 0] - memory_before) / (len(pairs) * 2)
+        tracemalloc.stop()
+
+        latencies = []
+        self.counting = True
+        started = time.perf_counter()
+        await asyncio.gather(*[self._converse(buyer, seller, latencies) for buyer, seller in pairs])
+        elapsed = time.perf_counter() - started
+        self.counting = False
+
+        for buyer, seller in pairs:
+            await buyer.disconnect()
+            await seller.disconnect()
+
+        return {
+            'connections': len(pairs) * 2,
+            'messages': len(latencies),
+            'elapsed': elapsed,
+            'latencies': latencies,
+            'memory_per_connection': memory_per_connection,
+        }
+
+    async def _connect(self, application, chat):
+        pair = []
+        for user in (chat.buyer, chat.seller):
+            communicator = WebsocketCommunicator(
+                application, f'/ws/chat/{chat.id}/')
+            communicator.scope['user'] = user
+            connected, _ = await communicator.connect(timeout=self.options['timeout'])
+            if not connected:
+                raise RuntimeError(
+                    f'Connection to chat {chat.id} was rejected')
+            await communicator.receive_json_from(timeout=self.options['timeout'])
+            pair.append(communicator)
+        return pair
+
+    async def _converse(self, buyer, seller, latencies):
+        timeout = self.options['timeout']
+        mark_read_every = self.options['mark_read_every']
+
+        for i in range(self.options['messages']):
+            sender, recipient = (buyer, seller) if i % 2 == 0 else (seller, buyer)
+
+            started = time.perf_counter()
+            await sender.send_json_to({'type': 'chat_message', 'message': f'Message {i}'})
+            await self._receive(recipient, 'chat_message', timeout)
+            latencies.append(time.perf_counter() - started)
+            # Own message is echoed back to the sender
+            await self._receive(sender, 'chat_message', timeout)
+
+            if mark_read_every and (i + 1) % mark_read_every == 0:
+                await recipient.send_json_to({'type': 'mark_read'})
+                # Read receipt is delivered to both participants
+                await self._receive(recipient, 'mark_read', timeout)
+                await self._receive(sender, 'mark_read', timeout)
+
+    @staticmethod
+    async def _receive(communicator, message_type, timeout):
+        # Presence events may arrive in between and are skipped
+        while True:
+            response = await communicator.receive_json_from(timeout=timeout)
+            if response['type'] == message_type:
+                return response
+
+    def _report(self, stats):
+        latencies = sorted(stats['latencies'])
+        if not latencies:
+            self.stdout.write('No messages were sent.')
+            return
+
+        # Percentile cut points need at least two samples
+        cuts = quantiles(latencies, n=100) if len(latencies) > 1 else [latencies[0]] * 99
+
+        self.stdout.write(
+            f"connections: {stats['connections']}, database threads: {self.db_threads or 'shared'}")
+        self.stdout.write(
+            f"messages: {stats['messages']} in {stats['elapsed']:.3f}s, "
+            f"{stats['messages'] / stats['elapsed']:.0f} messages/sec")
+        self.stdout.write(
+            'latency ms: ' + ', '.join(f'p{p} {cuts[p - 1] * 1000:.2f}' for p in (50, 95, 99))
+            + f', max {latencies[-1] * 1000:.2f}')
+        self.stdout.write(
+            f"DB queries per message: {self.queries / stats['messages']:.2f} (including mark_read)")
+        self.stdout.write(
+            f"memory per connection: {stats['memory_per_connection'] / 1024:.1f} KiB")
@@ -1,34 +1,119 @@
-from channels.db import database_sync_to_async
 from channels.middleware import BaseMiddleware
 from django.contrib.auth.models import AnonymousUser
 from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.db import router
 from rest_framework_simplejwt.tokens import AccessToken
 from rest_framework_simplejwt.exceptions import TokenError
 from urllib.parse import parse_qs
+from .db import run_db
 
 User = get_user_model()
 
+# Subprotocol marking the token in Sec-WebSocket-Protocol: ['access_token', <jwt>]
+TOKEN_SUBPROTOCOL = 'access_token'
 
-@database_sync_to_async
-def get_user_from_token(token_key):
+# User snapshots are dropped when a cached field changes, TTL only limits staleness if that fails
+USER_CACHE_TIMEOUT = 60
+# Only what websocket auth and message payloads need, never the password hash or other profile data
+USER_CACHE_FIELDS = ('id', 'is_active', 'first_name', 'last_name', 'email', 'profile_image')
+
+
+def user_cache_key(user_id):
+    return f'ws_user:{user_id}'
+
+
+def load_user_snapshot(user_id):
+    # Cache and database in one call on the chat pool, not a hop to the shared sync thread each
+    cache = caches['chat']
+    snapshot = cache.get(user_cache_key(user_id))
+    if snapshot is None:
+        snapshot = User.objects.filter(id=user_id).values(*USER_CACHE_FIELDS).first()
+        if snapshot is not None:
+            cache.set(user_cache_key(user_id), snapshot, USER_CACHE_TIMEOUT)
+    return snapshot
+
+
+async def get_cached_user(user_id):
+    """
+    Reconnects are served from the snapshot without touching the database.
+    Returned user has only USER_CACHE_FIELDS loaded, other fields are deferred.
+    """
+    snapshot = await run_db(load_user_snapshot, user_id)
+    if snapshot is None:
+        return None
+    # from_db expects values in model field order
+    fields = [field.attname for field in User._meta.concrete_fields if field.attname in snapshot]
+    return User.from_db(router.db_for_read(User), fields, [snapshot[field] for field in fields])
+
+
+def remember_cached_fields(user):
+    # Values of the cached fields as loaded or last saved, compared on the next save
+    user._cached_fields_state = {
+        field: user.__dict__[field] for field in USER_CACHE_FIELDS if field in user.__dict__}
+
+
+def cached_user_changed(user, update_fields=None):
+    """
+    Whether a save changed a field of the snapshot, compared with the state the instance was
+    loaded with, so saves don't read the cache. Saves that don't touch the cached fields
+    (e.g. last_login) keep the snapshot.
+    """
+    fields = set(USER_CACHE_FIELDS)
+    if update_fields is not None:
+        fields &= set(update_fields)
+    loaded = getattr(user, '_cached_fields_state', {})
+    deferred = user.get_deferred_fields()
+    # Deferred fields are not saved, fields loaded after init are compared as changed
+    return any(field not in loaded or getattr(user, field) != loaded[field]
+               for field in fields - deferred)
+
+
+def invalidate_cached_user(user_id):
+    caches['chat'].delete(user_cache_key(user_id))
+
+
+async def get_user_from_token(token_key):
     try:
         access_token = AccessToken(token_key)
         user_id = access_token['user_id']
-        user = User.objects.get(id=user_id)
-        return user
-    except (TokenError, User.DoesNotExist):
-        return AnonymousUser
+    except (TokenError, KeyError):
+        return AnonymousUser()
+
+    user = await get_cached_user(user_id)
+    # Banned users are rejected even with a valid token
+    if user is None or not user.is_active:
+        return AnonymousUser()
+    return user
+
+
+def get_token(scope):
+    """
+    Token from ?token= query param or from Sec-WebSocket-Protocol header.
+    Header form keeps the token out of URLs and access logs.
+    """
+    query_string = scope.get('query_string', b'').decode()
+    token = parse_qs(query_string).get('token', [None])[0]
+    if token:
+        return token, None
+
+    subprotocols = scope.get('subprotocols', [])
+    if TOKEN_SUBPROTOCOL in subprotocols:
+        index = subprotocols.index(TOKEN_SUBPROTOCOL)
+        if index + 1 < len(subprotocols):
+            return subprotocols[index + 1], TOKEN_SUBPROTOCOL
+    return None, None
 
 
 class JWTMiddleware(BaseMiddleware):
     async def __call__(self, scope, receive, send):
-        query_string = scope.get('query_string', b'').decode()
-        query_params = parse_qs(query_string)
-        token = query_params.get('token', [None])[0]
+        token, subprotocol = get_token(scope)
 
         if token:
             scope['user'] = await get_user_from_token(token)
         else:
-            scope['user'] = AnonymousUser
+            scope['user'] = AnonymousUser()
+        # Browsers drop connection unless the requested subprotocol is echoed on accept
+        scope['auth_subprotocol'] = subprotocol
 
         return await super().__call__(scope, receive, send)
@@ -0,0 +1,49 @@
+# Generated by Django 4.2.16 on 2026-10-19 15:02
+
+import uuid
+from django.db import migrations, models
+import django.utils.timezone
+
+
+BATCH_SIZE = 1000
+
+
+def gen_uuid(apps, schema_editor):
+    # Existing rows need distinct values before the unique constraint is added,
+    # keyset batches keep memory independent of the table size
+    Message = apps.get_model('chat', 'Message')
+    last_id = 0
+    while True:
+        messages = list(Message.objects.filter(id__gt=last_id).order_by('id').only('id')[:BATCH_SIZE])
+        if not messages:
+            break
+        for message in messages:
+            message.uuid = uuid.uuid4()
+        Message.objects.bulk_update(messages, ['uuid'])
+        last_id = messages[-1].id
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_unreadcounter'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='uuid',
+            field=models.UUIDField(null=True, editable=False),
+        ),
+        migrations.RunPython(gen_uuid, reverse_code=migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='message',
+            name='uuid',
+            field=models.UUIDField(default=uuid.uuid4, editable=False, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+    ]
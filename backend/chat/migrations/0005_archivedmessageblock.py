@@ -0,0 +1,32 @@
+# Generated by Django 4.2.16 on 2026-10-19 13:44
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_message_uuid'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedMessageBlock',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.DateField()),
+                ('message_count', models.PositiveIntegerField(default=0)),
+                ('min_message_id', models.BigIntegerField()),
+                ('max_message_id', models.BigIntegerField()),
+                ('first_created_at', models.DateTimeField()),
+                ('last_created_at', models.DateTimeField()),
+                ('data', models.BinaryField()),
+                ('chat', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_blocks', to='chat.chat')),
+            ],
+            options={
+                'ordering': ['period'],
+                'unique_together': {('chat', 'period')},
+            },
+        ),
+    ]
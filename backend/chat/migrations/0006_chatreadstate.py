@@ -0,0 +1,68 @@
+# Generated by Django 4.2.16 on 2026-10-19 13:47
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def create_read_states(apps, schema_editor):
+    # Watermark of each participant is the newest read message from the other one
+    Chat = apps.get_model('chat', 'Chat')
+    Message = apps.get_model('chat', 'Message')
+    ChatReadState = apps.get_model('chat', 'ChatReadState')
+
+    states = []
+    for chat in Chat.objects.only('id', 'buyer_id', 'seller_id').iterator(chunk_size=2000):
+        for user_id in (chat.buyer_id, chat.seller_id):
+            last_read = (Message.objects.filter(chat_id=chat.id, is_read=True)
+                         .exclude(sender_id=user_id)
+                         .order_by('-created_at', '-id')
+                         .values('id', 'created_at').first())
+            if last_read:
+                states.append(ChatReadState(chat_id=chat.id, user_id=user_id,
+                                            last_read_at=last_read['created_at'],
+                                            last_read_message_id=last_read['id']))
+    ChatReadState.objects.bulk_create(states, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chat', '0005_archivedmessageblock'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChatReadState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_read_at', models.DateTimeField()),
+                ('last_read_message_id', models.BigIntegerField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='chatreadstate',
+            name='chat',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_states', to='chat.chat'),
+        ),
+        migrations.AddField(
+            model_name='chatreadstate',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chat_read_states', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterUniqueTogether(
+            name='chatreadstate',
+            unique_together={('chat', 'user')},
+        ),
+        migrations.RunPython(create_read_states, reverse_code=migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name='message',
+            name='chat_messag_chat_id_a8bc54_idx',
+        ),
+        migrations.RemoveField(
+            model_name='message',
+            name='is_read',
+        ),
+    ]
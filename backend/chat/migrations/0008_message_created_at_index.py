@@ -0,0 +1,17 @@
+# Generated by Django 4.2.16 on 2026-10-19 14:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_message_search_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['created_at'], name='chat_messag_created_b6b51c_idx'),
+        ),
+    ]
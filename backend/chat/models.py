@@ -1,5 +1,7 @@
+import uuid
 from django.db import models
 from django.conf import settings
+from django.utils import timezone
 from ads.models import Ad
 # Create your models here.
 
@@ -38,15 +40,69 @@ class Message(models.Model):
     sender = models.ForeignKey(
         settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='sent_messages', db_index=True)
     content = models.TextField(max_length=2500)
-    is_read = models.BooleanField(default=False, db_index=True)
-    created_at = models.DateTimeField(auto_now_add=True)
+    # Assigned on instantiation, so write-behind messages can be broadcast before insert
+    uuid = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
 
     class Meta:
         ordering = ['created_at']
         indexes = [
             models.Index(fields=['chat', 'created_at']),
-            models.Index(fields=['chat', 'is_read', 'sender']),
+            # Archive task looks up old messages across all chats
+            models.Index(fields=['created_at']),
         ]
 
     def __str__(self):
         return f'Message {self.id} from {self.sender.email} in chat {self.chat.id}'
+
+
+class ChatReadState(models.Model):
+    # Read watermark of one participant: messages of the other participant up to
+    # (last_read_at, last_read_message_id) are read, read status of messages is derived from it
+    chat = models.ForeignKey(
+        Chat, on_delete=models.CASCADE, related_name='read_states')
+    user = models.ForeignKey(settings.AUTH_USER_MODEL,
+                             on_delete=models.CASCADE, related_name='chat_read_states')
+    last_read_at = models.DateTimeField()
+    last_read_message_id = models.BigIntegerField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('chat', 'user')
+
+    def __str__(self):
+        return f'Chat {self.chat_id}: user {self.user_id} read up to message {self.last_read_message_id}'
+
+
+class UnreadCounter(models.Model):
+    # Total unread messages of the user across all chats,
+    # maintained on message write/read and repaired by chat.tasks.reconcile_unread_counters
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE,
+                                primary_key=True, related_name='unread_counter')
+    unread_count = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'User {self.user_id}: {self.unread_count} unread'
+
+
+class ArchivedMessageBlock(models.Model):
+    # Messages of one chat and month moved out of the hot message table,
+    # stored as zlib compressed JSON and read back by chat.archive
+    chat = models.ForeignKey(
+        Chat, on_delete=models.CASCADE, related_name='archived_blocks')
+    period = models.DateField()
+    message_count = models.PositiveIntegerField(default=0)
+    # Id range of the block, used to find archived cursor messages
+    min_message_id = models.BigIntegerField()
+    max_message_id = models.BigIntegerField()
+    first_created_at = models.DateTimeField()
+    last_created_at = models.DateTimeField()
+    data = models.BinaryField()
+
+    class Meta:
+        unique_together = ('chat', 'period')
+        ordering = ['period']
+
+    def __str__(self):
+        return f'Chat {self.chat_id} archive {self.period:%Y-%m}: {self.message_count} messages'
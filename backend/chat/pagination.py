@@ -0,0 +1,73 @@
+from django.db.models import Q
+from rest_framework.pagination import PageNumberPagination
+from .models import Message
+from .archive import archived_messages, find_archived_cursor
+
+MESSAGE_PAGE_SIZE = 50
+MAX_MESSAGE_PAGE_SIZE = 100
+
+
+class SellerInboxPagination(PageNumberPagination):
+    # Dealers may have thousands of ads with chats
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+
+def paginate_messages(chat, before_id=None, after_id=None, page_size=MESSAGE_PAGE_SIZE):
+    """
+    Cursor based page of chat messages, returned in chronological order.
+    - no cursor: newest page
+    - before_id: older messages right before the given one
+    - after_id: newer messages right after the given one
+    Pages are ranges on the (chat, created_at) index, ties are broken by id.
+    Archived messages are always older than hot ones, so the archive is read
+    only when a page runs past the oldest hot message.
+    Returns (messages, has_more), None if the cursor message is not in the chat.
+    """
+    queryset = Message.objects.filter(chat=chat).select_related('sender')
+    cursor_id = after_id or before_id
+    cursor = None
+    archived_cursor = False
+
+    if cursor_id:
+        row = Message.objects.filter(
+            chat=chat, id=cursor_id).values('created_at').first()
+        if row is not None:
+            cursor = (row['created_at'], cursor_id)
+        else:
+            cursor = find_archived_cursor(chat, cursor_id)
+            if cursor is None:
+                return None
+            archived_cursor = True
+
+    if cursor and not archived_cursor:
+        created_at, cursor_id = cursor
+        if after_id:
+            queryset = queryset.filter(Q(created_at__gt=created_at) | Q(
+                created_at=created_at, id__gt=cursor_id))
+        else:
+            queryset = queryset.filter(Q(created_at__lt=created_at) | Q(
+                created_at=created_at, id__lt=cursor_id))
+
+    # One extra row tells whether another page exists
+    if after_id:
+        messages = []
+        if archived_cursor:
+            messages = archived_messages(
+                chat, cursor, page_size + 1, newer=True)
+        if len(messages) <= page_size:
+            messages += list(queryset.order_by('created_at', 'id')
+                             [:page_size + 1 - len(messages)])
+        return messages[:page_size], len(messages) > page_size
+
+    messages = []
+    if not archived_cursor:
+        messages = list(queryset.order_by(
+            '-created_at', '-id')[:page_size + 1])
+    if len(messages) <= page_size:
+        # Hot table is exhausted, the page continues in the archive
+        messages += archived_messages(chat, cursor if archived_cursor else None,
+                                      page_size + 1 - len(messages))
+    has_more = len(messages) > page_size
+    return messages[:page_size][::-1], has_more
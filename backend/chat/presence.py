@@ -0,0 +1,77 @@
+from django.core.cache import caches
+from .db import chat_db
+
+# Connections of a user are counted per chat, the count expires unless refreshed by a heartbeat,
+# clients send one every ~25 seconds. Counts of crashed processes are dropped this way too
+PRESENCE_TTL = 60
+# Minimum seconds between broadcast typing events of one connection
+TYPING_INTERVAL = 0.3
+
+# Each presence function is one blocking call run like database calls (on the CHAT_DB_THREADS pool),
+# Django's async cache methods would queue every round trip on the shared sync thread instead
+
+
+def presence_key(chat_id, user_id):
+    return f'chat_presence:{chat_id}:{user_id}'
+
+
+@chat_db
+def set_online(chat_id, user_id):
+    """
+    Count a new connection of the user to the chat.
+    Returns True for the first connection, so the change is worth broadcasting.
+    """
+    cache = caches['chat']
+    key = presence_key(chat_id, user_id)
+    cache.add(key, 0, PRESENCE_TTL)
+    try:
+        count = cache.incr(key)
+    except ValueError:
+        # Expired between add and incr
+        count = 1 if cache.add(key, 1, PRESENCE_TTL) else cache.incr(key)
+    cache.touch(key, PRESENCE_TTL)
+    return count == 1
+
+
+@chat_db
+def refresh_online(chat_id, user_id):
+    """
+    Heartbeat of a connection, refreshes the TTL shared by all connections of the user.
+    Returns True if presence had expired and the user is online again.
+    """
+    cache = caches['chat']
+    key = presence_key(chat_id, user_id)
+    if cache.touch(key, PRESENCE_TTL):
+        return False
+    return cache.add(key, 1, PRESENCE_TTL)
+
+
+@chat_db
+def set_offline(chat_id, user_id):
+    """
+    Count a closed connection of the user to the chat.
+    Returns True when the last connection is gone. The zero count is left to expire,
+    deleting it could drop a connection counted meanwhile.
+    """
+    try:
+        return caches['chat'].decr(presence_key(chat_id, user_id)) <= 0
+    except ValueError:
+        # Already expired, offline was reported by nobody
+        return True
+
+
+async def get_online(chat_id, user_ids):
+    return (await get_online_many({chat_id: user_ids}))[chat_id]
+
+
+@chat_db
+def get_online_many(participants):
+    # Ids of present users by chat id for {chat_id: user_ids}, read in one round trip
+    keys = {presence_key(chat_id, user_id): (chat_id, user_id)
+            for chat_id, user_ids in participants.items() for user_id in user_ids}
+    found = caches['chat'].get_many(list(keys))
+    online = {chat_id: [] for chat_id in participants}
+    for key, (chat_id, user_id) in keys.items():
+        if found.get(key, 0) > 0:
+            online[chat_id].append(user_id)
+    return online
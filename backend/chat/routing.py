@@ -2,5 +2,7 @@ from django.urls import re_path
 from . import consumers
 
 websocket_urlpatterns = [
-    re_path(r'ws/chat/(?P<chat_id>\w+)/$', consumers.ChatConsumer.as_asgi())
+    re_path(r'ws/chat/(?P<chat_id>\w+)/$', consumers.ChatConsumer.as_asgi()),
+    re_path(r'ws/chats/$', consumers.MultiChatConsumer.as_asgi()),
+    re_path(r'ws/inbox/$', consumers.InboxConsumer.as_asgi()),
 ]
@@ -0,0 +1,112 @@
+import re
+from django.db import connection, connections
+from django.db.models import Q
+from django.utils.html import escape
+from .models import Message
+
+SEARCH_PAGE_SIZE = 20
+MAX_SEARCH_PAGE_SIZE = 50
+# Words around the match kept in a snippet
+SNIPPET_WORDS = 12
+# Highlight markers, replaced with <mark> after the snippet is escaped
+MATCH_START, MATCH_END = '\x02', '\x03'
+# Triggers of migration 0007 keeping chat_message_fts in sync with chat_message
+SEARCH_TRIGGERS = ['chat_message_fts_insert', 'chat_message_fts_delete', 'chat_message_fts_update']
+
+
+def build_match_query(query):
+    """
+    FTS5 query from user input: every word must match, the last one as a prefix,
+    so results show up while typing. Words are quoted, FTS5 operators in input have no effect.
+    Returns None if the input has no words.
+    """
+    words = re.findall(r'\w+', query)
+    if not words:
+        return None
+    return ' '.join(f'"{word}"' for word in words) + '*'
+
+
+def missing_search_triggers(using='default'):
+    """
+    Names of search index triggers missing from the database.
+    SQLite drops triggers when a migration remakes chat_message, and nothing else notices.
+    """
+    conn = connections[using]
+    if conn.vendor != 'sqlite':
+        return []
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name = 'chat_message'")
+        existing = {name for name, in cursor.fetchall()}
+    return [name for name in SEARCH_TRIGGERS if name not in existing]
+
+
+def highlight(snippet):
+    return escape(snippet).replace(MATCH_START, '<mark>').replace(MATCH_END, '</mark>')
+
+
+def search_messages(user, query, page=1, page_size=SEARCH_PAGE_SIZE):
+    """
+    Messages of the user's chats matching the query, newest first.
+    Returns (results, has_more), None if the query has no words.
+    Archived messages are not searched.
+    """
+    match = build_match_query(query)
+    if match is None:
+        return None
+
+    offset = (page - 1) * page_size
+    if connection.vendor != 'sqlite':
+        return _search_without_index(user, query, offset, page_size)
+
+    # Matches are joined to the user's chats before LIMIT/OFFSET, so pages are never short.
+    # One extra row tells whether another page exists
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            WITH user_chats AS (
+                SELECT id FROM chat_chat WHERE buyer_id = %s OR seller_id = %s
+            )
+            SELECT m.id, m.chat_id, m.sender_id, m.created_at,
+                   snippet(chat_message_fts, 0, %s, %s, '…', %s)
+            FROM chat_message_fts
+            JOIN chat_message m ON m.id = chat_message_fts.rowid
+            JOIN user_chats c ON c.id = m.chat_id
+            WHERE chat_message_fts MATCH %s
+            ORDER BY m.created_at DESC, m.id DESC
+            LIMIT %s OFFSET %s
+            """,
+            [user.id, user.id, MATCH_START, MATCH_END, SNIPPET_WORDS, match,
+             page_size + 1, offset])
+        rows = cursor.fetchall()
+
+    # Raw rows bypass model field conversion, SQLite returns created_at as text
+    results = [{
+        'id': message_id,
+        'chat_id': chat_id,
+        'sender_id': sender_id,
+        'created_at': connection.ops.convert_datetimefield_value(created_at, None, connection),
+        'snippet': highlight(snippet),
+    } for message_id, chat_id, sender_id, created_at, snippet in rows[:page_size]]
+    return results, len(rows) > page_size
+
+
+def _search_without_index(user, query, offset, page_size):
+    # Plain substring scan, used on databases without FTS5
+    query = query.strip()
+    messages = list(Message.objects.filter(Q(chat__buyer=user) | Q(chat__seller=user), content__icontains=query)
+                    .order_by('-created_at', '-id')
+                    .values('id', 'chat_id', 'sender_id', 'created_at', 'content')[offset:offset + page_size + 1])
+    results = []
+    for message in messages[:page_size]:
+        content = message.pop('content')
+        # Searched in the original content, lower() can change the length of non-ASCII text
+        found = re.search(re.escape(query), content, re.IGNORECASE)
+        if found is None:
+            # Database case folding differs from Python's, snippet without highlight then
+            message['snippet'] = highlight(content[:120])
+        else:
+            start, end = found.span()
+            message['snippet'] = highlight(content[max(0, start - 60):start] + MATCH_START +
+                                           content[start:end] + MATCH_END + content[end:end + 60])
+        results.append(message)
+    return results, len(messages) > page_size
@@ -1,16 +1,26 @@
 from rest_framework import serializers
 from .models import Chat, Message
+from ads.models import Ad
 from account.serializers import UserBasicSerializer
 from ads.serializers import AdListSerializer
+from .pagination import paginate_messages
+from .utils import after_watermark, get_read_watermarks, is_message_read, recipient_id
 
 
 class MessageSerializer(serializers.ModelSerializer):
     sender = UserBasicSerializer(read_only=True)
+    is_read = serializers.SerializerMethodField()
 
     class Meta:
         model = Message
-        fields = ['id', 'sender', 'content', 'is_read', 'created_at']
-        read_only_fields = ['id', 'sender', 'created_at']
+        fields = ['id', 'uuid', 'sender', 'content', 'is_read', 'created_at']
+        read_only_fields = ['id', 'uuid', 'sender', 'created_at']
+
+    def get_is_read(self, obj):
+        # Derived from read watermarks passed in context, archived messages are always read
+        if getattr(obj, 'archived', False):
+            return True
+        return is_message_read(obj, self.context.get('read_watermarks', {}))
 
 
 class ChatSerializer(serializers.ModelSerializer):
@@ -28,19 +38,33 @@ class ChatSerializer(serializers.ModelSerializer):
         read_only_fields = ['id', 'created_at', 'updated_at']
 
     def get_last_message(self, obj):
-        last_msg = obj.messages.last()
+        # Use values annotated by ChatViewSet.annotate_summary when available
+        if hasattr(obj, 'last_message_id'):
+            if obj.last_message_id is None:
+                return None
+            return {
+                'content': obj.last_message_content,
+                'sender_id': obj.last_message_sender_id,
+                'created_at': obj.last_message_created_at
+            }
+
+        last_msg = obj.messages.order_by('-created_at', '-id').first()
         if last_msg:
             return {
                 'content': last_msg.content,
-                'sender_id': last_msg.sender.id,
+                'sender_id': last_msg.sender_id,
                 'created_at': last_msg.created_at
             }
         return None
 
     def get_unread_count(self, obj):
+        if hasattr(obj, 'unread_messages'):
+            return obj.unread_messages
+
         request = self.context.get('request')
         if request and request.user.is_authenticated:
-            return obj.messages.filter(is_read=False).exclude(sender=request.user).count()
+            watermark = get_read_watermarks(obj)[recipient_id(obj, request.user.id)]
+            return obj.messages.filter(after_watermark(*watermark)).exclude(sender=request.user).count()
         return 0
 
     def get_other_user(self, obj):
@@ -55,18 +79,66 @@ class ChatDetailSerializer(serializers.ModelSerializer):
     buyer = UserBasicSerializer(read_only=True)
     seller = UserBasicSerializer(read_only=True)
     ad = AdListSerializer(read_only=True)
-    messages = MessageSerializer(many=True, read_only=True)
+    messages = serializers.SerializerMethodField()
+    has_more_messages = serializers.SerializerMethodField()
     other_user = serializers.SerializerMethodField()
 
     class Meta:
         model = Chat
         fields = ['id', 'ad', 'buyer', 'seller', 'other_user',
-                  'messages', 'created_at', 'updated_at']
+                  'messages', 'has_more_messages', 'created_at', 'updated_at']
         read_only_fields = ['id', 'created_at', 'updated_at']
 
+    def _newest_page(self, obj):
+        # Only the newest page is serialized, older pages are loaded via ChatViewSet.messages
+        if not hasattr(obj, '_newest_messages_page'):
+            obj._newest_messages_page = paginate_messages(obj)
+        return obj._newest_messages_page
+
+    def get_messages(self, obj):
+        messages, _ = self._newest_page(obj)
+        context = {**self.context, 'read_watermarks': get_read_watermarks(obj)}
+        return MessageSerializer(messages, many=True, context=context).data
+
+    def get_has_more_messages(self, obj):
+        _, has_more = self._newest_page(obj)
+        return has_more
+
     def get_other_user(self, obj):
         request = self.context.get('request')
         if request and request.user.is_authenticated:
             other_user = obj.get_other_user(request.user)
             return UserBasicSerializer(other_user, context={'request': request}).data
         return None
+
+
+class SellerInboxSerializer(serializers.ModelSerializer):
+    """Compact ad row with summary of its chats, uses values annotated by ChatViewSet.seller_inbox_queryset"""
+    image = serializers.SerializerMethodField()
+    chat_count = serializers.IntegerField(read_only=True)
+    unread_count = serializers.IntegerField(source='unread_messages', read_only=True)
+    last_message = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Ad
+        fields = ['id', 'title', 'price', 'image',
+                  'chat_count', 'unread_count', 'last_message']
+
+    def get_image(self, obj):
+        # First image only, from prefetched images
+        images = [image for image in obj.images.all() if image.image]
+        if not images:
+            return None
+        request = self.context.get('request')
+        url = images[0].image.url
+        return request.build_absolute_uri(url) if request else url
+
+    def get_last_message(self, obj):
+        if obj.last_message_chat_id is None:
+            return None
+        return {
+            'chat_id': obj.last_message_chat_id,
+            'content': obj.last_message_content,
+            'sender_id': obj.last_message_sender_id,
+            'created_at': obj.last_message_created_at
+        }
@@ -0,0 +1,32 @@
+from django.contrib.auth import get_user_model
+from django.db.models.signals import post_init, post_save, post_delete, pre_delete
+from django.dispatch import receiver
+from .archive import purge_archived_user
+from .middleware import cached_user_changed, invalidate_cached_user, remember_cached_fields
+
+User = get_user_model()
+
+
+@receiver(post_init, sender=User)
+def user_loaded(sender, instance, **kwargs):
+    remember_cached_fields(instance)
+
+
+@receiver(post_save, sender=User)
+def user_changed(sender, instance, created=False, update_fields=None, **kwargs):
+    # Websocket auth snapshot must not outlive profile changes or bans.
+    # New users drop any snapshot left under a reused id
+    if created or cached_user_changed(instance, update_fields):
+        invalidate_cached_user(instance.id)
+    remember_cached_fields(instance)
+
+
+@receiver(pre_delete, sender=User)
+def user_deleting(sender, instance, **kwargs):
+    # Archived messages of the user go away with their chats
+    purge_archived_user(instance.id)
+
+
+@receiver(post_delete, sender=User)
+def user_deleted(sender, instance, **kwargs):
+    invalidate_cached_user(instance.id)
@@ -0,0 +1,26 @@
+import logging
+from celery import shared_task
+from .utils import reconcile_unread_counters as reconcile
+from .archive import archive_old_messages as archive
+
+logger = logging.getLogger(__name__)
+
+
+@shared_task(name='chat.tasks.reconcile_unread_counters')
+def reconcile_unread_counters():
+    """
+    Periodic celery task that repairs drift of per-user unread counters
+    """
+    repaired = reconcile()
+    logger.info(f'Unread counters repaired: {repaired}.')
+    return repaired
+
+
+@shared_task(name='chat.tasks.archive_old_messages')
+def archive_old_messages(max_chats=500):
+    """
+    Periodic celery task that moves old messages into the archive
+    """
+    chats, messages = archive(max_chats)
+    logger.info(f'Archived {messages} messages from {chats} chats.')
+    return messages
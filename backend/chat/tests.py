@@ -1,15 +1,49 @@
+import asyncio
+import threading
+from datetime import timedelta
+from io import StringIO
+from django.core.management import call_command
 from django.test import TestCase
+from django.utils import timezone
 from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
 from rest_framework.test import APITestCase, APIClient
 from rest_framework import status
 from django.urls import reverse
+from django.db import connection, DatabaseError
+from unittest.mock import patch
+from django.test.utils import CaptureQueriesContext
+from django.test import override_settings
+from django.core.cache import caches
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from rest_framework_simplejwt.tokens import AccessToken
+import msgpack
+from .routing import websocket_urlpatterns
+from .consumers import MSGPACK_SUBPROTOCOL
+from .middleware import JWTMiddleware, USER_CACHE_FIELDS, get_cached_user, user_cache_key
+from .utils import reconcile_unread_counters, create_message, mark_chat_as_read, get_read_watermarks, is_message_read, after_watermark
+from .archive import archive_chat, month_start
+from .checks import search_triggers_check
+from .search import _search_without_index
+from .db import run_db
+from .write_behind import MessageWriteBehind
+from .presence import get_online, set_online
 from decimal import Decimal
-from .models import Chat, Message
+from .models import Chat, Message, UnreadCounter, ArchivedMessageBlock, ChatReadState
+from .pagination import MESSAGE_PAGE_SIZE
 from ads.models import Ad
 from catalog.models import Brand, ModelCar
 
 User = get_user_model()
 
+IN_MEMORY_CHANNEL_LAYERS = {
+    'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+IN_MEMORY_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'chat': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'chat'}}
+
 
 class ChatModelTests(TestCase):
     """Test cases for Chat model"""
@@ -160,14 +194,67 @@ class MessageModelTest(TestCase):
         message = Message.objects.create(
             chat=self.chat, sender=self.buyer, content='something')
 
-        self.assertFalse(message.is_read)
-        message.is_read = True
-        message.save()
-        message.refresh_from_db()
-
-        self.assertTrue(message.is_read)
-
-
+        self.assertFalse(is_message_read(message, get_read_watermarks(self.chat)))
+        self.assertEqual(mark_chat_as_read(self.chat.id, self.seller), 1)
+
+        self.assertTrue(is_message_read(message, get_read_watermarks(self.chat)))
+        # Own messages of the reader are not affected
+        self.assertEqual(mark_chat_as_read(self.chat.id, self.buyer), 0)
+
+    def test_create_message_is_atomic(self):
+        # Test for message insert rolled back when the counter update fails
+        with patch('chat.utils.add_unread', side_effect=DatabaseError('counter failed')):
+            with self.assertRaises(DatabaseError):
+                create_message(self.chat, self.buyer, 'hello')
+
+        self.assertFalse(Message.objects.filter(chat=self.chat).exists())
+        message = create_message(self.chat, self.buyer, 'hello')
+        self.assertEqual(Chat.objects.get(id=self.chat.id).updated_at, message.created_at)
+
+    def test_mark_as_read_is_single_upsert(self):
+        # Test for marking chat as read storing one watermark row per participant
+        for i in range(3):
+            Message.objects.create(
+                chat=self.chat, sender=self.buyer, content=f'message {i}')
+
+        self.assertEqual(mark_chat_as_read(self.chat.id, self.seller), 3)
+        newer = Message.objects.create(
+            chat=self.chat, sender=self.buyer, content='newer')
+        self.assertEqual(mark_chat_as_read(self.chat.id, self.seller), 1)
+
+        state = ChatReadState.objects.get(chat=self.chat, user=self.seller)
+        self.assertEqual(state.last_read_message_id, newer.id)
+        self.assertEqual(ChatReadState.objects.filter(chat=self.chat).count(), 1)
+
+
+    def test_concurrent_mark_as_read_decrements_once(self):
+        # Test for a call racing with another one neither decrementing twice nor moving the watermark back
+        create_message(self.chat, self.buyer, 'first')
+        newest = create_message(self.chat, self.buyer, 'second')
+        count_range = after_watermark
+        raced = []
+
+        def race(*args):
+            # Another connection marks the chat as read while this call counts
+            if not raced:
+                raced.append(None)
+                raced[0] = mark_chat_as_read(self.chat.id, self.seller)
+            return count_range(*args)
+
+        # First race creates the watermark row, second one updates it
+        for expected in (2, 1):
+            raced.clear()
+            with patch('chat.utils.after_watermark', side_effect=race):
+                self.assertEqual(mark_chat_as_read(self.chat.id, self.seller), 0)
+
+            self.assertEqual(raced, [expected])
+            self.assertEqual(UnreadCounter.objects.get(user=self.seller).unread_count, 0)
+            state = ChatReadState.objects.get(chat=self.chat, user=self.seller)
+            self.assertEqual(state.last_read_message_id, newest.id)
+            newest = create_message(self.chat, self.buyer, 'third')
+        self.assertEqual(UnreadCounter.objects.get(user=self.seller).unread_count, 1)
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
 class ChatViewSetTests(APITestCase):
     """Test cases for Chat API"""
 
@@ -303,7 +390,7 @@ class ChatViewSetTests(APITestCase):
         chat = Chat.objects.create(
             ad=self.ad, buyer=self.buyer, seller=self.seller)
         Message.objects.create(
-            chat=chat, sender=self.seller, content='unread', is_read=False)
+            chat=chat, sender=self.seller, content='unread')
 
         self.client.force_authenticate(user=self.buyer)
         response = self.client.get(self.chats_url)
@@ -316,9 +403,9 @@ class ChatViewSetTests(APITestCase):
         chat = Chat.objects.create(
             ad=self.ad, buyer=self.buyer, seller=self.seller)
         msg_1 = Message.objects.create(
-            chat=chat, sender=self.seller, content='message 1', is_read=False)
+            chat=chat, sender=self.seller, content='message 1')
         msg_2 = Message.objects.create(
-            chat=chat, sender=self.seller, content='message 2', is_read=False)
+            chat=chat, sender=self.seller, content='message 2')
 
         self.client.force_authenticate(user=self.buyer)
         url = reverse('chats-mark-as-read', kwargs={'pk': chat.id})
@@ -326,11 +413,15 @@ class ChatViewSetTests(APITestCase):
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
-        msg_1.refresh_from_db()
-        msg_2.refresh_from_db()
+        watermarks = get_read_watermarks(chat)
+        self.assertTrue(is_message_read(msg_1, watermarks))
+        self.assertTrue(is_message_read(msg_2, watermarks))
 
-        self.assertTrue(msg_1.is_read)
-        self.assertTrue(msg_2.is_read)
+        # Read status is still part of the API, derived from the watermark
+        self.client.force_authenticate(user=self.seller)
+        url = reverse('chats-messages', kwargs={'pk': chat.id})
+        response = self.client.get(url)
+        self.assertTrue(all(message['is_read'] for message in response.data['results']))
 
     def test_seller_access_to_chat(self):
         # Test for seller access to chat
@@ -387,11 +478,1068 @@ class ChatViewSetTests(APITestCase):
         chat = Chat.objects.create(
             ad=self.ad, buyer=self.buyer, seller=self.seller)
         message = Message.objects.create(
-            chat=chat, sender=self.seller, content='some text', is_read=False)
+            chat=chat, sender=self.seller, content='some text')
 
         self.client.force_authenticate(user=self.buyer)
         url = reverse('chats-detail', kwargs={'pk': chat.id})
         self.client.get(url)
 
-        message.refresh_from_db()
-        self.assertTrue(message.is_read)
+        self.assertTrue(is_message_read(message, get_read_watermarks(chat)))
+
+    def test_list_chats_query_count_is_constant(self):
+        # Test for chat list queries not growing with number of chats and messages
+        def list_queries():
+            self.client.force_authenticate(user=self.buyer)
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.get(self.chats_url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            return len(context.captured_queries)
+
+        chat = Chat.objects.create(
+            ad=self.ad, buyer=self.buyer, seller=self.seller)
+        Message.objects.create(chat=chat, sender=self.seller, content='hi')
+        single_chat_queries = list_queries()
+
+        for i in range(5):
+            ad = Ad.objects.create(user=self.seller, title=f'Car {i}', brand=self.brand, model=self.model,
+                                   year=1987, mileage=100, price=Decimal('1000'))
+            other_chat = Chat.objects.create(
+                ad=ad, buyer=self.buyer, seller=self.seller)
+            for j in range(3):
+                Message.objects.create(
+                    chat=other_chat, sender=self.seller, content=f'message {j}')
+
+        self.assertEqual(list_queries(), single_chat_queries)
+
+    def test_list_chats_without_messages(self):
+        # Test for empty last message and unread count in chat list
+        Chat.objects.create(ad=self.ad, buyer=self.buyer, seller=self.seller)
+
+        self.client.force_authenticate(user=self.buyer)
+        response = self.client.get(self.chats_url)
+
+        self.assertIsNone(response.data[0]['last_message'])
+        self.assertEqual(response.data[0]['unread_count'], 0)
+
+    def test_retrieve_returns_newest_page(self):
+        # Test for chat detail returning only the newest page of messages
+        chat = Chat.objects.create(
+            ad=self.ad, buyer=self.buyer, seller=self.seller)
+        for i in range(MESSAGE_PAGE_SIZE + 5):
+            Message.objects.create(
+                chat=chat, sender=self.seller, content=f'message {i}')
+
+        self.client.force_authenticate(user=self.buyer)
+        url = reverse('chats-detail', kwargs={'pk': chat.id})
+        response = self.client.get(url)
+
+        self.assertEqual(len(response.data['messages']), MESSAGE_PAGE_SIZE)
+        self.assertTrue(response.data['has_more_messages'])
+        self.assertEqual(
+            response.data['messages'][-1]['content'], f'message {MESSAGE_PAGE_SIZE + 4}')
+
+    def test_message_history_cursor(self):
+        # Test for loading older and newer pages with before_id and after_id
+        chat = Chat.objects.create(
+            ad=self.ad, buyer=self.buyer, seller=self.seller)
+        messages = [Message.objects.create(chat=chat, sender=self.seller, content=f'message {i}')
+                    for i in range(10)]
+
+        self.client.force_authenticate(user=self.buyer)
+        url = reverse('chats-messages', kwargs={'pk': chat.id})
+
+        response = self.client.get(
+            url, {'before_id': messages[6].id, 'page_size': 4})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([m['id'] for m in response.data['results']],
+                         [m.id for m in messages[2:6]])
+        self.assertTrue(response.data['has_more'])
+
+        response = self.client.get(
+            url, {'after_id': messages[6].id, 'page_size': 4})
+        self.assertEqual([m['id'] for m in response.data['results']],
+                         [m.id for m in messages[7:]])
+        self.assertFalse(response.data['has_more'])
+
+    def test_message_history_reads_through_archive(self):
+        # Test for old messages moved to archive and served transparently by history pages
+        chat = Chat.objects.create(
+            ad=self.ad, buyer=self.buyer, seller=self.seller)
+        now = timezone.now()
+        messages = [Message.objects.create(chat=chat, sender=self.seller, content=f'message {i}',
+                                           created_at=now - timedelta(days=400 - i * 40))
+                    for i in range(10)]
+        cutoff = now - timedelta(days=180)
+        archived = [m for m in messages if m.created_at < cutoff]
+
+        self.assertEqual(archive_chat(chat, cutoff), len(archived))
+        self.assertEqual(Message.objects.filter(chat=chat).count(), 10 - len(archived))
+        # One block per month, each filled in its own pass
+        months = {month_start(m.created_at) for m in archived}
+        self.assertEqual(ArchivedMessageBlock.objects.filter(chat=chat).count(), len(months))
+        self.assertEqual(sum(ArchivedMessageBlock.objects.filter(chat=chat)
+                             .values_list('message_count', flat=True)), len(archived))
+        self.assertEqual(UnreadCounter.objects.get(
+            user=self.buyer).unread_count, 10 - len(archived))
+
+        self.client.force_authenticate(user=self.buyer)
+        url = reverse('chats-messages', kwargs={'pk': chat.id})
+
+        # Page crossing from hot table into the archive
+        response = self.client.get(
+            url, {'before_id': messages[7].id, 'page_size': 4})
+        self.assertEqual([m['id'] for m in response.data['results']],
+                         [m.id for m in messages[3:7]])
+        self.assertTrue(response.data['has_more'])
+        self.assertEqual(response.data['results'][0]['sender']['id'], self.seller.id)
+
+        # Cursor inside the archive, both directions
+        response = self.client.get(
+            url, {'before_id': messages[3].id, 'page_size': 4})
+        self.assertEqual([m['id'] for m in response.data['results']],
+                         [m.id for m in messages[:3]])
+        self.assertFalse(response.data['has_more'])
+
+        response = self.client.get(
+            url, {'after_id': messages[1].id, 'page_size': 4})
+        self.assertEqual([m['id'] for m in response.data['results']],
+                         [m.id for m in messages[2:6]])
+        self.assertTrue(response.data['has_more'])
+
+    def test_deleted_user_messages_purged_from_archive(self):
+        # Test for archived messages of a deleted user not left behind in blocks
+        chat = Chat.objects.create(
+            ad=self.ad, buyer=self.buyer, seller=self.seller)
+        old = timezone.now() - timedelta(days=400)
+        Message.objects.create(chat=chat, sender=self.buyer, content='old', created_at=old)
+        archive_chat(chat, timezone.now())
+        self.assertTrue(ArchivedMessageBlock.objects.filter(chat=chat).exists())
+
+        self.buyer.delete()
+
+        self.assertFalse(ArchivedMessageBlock.objects.filter(chat_id=chat.id).exists())
+
+    def test_message_history_unknown_cursor(self):
+        # Test for cursor message from another chat
+        chat = Chat.objects.create(
+            ad=self.ad, buyer=self.buyer, seller=self.seller)
+
+        self.client.force_authenticate(user=self.buyer)
+        url = reverse('chats-messages', kwargs={'pk': chat.id})
+        response = self.client.get(url, {'before_id': 9999})
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_unread_summary(self):
+        # Test for global unread counter following message reads
+        chat = Chat.objects.create(
+            ad=self.ad, buyer=self.buyer, seller=self.seller)
+        Message.objects.create(chat=chat, sender=self.seller, content='one')
+        Message.objects.create(chat=chat, sender=self.seller, content='two')
+
+        self.client.force_authenticate(user=self.buyer)
+        url = reverse('chats-unread-summary')
+        response = self.client.get(url)
+        self.assertEqual(response.data['unread_count'], 2)
+
+        self.client.post(reverse('chats-mark-as-read', kwargs={'pk': chat.id}))
+        self.assertEqual(UnreadCounter.objects.get(
+            user=self.buyer).unread_count, 0)
+        self.assertEqual(self.client.get(url).data['unread_count'], 0)
+
+    def test_seller_inbox_groups_chats_by_ad(self):
+        # Test for seller inbox returning each ad once with summary of its chats
+        second_buyer = User.objects.create_user(
+            email='second@email.com',
+            username='second@email.com',
+            password='321qwerty',
+            first_name='Second',
+            last_name='Buyer',
+            phone_number='+111222333',
+        )
+        first_chat = Chat.objects.create(
+            ad=self.ad, buyer=self.buyer, seller=self.seller)
+        second_chat = Chat.objects.create(
+            ad=self.ad, buyer=second_buyer, seller=self.seller)
+        Message.objects.create(chat=first_chat, sender=self.buyer, content='one')
+        Message.objects.create(chat=first_chat, sender=self.seller, content='reply')
+        Message.objects.create(chat=second_chat, sender=second_buyer, content='two')
+        Message.objects.create(chat=second_chat, sender=second_buyer, content='three')
+        mark_chat_as_read(first_chat.id, self.seller)
+
+        self.client.force_authenticate(user=self.seller)
+        url = reverse('chats-seller-inbox')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['count'], 1)
+        row = response.data['results'][0]
+        self.assertEqual(row['id'], self.ad.id)
+        self.assertEqual(row['chat_count'], 2)
+        self.assertEqual(row['unread_count'], 2)
+        self.assertEqual(row['last_message']['content'], 'three')
+        self.assertEqual(row['last_message']['chat_id'], second_chat.id)
+        # Count, ads page and prefetched images, independent of number of chats
+        self.assertLessEqual(len(queries), 4)
+
+        # Buyers have no ads with chats
+        self.client.force_authenticate(user=self.buyer)
+        self.assertEqual(self.client.get(url).data['results'], [])
+
+    def test_seller_inbox_is_paginated(self):
+        # Test for seller inbox split into pages of ads, most recent activity first
+        ads = [self.ad] + [Ad.objects.create(
+            user=self.seller, title=f'Ad {i}', brand=self.ad.brand, model=self.ad.model,
+            year=2020, mileage=0, price=Decimal('1000.00')) for i in range(2)]
+        for ad in ads:
+            Chat.objects.create(ad=ad, buyer=self.buyer, seller=self.seller)
+
+        self.client.force_authenticate(user=self.seller)
+        url = reverse('chats-seller-inbox')
+        response = self.client.get(url, {'page_size': 2})
+        self.assertEqual(response.data['count'], 3)
+        self.assertEqual([row['id'] for row in response.data['results']], [ads[2].id, ads[1].id])
+        self.assertIsNotNone(response.data['next'])
+
+        response = self.client.get(url, {'page_size': 2, 'page': 2})
+        self.assertEqual([row['id'] for row in response.data['results']], [ads[0].id])
+
+    def test_search_messages(self):
+        # Test for message search scoped to user's chats with highlighted snippets
+        other_user = User.objects.create_user(
+            email='otheruser@email.com',
+            username='otheruser@email.com',
+            password='321qwerty',
+            first_name='Other',
+            last_name='User',
+            phone_number='+123123123123'
+        )
+        chat = Chat.objects.create(
+            ad=self.ad, buyer=self.buyer, seller=self.seller)
+        foreign_chat = Chat.objects.create(
+            ad=self.ad, buyer=other_user, seller=self.seller)
+        message = Message.objects.create(
+            chat=chat, sender=self.buyer, content='Could you send me the VIN <please>?')
+        Message.objects.create(chat=chat, sender=self.seller, content='Sure, tomorrow')
+        Message.objects.create(
+            chat=foreign_chat, sender=other_user, content='What is the VIN?')
+
+        self.client.force_authenticate(user=self.buyer)
+        url = reverse('chats-search')
+        response = self.client.get(url, {'q': 'vin'})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([row['id'] for row in response.data['results']], [message.id])
+        self.assertEqual(response.data['results'][0]['chat_id'], chat.id)
+        self.assertIn('<mark>VIN</mark>', response.data['results'][0]['snippet'])
+        # Message content is escaped, only highlight tags are markup
+        self.assertIn('&lt;please&gt;', response.data['results'][0]['snippet'])
+        self.assertFalse(response.data['has_more'])
+
+        # Last word matches as a prefix, operators in input are plain words
+        self.assertEqual(len(self.client.get(url, {'q': 'tomor'}).data['results']), 1)
+        self.assertEqual(len(self.client.get(url, {'q': 'VIN OR NEAR('}).data['results']), 0)
+        self.assertEqual(self.client.get(url, {'q': ' ?'}).status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_search_messages_pagination(self):
+        # Test for search results paginated newest first
+        chat = Chat.objects.create(
+            ad=self.ad, buyer=self.buyer, seller=self.seller)
+        for i in range(3):
+            Message.objects.create(chat=chat, sender=self.seller, content=f'price offer {i}')
+
+        self.client.force_authenticate(user=self.buyer)
+        url = reverse('chats-search')
+        response = self.client.get(url, {'q': 'offer', 'page_size': 2})
+        self.assertEqual(response.data['has_more'], True)
+        self.assertEqual(response.data['results'][0]['snippet'], 'price <mark>offer</mark> 2')
+
+        response = self.client.get(url, {'q': 'offer', 'page_size': 2, 'page': 2})
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertFalse(response.data['has_more'])
+
+    def test_search_messages_pages_skip_other_users_matches(self):
+        # Test for search pages filled with the user's messages when other chats match too
+        other_user = User.objects.create_user(
+            email='otheruser@email.com',
+            username='otheruser@email.com',
+            password='321qwerty',
+            first_name='Other',
+            last_name='User',
+            phone_number='+123123123123'
+        )
+        chat = Chat.objects.create(
+            ad=self.ad, buyer=self.buyer, seller=self.seller)
+        foreign_chat = Chat.objects.create(
+            ad=self.ad, buyer=other_user, seller=self.seller)
+        now = timezone.now()
+        own = [Message.objects.create(chat=chat, sender=self.buyer, content=f'vin question {i}',
+                                      created_at=now - timedelta(minutes=10 + i))
+               for i in range(3)]
+        for i in range(5):
+            Message.objects.create(chat=foreign_chat, sender=other_user, content=f'vin question {i}',
+                                   created_at=now - timedelta(minutes=i))
+
+        self.client.force_authenticate(user=self.buyer)
+        response = self.client.get(reverse('chats-search'), {'q': 'vin', 'page_size': 2})
+        self.assertEqual([row['id'] for row in response.data['results']], [m.id for m in own[:2]])
+        self.assertTrue(response.data['has_more'])
+
+    def test_search_without_index_snippets(self):
+        # Test for substring search snippets when lowercasing changes text length or finds nothing
+        chat = Chat.objects.create(
+            ad=self.ad, buyer=self.buyer, seller=self.seller)
+        Message.objects.create(chat=chat, sender=self.seller, content='İİ price offer')
+
+        results, has_more = _search_without_index(self.buyer, 'offer', 0, 10)
+        self.assertEqual(results[0]['snippet'], 'İİ price <mark>offer</mark>')
+        self.assertFalse(has_more)
+
+        # Database matched but Python does not find the query
+        with patch('chat.search.re.search', return_value=None):
+            results, _ = _search_without_index(self.buyer, 'offer', 0, 10)
+        self.assertEqual(results[0]['snippet'], 'İİ price offer')
+
+    def test_search_triggers_check(self):
+        # Test for system check reporting search triggers dropped by a table rebuild
+        self.assertEqual(search_triggers_check(None, databases=['default']), [])
+
+        with connection.cursor() as cursor:
+            cursor.execute('DROP TRIGGER chat_message_fts_update')
+        errors = search_triggers_check(None, databases=['default'])
+        self.assertEqual([error.id for error in errors], ['chat.E001'])
+        self.assertIn('chat_message_fts_update', errors[0].msg)
+
+    def test_reconcile_unread_counters(self):
+        # Test for repairing drifted unread counters
+        chat = Chat.objects.create(
+            ad=self.ad, buyer=self.buyer, seller=self.seller)
+        Message.objects.create(chat=chat, sender=self.seller, content='one')
+        UnreadCounter.objects.create(user=self.buyer, unread_count=7)
+        UnreadCounter.objects.create(user=self.seller, unread_count=0)
+
+        self.assertEqual(reconcile_unread_counters(), 1)
+        self.assertEqual(UnreadCounter.objects.get(
+            user=self.buyer).unread_count, 1)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS, CACHES=IN_MEMORY_CACHES)
+class ChatConsumerTests(TestCase):
+    """Test cases for chat websocket consumer"""
+
+    def setUp(self):
+        self.seller = User.objects.create_user(
+            email='seller@email.com',
+            username='seller@email.com',
+            password='321qwerty',
+            first_name='Seller',
+            last_name='User',
+            phone_number='+1234567890',
+        )
+        self.buyer = User.objects.create_user(
+            email='buyer@email.com',
+            username='buyer@email.com',
+            password='321qwerty',
+            first_name='Buyer',
+            last_name='User',
+            phone_number='+0987654321',
+        )
+        self.brand = Brand.objects.create(name='Buick')
+        self.model = ModelCar.objects.create(
+            name='Grand National', brand=self.brand)
+        self.ad = Ad.objects.create(
+            user=self.seller,
+            title='Black Grand National',
+            brand=self.brand,
+            model=self.model,
+            year=1987,
+            mileage=30000,
+            price=Decimal('120000.00'),
+        )
+        self.chat = Chat.objects.create(
+            ad=self.ad, buyer=self.buyer, seller=self.seller)
+
+    def communicator(self, user, path=None):
+        communicator = WebsocketCommunicator(
+            URLRouter(websocket_urlpatterns), path or f'/ws/chat/{self.chat.id}/')
+        communicator.scope['user'] = user
+        return communicator
+
+    def test_send_message_updates_unread_counter(self):
+        # Test for websocket messages incrementing recipient counter
+        async def scenario():
+            communicator = self.communicator(self.buyer)
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            await communicator.receive_json_from()
+
+            await communicator.send_json_to({'type': 'chat_message', 'message': 'hello'})
+            response = await communicator.receive_json_from()
+            self.assertEqual(response['message']['content'], 'hello')
+
+            await communicator.disconnect()
+
+        async_to_sync(scenario)()
+
+        self.assertEqual(Message.objects.filter(chat=self.chat).count(), 1)
+        self.assertEqual(UnreadCounter.objects.get(
+            user=self.seller).unread_count, 1)
+
+    def test_send_message_query_count(self):
+        # Test for chat and sender loaded on connect, not on every message
+        updated_at = self.chat.updated_at
+
+        async def scenario():
+            communicator = self.communicator(self.buyer)
+            await communicator.connect()
+            await communicator.receive_json_from()
+            for text in ('hello', 'are you there?'):
+                await communicator.send_json_to({'type': 'chat_message', 'message': text})
+                await communicator.receive_json_from()
+            await communicator.disconnect()
+
+        with CaptureQueriesContext(connection) as queries:
+            async_to_sync(scenario)()
+
+        # Single chat lookup on connect, none per message
+        chat_selects = [query['sql'] for query in queries.captured_queries
+                        if 'FROM "chat_chat"' in query['sql']]
+        self.assertEqual(len(chat_selects), 1)
+        self.chat.refresh_from_db()
+        self.assertGreater(self.chat.updated_at, updated_at)
+
+    @override_settings(CHAT_WRITE_BEHIND=True, CHAT_WRITE_BEHIND_INTERVAL=0.05)
+    def test_write_behind_group_commits_connections(self):
+        # Test for messages of concurrent connections inserted in one batch before broadcast
+        async def scenario():
+            communicators = [self.communicator(self.buyer), self.communicator(self.buyer)]
+            for communicator in communicators:
+                await communicator.connect()
+                await communicator.receive_json_from()
+
+            for i, communicator in enumerate(communicators):
+                await communicator.send_json_to({'type': 'chat_message', 'message': f'hello {i}'})
+
+            ids = set()
+            for communicator in communicators:
+                for _ in range(2):
+                    response = await communicator.receive_json_from()
+                    self.assertIsNotNone(response['message']['id'])
+                    ids.add(response['message']['id'])
+                await communicator.disconnect()
+            return ids
+
+        with CaptureQueriesContext(connection) as queries:
+            ids = async_to_sync(scenario)()
+
+        inserts = [query['sql'] for query in queries.captured_queries
+                   if query['sql'].startswith('INSERT INTO "chat_message"')]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(set(Message.objects.filter(
+            chat=self.chat).values_list('id', flat=True)), ids)
+        self.assertEqual(UnreadCounter.objects.get(
+            user=self.seller).unread_count, 2)
+
+    @override_settings(CHAT_WRITE_BEHIND=True, CHAT_WRITE_BEHIND_INTERVAL=0.01)
+    def test_write_behind_replays_from_broadcast_id(self):
+        # Test for broadcast ids usable as replay cursor in write-behind mode
+        async def scenario():
+            communicator = self.communicator(self.buyer)
+            await communicator.connect()
+            await communicator.receive_json_from()
+
+            ids = []
+            for text in ('hello', 'still there?'):
+                await communicator.send_json_to({'type': 'chat_message', 'message': text})
+                response = await communicator.receive_json_from()
+                ids.append(response['message']['id'])
+            await communicator.disconnect()
+
+            communicator = self.communicator(
+                self.seller, f'/ws/chat/{self.chat.id}/?last_id={ids[0]}')
+            await communicator.connect()
+            await communicator.receive_json_from()
+            response = await communicator.receive_json_from()
+            self.assertEqual(response['message']['id'], ids[1])
+            self.assertEqual(response['message']['content'], 'still there?')
+            response = await communicator.receive_json_from()
+            self.assertEqual(response['count'], 1)
+            self.assertFalse(response['reset'])
+            await communicator.disconnect()
+
+        async_to_sync(scenario)()
+
+    @override_settings(CHAT_WRITE_BEHIND_INTERVAL=0.01, CHAT_WRITE_BEHIND_MAX_RETRIES=2,
+                       CHAT_WRITE_BEHIND_MAX_PENDING=1)
+    def test_write_behind_gives_up_when_database_is_down(self):
+        # Test for writers failed after the retry limit and new messages refused while the queue is full
+        writer = MessageWriteBehind()
+
+        async def scenario():
+            write = asyncio.ensure_future(writer.write(
+                Message(chat=self.chat, sender=self.buyer, content='hello')))
+            await asyncio.sleep(0)
+            with self.assertRaises(DatabaseError):
+                await writer.enqueue(Message(chat=self.chat, sender=self.buyer, content='full'))
+            with self.assertRaises(DatabaseError):
+                await write
+
+        with patch.object(MessageWriteBehind, 'persist', side_effect=DatabaseError('database is down')) as persist:
+            async_to_sync(scenario)()
+
+        self.assertEqual(persist.call_count, 2)
+        self.assertEqual(writer.pending, [])
+
+    def test_reconnect_replays_missed_messages(self):
+        # Test for messages newer than last_id replayed on connect, followed by replay_done
+        seen = Message.objects.create(
+            chat=self.chat, sender=self.seller, content='seen')
+        Message.objects.create(
+            chat=self.chat, sender=self.seller, content='missed 1')
+        Message.objects.create(
+            chat=self.chat, sender=self.buyer, content='missed 2')
+
+        async def scenario():
+            communicator = self.communicator(
+                self.buyer, f'/ws/chat/{self.chat.id}/?last_id={seen.id}')
+            await communicator.connect()
+            await communicator.receive_json_from()
+
+            contents = []
+            for _ in range(2):
+                response = await communicator.receive_json_from()
+                self.assertEqual(response['type'], 'chat_message')
+                contents.append(response['message']['content'])
+            self.assertEqual(contents, ['missed 1', 'missed 2'])
+
+            response = await communicator.receive_json_from()
+            self.assertEqual(response, {'type': 'replay_done', 'chat_id': self.chat.id,
+                                        'count': 2, 'reset': False})
+
+            # Unknown cursor asks the client to reload the chat
+            await communicator.send_json_to({'type': 'replay', 'last_id': 999})
+            response = await communicator.receive_json_from()
+            self.assertTrue(response['reset'])
+            await communicator.disconnect()
+
+        async_to_sync(scenario)()
+
+    def test_multiplexed_subscribe_replays_missed_messages(self):
+        # Test for replay of missed messages per chat on multiplexed subscribe
+        seen = Message.objects.create(
+            chat=self.chat, sender=self.buyer, content='seen')
+        Message.objects.create(
+            chat=self.chat, sender=self.buyer, content='missed')
+
+        async def scenario():
+            communicator = self.communicator(self.seller, '/ws/chats/')
+            await communicator.connect()
+            await communicator.receive_json_from()
+            await communicator.send_json_to({'type': 'subscribe', 'chat_ids': [self.chat.id],
+                                             'last_ids': {str(self.chat.id): seen.id}})
+            await communicator.receive_json_from()
+
+            response = await communicator.receive_json_from()
+            self.assertEqual(response['chat_id'], self.chat.id)
+            self.assertEqual(response['message']['content'], 'missed')
+            self.assertFalse(response['message']['is_read'])
+            response = await communicator.receive_json_from()
+            self.assertEqual(response['type'], 'replay_done')
+            await communicator.disconnect()
+
+        async_to_sync(scenario)()
+
+    def test_msgpack_protocol_sends_profile_once(self):
+        # Test for MessagePack frames with sender profile sent once per connection
+        async def scenario():
+            communicator = WebsocketCommunicator(
+                URLRouter(websocket_urlpatterns), f'/ws/chat/{self.chat.id}/', subprotocols=[MSGPACK_SUBPROTOCOL])
+            communicator.scope['user'] = self.buyer
+            connected, subprotocol = await communicator.connect()
+            self.assertTrue(connected)
+            self.assertEqual(subprotocol, MSGPACK_SUBPROTOCOL)
+            response = msgpack.unpackb(await communicator.receive_from())
+            self.assertEqual(response['type'], 'connection_established')
+
+            await communicator.send_to(bytes_data=msgpack.packb({'type': 'chat_message', 'message': 'hello'}))
+            profile = msgpack.unpackb(await communicator.receive_from())
+            self.assertEqual(profile['type'], 'profile')
+            self.assertEqual(profile['user']['email'], self.buyer.email)
+            response = msgpack.unpackb(await communicator.receive_from())
+            self.assertEqual(response['message']['sender_id'], self.buyer.id)
+            self.assertNotIn('sender', response['message'])
+
+            await communicator.send_to(bytes_data=msgpack.packb({'type': 'chat_message', 'message': 'again'}))
+            response = msgpack.unpackb(await communicator.receive_from())
+            self.assertEqual(response['type'], 'chat_message')
+            self.assertEqual(response['message']['content'], 'again')
+
+            await communicator.send_to(bytes_data=b'\xc1')
+            response = msgpack.unpackb(await communicator.receive_from())
+            self.assertEqual(response['type'], 'error')
+            await communicator.disconnect()
+
+        async_to_sync(scenario)()
+
+    def test_msgpack_subscribe_with_integer_keyed_last_ids(self):
+        # Test for MessagePack subscribe frame with last_ids keyed by integer chat id
+        seen = Message.objects.create(chat=self.chat, sender=self.buyer, content='seen')
+        Message.objects.create(chat=self.chat, sender=self.buyer, content='missed')
+
+        async def scenario():
+            communicator = WebsocketCommunicator(
+                URLRouter(websocket_urlpatterns), '/ws/chats/', subprotocols=[MSGPACK_SUBPROTOCOL])
+            communicator.scope['user'] = self.seller
+            await communicator.connect()
+            await communicator.receive_from()
+
+            await communicator.send_to(bytes_data=msgpack.packb(
+                {'type': 'subscribe', 'chat_ids': [self.chat.id], 'last_ids': {self.chat.id: seen.id}}))
+            response = msgpack.unpackb(await communicator.receive_from(), strict_map_key=False)
+            self.assertEqual(response['chat_ids'], [self.chat.id])
+
+            frames = [msgpack.unpackb(await communicator.receive_from()) for _ in range(3)]
+            self.assertEqual([frame['type'] for frame in frames], ['profile', 'chat_message', 'replay_done'])
+            self.assertEqual(frames[1]['message']['content'], 'missed')
+            await communicator.disconnect()
+
+        async_to_sync(scenario)()
+
+    def test_presence_on_connect_and_disconnect(self):
+        # Test for presence snapshot on connect and online/offline events for the other participant
+        async def scenario():
+            buyer = self.communicator(self.buyer)
+            await buyer.connect()
+            response = await buyer.receive_json_from()
+            self.assertEqual(response['online_users'], [])
+
+            seller = self.communicator(self.seller)
+            await seller.connect()
+            response = await seller.receive_json_from()
+            self.assertEqual(response['online_users'], [self.buyer.id])
+
+            event = await buyer.receive_json_from()
+            self.assertEqual(event, {'type': 'presence', 'user_id': self.seller.id, 'online': True})
+
+            # Heartbeat of a present user refreshes TTL without broadcasting
+            await seller.send_json_to({'type': 'heartbeat'})
+            self.assertTrue(await buyer.receive_nothing())
+
+            await seller.disconnect()
+            event = await buyer.receive_json_from()
+            self.assertEqual(event, {'type': 'presence', 'user_id': self.seller.id, 'online': False})
+            await buyer.disconnect()
+
+        async_to_sync(scenario)()
+
+    def test_presence_counts_connections(self):
+        # Test for user staying online until the last of several connections is closed
+        async def scenario():
+            buyer = self.communicator(self.buyer)
+            await buyer.connect()
+            await buyer.receive_json_from()
+
+            sellers = [self.communicator(self.seller), self.communicator(self.seller)]
+            for seller in sellers:
+                await seller.connect()
+                await seller.receive_json_from()
+            event = await buyer.receive_json_from()
+            self.assertEqual(event, {'type': 'presence', 'user_id': self.seller.id, 'online': True})
+            self.assertTrue(await buyer.receive_nothing())
+
+            await sellers[0].disconnect()
+            self.assertTrue(await buyer.receive_nothing())
+            self.assertEqual(await get_online(self.chat.id, [self.seller.id]), [self.seller.id])
+
+            await sellers[1].disconnect()
+            event = await buyer.receive_json_from()
+            self.assertEqual(event, {'type': 'presence', 'user_id': self.seller.id, 'online': False})
+            self.assertEqual(await get_online(self.chat.id, [self.seller.id]), [])
+            await buyer.disconnect()
+
+        async_to_sync(scenario)()
+
+    def test_typing_events_are_coalesced(self):
+        # Test for burst of typing events broadcast once, stop event always delivered
+        async def scenario():
+            buyer = self.communicator(self.buyer)
+            seller = self.communicator(self.seller)
+            await buyer.connect()
+            await buyer.receive_json_from()
+            await seller.connect()
+            await seller.receive_json_from()
+            await buyer.receive_json_from()
+
+            for _ in range(10):
+                await buyer.send_json_to({'type': 'typing'})
+            await buyer.send_json_to({'type': 'typing', 'is_typing': False})
+
+            event = await seller.receive_json_from()
+            self.assertEqual(event, {'type': 'typing', 'user_id': self.buyer.id, 'is_typing': True})
+            event = await seller.receive_json_from()
+            self.assertFalse(event['is_typing'])
+            self.assertTrue(await seller.receive_nothing())
+            # Sender doesn't get own typing events
+            self.assertTrue(await buyer.receive_nothing())
+
+            await buyer.disconnect()
+            await seller.disconnect()
+
+        async_to_sync(scenario)()
+
+    def test_non_participant_is_rejected(self):
+        # Test for closing connection for users outside the chat
+        other_user = User.objects.create_user(
+            email='other@email.com',
+            username='other@email.com',
+            password='321qwerty',
+            first_name='Other',
+            last_name='User',
+            phone_number='+111222333',
+        )
+
+        async def scenario():
+            connected, _ = await self.communicator(other_user).connect()
+            self.assertFalse(connected)
+
+        async_to_sync(scenario)()
+
+    def test_inbox_receives_new_message(self):
+        # Test for new message preview and unread delta pushed to both inboxes
+        async def scenario():
+            seller_inbox = self.communicator(self.seller, '/ws/inbox/')
+            connected, _ = await seller_inbox.connect()
+            self.assertTrue(connected)
+            response = await seller_inbox.receive_json_from()
+            self.assertEqual(response['unread_count'], 0)
+
+            chat = self.communicator(self.buyer)
+            await chat.connect()
+            await chat.receive_json_from()
+            await chat.send_json_to({'type': 'chat_message', 'message': 'hello'})
+
+            event = await seller_inbox.receive_json_from()
+            self.assertEqual(event['type'], 'inbox_message')
+            self.assertEqual(event['chat_id'], self.chat.id)
+            self.assertEqual(event['message']['content'], 'hello')
+            self.assertEqual(event['unread_delta'], 1)
+
+            await chat.disconnect()
+            await seller_inbox.disconnect()
+
+        async_to_sync(scenario)()
+
+    def test_inbox_receives_read_receipt_from_rest(self):
+        # Test for read receipts pushed to inboxes when chat is read over REST
+        Message.objects.create(
+            chat=self.chat, sender=self.seller, content='Still available')
+        client = APIClient()
+        client.force_authenticate(user=self.buyer)
+
+        async def scenario():
+            buyer_inbox = self.communicator(self.buyer, '/ws/inbox/')
+            seller_inbox = self.communicator(self.seller, '/ws/inbox/')
+            await buyer_inbox.connect()
+            await seller_inbox.connect()
+            await buyer_inbox.receive_json_from()
+            await seller_inbox.receive_json_from()
+
+            await sync_to_async(client.post)(
+                reverse('chats-mark-as-read', kwargs={'pk': self.chat.id}))
+
+            event = await buyer_inbox.receive_json_from()
+            self.assertEqual(event['type'], 'inbox_read')
+            self.assertEqual(event['unread_delta'], -1)
+            event = await seller_inbox.receive_json_from()
+            self.assertEqual(event['reader_id'], self.buyer.id)
+            self.assertEqual(event['unread_delta'], 0)
+
+            await buyer_inbox.disconnect()
+            await seller_inbox.disconnect()
+
+        async_to_sync(scenario)()
+
+    def test_inbox_rejects_anonymous(self):
+        # Test for closing inbox connection for anonymous users
+        async def scenario():
+            connected, _ = await self.communicator(AnonymousUser(), '/ws/inbox/').connect()
+            self.assertFalse(connected)
+
+        async_to_sync(scenario)()
+
+    def test_multiplexed_subscribe_checks_participation(self):
+        # Test for subscribing many chats on one socket, foreign chats are rejected
+        other_seller = User.objects.create_user(
+            email='other@email.com',
+            username='other@email.com',
+            password='321qwerty',
+            first_name='Other',
+            last_name='User',
+            phone_number='+111222333',
+        )
+        second_chat = Chat.objects.create(
+            ad=self.ad, buyer=other_seller, seller=self.seller)
+
+        async def scenario():
+            communicator = self.communicator(self.seller, '/ws/chats/')
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            await communicator.receive_json_from()
+
+            await communicator.send_json_to({
+                'type': 'subscribe', 'chat_ids': [self.chat.id, second_chat.id, 999]})
+            response = await communicator.receive_json_from()
+            self.assertEqual(response['chat_ids'], [self.chat.id, second_chat.id])
+            self.assertEqual(response['rejected'], [999])
+
+            await communicator.send_json_to({
+                'type': 'unsubscribe', 'chat_ids': [second_chat.id]})
+            response = await communicator.receive_json_from()
+            self.assertEqual(response['chat_ids'], [second_chat.id])
+
+            await communicator.send_json_to({
+                'type': 'chat_message', 'chat_id': second_chat.id, 'message': 'hi'})
+            response = await communicator.receive_json_from()
+            self.assertEqual(response['type'], 'error')
+
+            await communicator.disconnect()
+
+        async_to_sync(scenario)()
+
+    def test_multiplexed_sets_presence(self):
+        # Test for presence of subscribed chats set and cleared by multiplexed socket
+        async def scenario():
+            chat = self.communicator(self.buyer)
+            await chat.connect()
+            await chat.receive_json_from()
+
+            multiplexed = self.communicator(self.seller, '/ws/chats/')
+            await multiplexed.connect()
+            await multiplexed.receive_json_from()
+            await multiplexed.send_json_to({'type': 'subscribe', 'chat_ids': [self.chat.id]})
+            response = await multiplexed.receive_json_from()
+            self.assertEqual(response['online_users'], {str(self.chat.id): [self.buyer.id]})
+
+            event = await chat.receive_json_from()
+            self.assertEqual(event, {'type': 'presence', 'user_id': self.seller.id, 'online': True})
+
+            await multiplexed.send_json_to({'type': 'heartbeat'})
+            self.assertTrue(await chat.receive_nothing())
+
+            await multiplexed.send_json_to({'type': 'unsubscribe', 'chat_ids': [self.chat.id]})
+            await multiplexed.receive_json_from()
+            event = await chat.receive_json_from()
+            self.assertEqual(event, {'type': 'presence', 'user_id': self.seller.id, 'online': False})
+
+            await multiplexed.disconnect()
+            await chat.disconnect()
+
+        async_to_sync(scenario)()
+
+    def test_multiplexed_receives_messages_with_chat_id(self):
+        # Test for messages from single chat sockets delivered to multiplexed socket
+        async def scenario():
+            multiplexed = self.communicator(self.seller, '/ws/chats/')
+            await multiplexed.connect()
+            await multiplexed.receive_json_from()
+            await multiplexed.send_json_to({'type': 'subscribe', 'chat_ids': [self.chat.id]})
+            await multiplexed.receive_json_from()
+
+            chat = self.communicator(self.buyer)
+            await chat.connect()
+            await chat.receive_json_from()
+            await chat.send_json_to({'type': 'chat_message', 'message': 'hello'})
+            await chat.receive_json_from()
+
+            event = await multiplexed.receive_json_from()
+            self.assertEqual(event['type'], 'presence')
+            self.assertEqual(event['user_id'], self.buyer.id)
+
+            event = await multiplexed.receive_json_from()
+            self.assertEqual(event['type'], 'chat_message')
+            self.assertEqual(event['chat_id'], self.chat.id)
+            self.assertEqual(event['message']['content'], 'hello')
+
+            await multiplexed.send_json_to({
+                'type': 'chat_message', 'chat_id': self.chat.id, 'message': 'reply'})
+            event = await chat.receive_json_from()
+            self.assertEqual(event['message']['content'], 'reply')
+
+            await chat.disconnect()
+            await multiplexed.disconnect()
+
+        async_to_sync(scenario)()
+
+
+class ChatDbTests(TestCase):
+    """Test cases for consumer database call pool"""
+
+    def test_run_db_uses_configured_pool(self):
+        # Test for database calls running on the shared thread by default and on the pool when configured
+        def thread_name():
+            return threading.current_thread().name
+
+        self.assertFalse(async_to_sync(run_db)(thread_name).startswith('chat-db'))
+        with override_settings(CHAT_DB_THREADS=2):
+            self.assertTrue(async_to_sync(run_db)(thread_name).startswith('chat-db'))
+
+    @override_settings(CHAT_DB_THREADS=2, CACHES=IN_MEMORY_CACHES)
+    def test_presence_cache_calls_use_pool(self):
+        # Test for presence cache round trips running on the pool, not the shared thread
+        threads = []
+        original_add = caches['chat'].add
+
+        def add(*args, **kwargs):
+            threads.append(threading.current_thread().name)
+            return original_add(*args, **kwargs)
+
+        with patch('django.core.cache.backends.locmem.LocMemCache.add', side_effect=add):
+            self.assertTrue(async_to_sync(set_online)(1, 2))
+        self.assertTrue(threads)
+        self.assertTrue(all(name.startswith('chat-db') for name in threads))
+
+
+class ChatLoadTestCommandTests(TestCase):
+    """Test cases for chat benchmark commands"""
+
+    def test_load_test_reports_metrics(self):
+        # Test for load test run reporting latency, queries and memory, and cleaning up its rows
+        out = StringIO()
+        call_command('chat_load_test', chats=2, sellers=1,
+                     messages=4, mark_read_every=2, stdout=out)
+
+        output = out.getvalue()
+        self.assertIn('connections: 4', output)
+        self.assertIn('messages: 8', output)
+        self.assertIn('latency ms: p50', output)
+        self.assertIn('DB queries per message', output)
+        self.assertFalse(Chat.objects.exists())
+        self.assertFalse(User.objects.exists())
+
+    def test_cleanup_keeps_existing_rows(self):
+        # Test for benchmark cleanup deleting only the rows it created
+        seller = User.objects.create(email='seller@email.com', username='seller@email.com')
+        brand = Brand.objects.create(name='Benchmark')
+        model = ModelCar.objects.create(name='Benchmark', brand=brand)
+        ad = Ad.objects.create(user=seller, title='Real ad', brand=brand, model=model,
+                               year=2020, mileage=0, price=Decimal('1000.00'))
+
+        out = StringIO()
+        call_command('benchmark_chat_writes', messages=4, chats=2, stdout=out)
+        self.assertIn('write-behind: 4 messages', out.getvalue())
+        self.assertIn('latency ms p50', out.getvalue())
+
+        self.assertTrue(Ad.objects.filter(pk=ad.pk).exists())
+        self.assertEqual(list(Brand.objects.values_list('name', flat=True)), ['Benchmark'])
+        self.assertEqual(User.objects.count(), 1)
+        self.assertFalse(Chat.objects.exists())
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS, CACHES=IN_MEMORY_CACHES)
+class JWTMiddlewareTests(TestCase):
+    """Test cases for websocket JWT authentication"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(
+            email='buyer@email.com',
+            username='buyer@email.com',
+            password='321qwerty',
+            first_name='Buyer',
+            last_name='User',
+            phone_number='+0987654321',
+        )
+        self.token = str(AccessToken.for_user(self.user))
+        self.application = JWTMiddleware(URLRouter(websocket_urlpatterns))
+
+    def connect(self, path='/ws/inbox/', subprotocols=None):
+        async def scenario():
+            communicator = WebsocketCommunicator(
+                self.application, path, subprotocols=subprotocols)
+            connected, subprotocol = await communicator.connect()
+            if connected:
+                await communicator.disconnect()
+            return connected, subprotocol
+
+        return async_to_sync(scenario)()
+
+    def test_token_in_subprotocol_header(self):
+        # Test for token passed in Sec-WebSocket-Protocol and subprotocol echoed back
+        connected, subprotocol = self.connect(
+            subprotocols=['access_token', self.token])
+        self.assertTrue(connected)
+        self.assertEqual(subprotocol, 'access_token')
+
+    def test_token_in_query_string(self):
+        # Test for token passed in query string
+        connected, _ = self.connect(f'/ws/inbox/?token={self.token}')
+        self.assertTrue(connected)
+
+    def test_invalid_token_is_rejected(self):
+        # Test for rejecting connections with invalid token
+        connected, _ = self.connect('/ws/inbox/?token=invalid')
+        self.assertFalse(connected)
+
+    def test_reconnect_uses_cached_user(self):
+        # Test for user loaded from database once for repeated connects
+        with CaptureQueriesContext(connection) as queries:
+            for _ in range(3):
+                self.assertTrue(self.connect(
+                    subprotocols=['access_token', self.token])[0])
+
+        user_queries = [query for query in queries.captured_queries
+                        if 'FROM "account_user"' in query['sql']]
+        self.assertEqual(len(user_queries), 1)
+
+    def test_cached_user_is_minimal_snapshot(self):
+        # Test for cached user holding no password hash and unchanged by unrelated saves
+        self.assertTrue(self.connect(f'/ws/inbox/?token={self.token}')[0])
+        snapshot = caches['chat'].get(user_cache_key(self.user.id))
+        self.assertEqual(set(snapshot), set(USER_CACHE_FIELDS))
+
+        user = async_to_sync(get_cached_user)(self.user.id)
+        self.assertEqual((user.pk, user.first_name, user.email),
+                         (self.user.id, 'Buyer', 'buyer@email.com'))
+        self.assertIn('password', user.get_deferred_fields())
+
+        self.user.last_login = timezone.now()
+        self.user.save(update_fields=['last_login'])
+        self.user.about = 'Updated'
+        self.user.save()
+        self.assertIsNotNone(caches['chat'].get(user_cache_key(self.user.id)))
+
+        self.user.first_name = 'Renamed'
+        self.user.save()
+        self.assertIsNone(caches['chat'].get(user_cache_key(self.user.id)))
+
+    def test_user_save_does_not_read_cached_user(self):
+        # Test for snapshot invalidation decided from the loaded user, without cache reads on save
+        self.assertTrue(self.connect(f'/ws/inbox/?token={self.token}')[0])
+        user = User.objects.get(id=self.user.id)
+
+        with patch.object(caches['chat'], 'get') as cache_get:
+            user.about = 'Updated'
+            user.save()
+        cache_get.assert_not_called()
+        self.assertIsNotNone(caches['chat'].get(user_cache_key(user.id)))
+
+        with patch.object(caches['chat'], 'get') as cache_get:
+            user.email = 'renamed@email.com'
+            user.save()
+        cache_get.assert_not_called()
+        self.assertIsNone(caches['chat'].get(user_cache_key(user.id)))
+
+    def test_banned_user_is_rejected(self):
+        # Test for cached user dropped when admin bans the user
+        self.assertTrue(self.connect(f'/ws/inbox/?token={self.token}')[0])
+
+        admin = User.objects.create_superuser(
+            email='admin@email.com', username='admin@email.com', password='321qwerty')
+        client = APIClient()
+        client.force_authenticate(user=admin)
+        response = client.post(
+            reverse('admin-toggle-active', kwargs={'pk': self.user.id}))
+        self.assertFalse(response.data['is_active'])
+
+        connected, _ = self.connect(f'/ws/inbox/?token={self.token}')
+        self.assertFalse(connected)
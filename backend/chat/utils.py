@@ -0,0 +1,180 @@
+from datetime import datetime, timezone as dt_timezone
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from django.db.models import Q, F, Count, Case, When, OuterRef, Subquery, Value, DateTimeField, BigIntegerField
+from django.db.models.functions import Coalesce, Greatest
+from .models import Chat, ChatReadState, Message, UnreadCounter
+
+# Watermark used for participants, who haven't read anything yet
+NOTHING_READ = (datetime(1970, 1, 1, tzinfo=dt_timezone.utc), 0)
+
+
+def after_watermark(last_read_at, last_read_message_id):
+    # Messages newer than the watermark, a range on the (chat, created_at) index
+    return Q(created_at__gt=last_read_at) | Q(created_at=last_read_at, id__gt=last_read_message_id)
+
+
+def watermark_annotations(read_states):
+    # Watermark of the matching read state, usable as F('last_read_at'), F('last_read_message_id')
+    return {
+        'last_read_at': Coalesce(Subquery(read_states.values('last_read_at')[:1]),
+                                 Value(NOTHING_READ[0]), output_field=DateTimeField()),
+        'last_read_message_id': Coalesce(Subquery(read_states.values('last_read_message_id')[:1]),
+                                         Value(NOTHING_READ[1]), output_field=BigIntegerField()),
+    }
+
+
+def count_unread(user_id):
+    # Actual number of unread messages addressed to the user
+    read_states = ChatReadState.objects.filter(
+        chat=OuterRef('chat_id'), user_id=user_id)
+    return (Message.objects.filter(Q(chat__buyer_id=user_id) | Q(chat__seller_id=user_id))
+            .exclude(sender_id=user_id)
+            .annotate(**watermark_annotations(read_states))
+            .filter(after_watermark(F('last_read_at'), F('last_read_message_id')))
+            .count())
+
+
+def add_unread(user_id, delta):
+    """
+    Atomically change user unread counter by delta.
+    Must be called after the message write, a missing counter is created from actual state.
+    """
+    updated = UnreadCounter.objects.filter(user_id=user_id).update(
+        unread_count=Greatest(F('unread_count') + delta, 0))
+    if not updated:
+        UnreadCounter.objects.get_or_create(
+            user_id=user_id, defaults={'unread_count': count_unread(user_id)})
+
+
+def recipient_id(chat, sender_id):
+    return chat.seller_id if sender_id == chat.buyer_id else chat.buyer_id
+
+
+def create_message(chat, sender, content):
+    """
+    Insert message, bump chat updated_at and recipient unread counter.
+    The three writes share one transaction, so they are committed (and synced to disk) once
+    and the counter never drifts from a half-written message.
+    """
+    with transaction.atomic():
+        message = Message.objects.create(
+            chat=chat, sender=sender, content=content)
+        Chat.objects.filter(id=chat.id).update(updated_at=message.created_at)
+        add_unread(recipient_id(chat, sender.id), 1)
+    chat.updated_at = message.created_at
+    return message
+
+
+def get_unread_total(user_id):
+    count = UnreadCounter.objects.filter(user_id=user_id).values_list(
+        'unread_count', flat=True).first()
+    if count is None:
+        count = UnreadCounter.objects.get_or_create(
+            user_id=user_id, defaults={'unread_count': count_unread(user_id)})[0].unread_count
+    return count
+
+
+def get_read_watermarks(chat):
+    """
+    Watermarks deciding read status of chat messages, keyed by sender:
+    message is read if it is not newer than the other participant's watermark
+    """
+    states = {user_id: (last_read_at, message_id) for user_id, last_read_at, message_id in
+              ChatReadState.objects.filter(chat=chat).values_list(
+                  'user_id', 'last_read_at', 'last_read_message_id')}
+    return {
+        chat.buyer_id: states.get(chat.seller_id, NOTHING_READ),
+        chat.seller_id: states.get(chat.buyer_id, NOTHING_READ),
+    }
+
+
+def is_message_read(message, watermarks):
+    return (message.created_at, message.id) <= watermarks.get(message.sender_id, NOTHING_READ)
+
+
+def mark_chat_as_read(chat_id, user):
+    """
+    Move user watermark to the newest chat message and update counter.
+    The watermark only moves forward from the state messages were counted against,
+    so concurrent calls never decrement the same messages twice.
+    Returns number of messages that became read.
+    """
+    with transaction.atomic():
+        newest = (Message.objects.filter(chat_id=chat_id).order_by('-created_at', '-id')
+                  .values_list('created_at', 'id').first())
+        if newest is None:
+            return 0
+
+        # Row lock serializes calls of one participant where the database supports it
+        state = ChatReadState.objects.select_for_update().filter(chat_id=chat_id, user=user).values_list(
+            'last_read_at', 'last_read_message_id').first()
+        watermark = state or NOTHING_READ
+        if watermark >= newest:
+            return 0
+
+        # Range count between the old and the new watermark
+        updated = (Message.objects.filter(chat_id=chat_id)
+                   .filter(after_watermark(*watermark))
+                   .exclude(after_watermark(*newest))
+                   .exclude(sender=user).count())
+        if not updated:
+            return 0
+
+        if state is None:
+            try:
+                with transaction.atomic():
+                    ChatReadState.objects.create(chat_id=chat_id, user=user,
+                                                 last_read_at=newest[0], last_read_message_id=newest[1])
+            except IntegrityError:
+                # Created by a concurrent call, count again against its watermark
+                return mark_chat_as_read(chat_id, user)
+        else:
+            # Compare and set, a concurrent call may have moved the watermark meanwhile
+            advanced = ChatReadState.objects.filter(
+                chat_id=chat_id, user=user, last_read_at=watermark[0], last_read_message_id=watermark[1]
+            ).update(last_read_at=newest[0], last_read_message_id=newest[1], updated_at=timezone.now())
+            if not advanced:
+                return mark_chat_as_read(chat_id, user)
+
+        add_unread(user.id, -updated)
+    return updated
+
+
+def reconcile_unread_counters():
+    """
+    Recalculate all counters in one grouped query and fix the drifted ones.
+    The grouped query only picks candidates, each one is recounted and written under
+    the counter row lock, so increments committed meanwhile are not overwritten.
+    Returns number of repaired counters.
+    """
+    # Recipient is the participant, who is not the sender
+    read_states = ChatReadState.objects.filter(
+        chat=OuterRef('chat_id'), user_id=OuterRef('recipient'))
+    actual = dict(
+        Message.objects
+        .annotate(recipient=Case(When(sender_id=F('chat__buyer_id'), then=F('chat__seller_id')),
+                                 default=F('chat__buyer_id')))
+        .annotate(**watermark_annotations(read_states))
+        .filter(after_watermark(F('last_read_at'), F('last_read_message_id')))
+        .values('recipient')
+        .annotate(count=Count('id'))
+        .order_by()
+        .values_list('recipient', 'count')
+    )
+
+    drifted = [counter.pk for counter in UnreadCounter.objects.only('user_id', 'unread_count')
+               .iterator(chunk_size=2000) if counter.unread_count != actual.get(counter.user_id, 0)]
+
+    repaired = 0
+    for pk in drifted:
+        with transaction.atomic():
+            counter = UnreadCounter.objects.select_for_update().filter(pk=pk).first()
+            if counter is None:
+                continue
+            # Message writes update the counter in their transaction, so after the lock the count is current
+            expected = count_unread(counter.user_id)
+            if counter.unread_count != expected:
+                UnreadCounter.objects.filter(pk=pk).update(unread_count=expected)
+                repaired += 1
+    return repaired
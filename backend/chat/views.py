@@ -3,10 +3,15 @@ from rest_framework.decorators import action
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from django.shortcuts import get_object_or_404
-from django.db.models import Q
-from .models import Chat, Message
+from django.db.models import Q, F, Max, OuterRef, Subquery, Count, IntegerField
+from django.db.models.functions import Coalesce
+from .models import Chat, ChatReadState, Message
 from ads.models import Ad
-from .serializers import ChatSerializer, ChatDetailSerializer, MessageSerializer
+from .serializers import ChatSerializer, ChatDetailSerializer, MessageSerializer, SellerInboxSerializer
+from .pagination import paginate_messages, SellerInboxPagination, MESSAGE_PAGE_SIZE, MAX_MESSAGE_PAGE_SIZE
+from .utils import mark_chat_as_read, get_unread_total, get_read_watermarks, after_watermark, watermark_annotations
+from .events import read_events, notify_inbox_sync
+from .search import search_messages, SEARCH_PAGE_SIZE, MAX_SEARCH_PAGE_SIZE
 from account.throttles import MessageThrottle
 
 
@@ -17,7 +22,75 @@ class ChatViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self):
         user = self.request.user
-        return Chat.objects.filter(Q(buyer=user) | Q(seller=user)).select_related('ad', 'buyer', 'seller', 'ad__user', 'ad__brand', 'ad__model').prefetch_related('messages', 'ad__images')
+        queryset = Chat.objects.filter(Q(buyer=user) | Q(seller=user)).select_related(
+            'ad', 'buyer', 'seller', 'ad__user', 'ad__brand', 'ad__model__brand', 'ad__body_type',
+            'ad__fuel_type', 'ad__transmission', 'ad__exterior_color').prefetch_related('ad__images')
+        if self.action == 'list':
+            queryset = self.annotate_summary(queryset, user)
+        return queryset
+
+    @staticmethod
+    def annotate_summary(queryset, user):
+        # Last message and unread count are computed as subqueries in the same query,
+        # so the chat list doesn't load message history or run queries per chat
+        last_message = Message.objects.filter(
+            chat=OuterRef('pk')).order_by('-created_at', '-id')
+        # Range count after the user's read watermark, annotated on the chat below
+        unread = (Message.objects.filter(chat=OuterRef('pk'))
+                  .filter(after_watermark(OuterRef('last_read_at'), OuterRef('last_read_message_id')))
+                  .exclude(sender=user)
+                  .values('chat')
+                  .annotate(count=Count('id'))
+                  .values('count'))
+
+        return queryset.annotate(
+            **watermark_annotations(ChatReadState.objects.filter(chat=OuterRef('pk'), user=user)),
+            last_message_id=Subquery(last_message.values('id')[:1]),
+            last_message_content=Subquery(last_message.values('content')[:1]),
+            last_message_sender_id=Subquery(
+                last_message.values('sender_id')[:1]),
+            last_message_created_at=Subquery(
+                last_message.values('created_at')[:1]),
+        ).annotate(
+            unread_messages=Coalesce(
+                Subquery(unread, output_field=IntegerField()), 0),
+        )
+
+    @staticmethod
+    def seller_inbox_queryset(user):
+        """
+        Ads of the seller that have chats, one row per ad with chat count,
+        unread total and latest message, aggregated in a single query
+        """
+        read_states = ChatReadState.objects.filter(
+            chat=OuterRef('chat_id'), user=user)
+        unread = (Message.objects.filter(chat__ad=OuterRef('pk'), chat__seller=user)
+                  .exclude(sender=user)
+                  .annotate(**watermark_annotations(read_states))
+                  .filter(after_watermark(F('last_read_at'), F('last_read_message_id')))
+                  .values('chat__ad')
+                  .annotate(count=Count('id'))
+                  .values('count'))
+        last_message = Message.objects.filter(
+            chat__ad=OuterRef('pk'), chat__seller=user).order_by('-created_at', '-id')
+
+        return (Ad.objects.filter(chats__seller=user)
+                .annotate(
+                    chat_count=Count('chats'),
+                    last_activity=Max('chats__updated_at'),
+                    unread_messages=Coalesce(
+                        Subquery(unread, output_field=IntegerField()), 0),
+                    last_message_chat_id=Subquery(
+                        last_message.values('chat_id')[:1]),
+                    last_message_content=Subquery(
+                        last_message.values('content')[:1]),
+                    last_message_sender_id=Subquery(
+                        last_message.values('sender_id')[:1]),
+                    last_message_created_at=Subquery(
+                        last_message.values('created_at')[:1]),
+                )
+                .prefetch_related('images')
+                .order_by('-last_activity', '-id'))
 
     def get_serializer_class(self):
         if self.action == 'retrieve':
@@ -46,17 +119,86 @@ class ChatViewSet(viewsets.ModelViewSet):
     def mark_as_read(self, request, pk=None):
         chat = self.get_object()
 
-        Message.objects.filter(chat=chat, is_read=False).exclude(
-            sender=request.user).update(is_read=True)
+        self.mark_read(chat, request.user)
         return Response({'detail': 'Messages marked as read.'}, status=status.HTTP_200_OK)
 
+    @staticmethod
+    def mark_read(chat, user):
+        # Mark chat as read and push the change to participants inboxes
+        updated = mark_chat_as_read(chat.id, user)
+        if updated:
+            notify_inbox_sync(read_events(chat, user.id, updated))
+        return updated
+
+    @action(detail=False, methods=['get'])
+    def unread_summary(self, request):
+        # Global unread badge, read from the per-user counter
+        return Response({'unread_count': get_unread_total(request.user.id)}, status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=['get'], pagination_class=SellerInboxPagination)
+    def seller_inbox(self, request):
+        # Seller chats grouped by ad, payload grows with ads instead of chats
+        page = self.paginate_queryset(self.seller_inbox_queryset(request.user))
+        serializer = SellerInboxSerializer(page, many=True, context={'request': request})
+        return self.get_paginated_response(serializer.data)
+
+    @action(detail=False, methods=['get'])
+    def search(self, request):
+        """
+        Full-text search over messages of the user's chats, newest first
+        GET params: q - search text, page, page_size
+        """
+        query = request.query_params.get('q', '')
+        try:
+            page = max(1, int(request.query_params.get('page', 1)))
+            page_size = int(request.query_params.get(
+                'page_size', SEARCH_PAGE_SIZE))
+        except ValueError:
+            return Response({'detail': 'Invalid parameters.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        page_size = max(1, min(page_size, MAX_SEARCH_PAGE_SIZE))
+        found = search_messages(request.user, query, page, page_size)
+        if found is None:
+            return Response({'detail': 'q is required.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        results, has_more = found
+        return Response({'results': results, 'has_more': has_more}, status=status.HTTP_200_OK)
+
+    @action(detail=True, methods=['get'])
+    def messages(self, request, pk=None):
+        """
+        Message history page
+        GET params: before_id - older messages, after_id - newer messages, page_size
+        """
+        chat = self.get_object()
+
+        try:
+            before_id = int(request.query_params.get('before_id', 0))
+            after_id = int(request.query_params.get('after_id', 0))
+            page_size = int(request.query_params.get(
+                'page_size', MESSAGE_PAGE_SIZE))
+        except ValueError:
+            return Response({'detail': 'Invalid parameters.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        if before_id and after_id:
+            return Response({'detail': 'Use either before_id or after_id.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        page_size = max(1, min(page_size, MAX_MESSAGE_PAGE_SIZE))
+        page = paginate_messages(
+            chat, before_id=before_id, after_id=after_id, page_size=page_size)
+        if page is None:
+            return Response({'detail': 'Message not found.'}, status=status.HTTP_404_NOT_FOUND)
+
+        messages, has_more = page
+        serializer = MessageSerializer(
+            messages, many=True, context={'request': request, 'read_watermarks': get_read_watermarks(chat)})
+        return Response({'results': serializer.data, 'has_more': has_more}, status=status.HTTP_200_OK)
+
     def retrieve(self, request, *args, **kwargs):
         instance = self.get_object()
 
-        Message.objects.filter(chat=instance, is_read=False).exclude(
-            sender=request.user).update(is_read=True)
-        instance = Chat.objects.select_related('ad', 'buyer', 'seller', 'ad__user', 'ad__brand', 'ad__model').prefetch_related(
-            'messages__sender', 'ad__images').get(pk=instance.pk)
+        self.mark_read(instance, request.user)
 
+        # Only the newest page of messages is serialized
         serializer = self.get_serializer(instance)
         return Response(serializer.data)
@@ -0,0 +1,156 @@
+import asyncio
+import atexit
+import logging
+from collections import Counter
+from django.conf import settings
+from django.db import DatabaseError, IntegrityError, transaction
+from .models import Chat, Message
+from .utils import add_unread, recipient_id
+from .db import run_db
+
+logger = logging.getLogger(__name__)
+
+
+class MessageWriteBehind:
+    """
+    Per-process group commit for chat messages in write-behind mode.
+    Messages of all connections are collected and inserted with one bulk_create every
+    CHAT_WRITE_BEHIND_INTERVAL seconds, or as soon as CHAT_WRITE_BEHIND_BATCH_SIZE is reached.
+    Consumers wait in write() until their batch is committed, so a broadcast message always
+    has its id and nothing that was acknowledged can be lost if the process dies.
+    While the database is down a batch is retried CHAT_WRITE_BEHIND_MAX_RETRIES times, then its
+    writers get the error. New messages are refused once CHAT_WRITE_BEHIND_MAX_PENDING are waiting.
+    """
+
+    def __init__(self):
+        # (message, future) pairs, future is None for messages nobody waits for
+        self.pending = []
+        self.flush_task = None
+        # Failed flushes in a row
+        self.failures = 0
+
+    async def write(self, message):
+        # Enqueue and wait until the message is persisted, raises if it was dropped
+        future = asyncio.get_running_loop().create_future()
+        await self.enqueue(message, future)
+        await future
+        return message
+
+    async def enqueue(self, message, future=None):
+        if len(self.pending) >= settings.CHAT_WRITE_BEHIND_MAX_PENDING:
+            raise DatabaseError('Too many messages waiting to be saved')
+        self.pending.append((message, future))
+        loop = asyncio.get_running_loop()
+        if len(self.pending) >= settings.CHAT_WRITE_BEHIND_BATCH_SIZE:
+            await self.flush()
+        elif self.flush_task is None or self.flush_task.done() or self.flush_task.get_loop() is not loop:
+            # A task of another (e.g. finished) event loop would never run, start one on this loop
+            self.flush_task = loop.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        # Keeps retrying while messages are pending, e.g. when the database is unavailable
+        while self.pending:
+            await asyncio.sleep(settings.CHAT_WRITE_BEHIND_INTERVAL)
+            await self.flush()
+
+    async def flush(self):
+        if not self.pending:
+            return 0
+        batch, self.pending = self.pending, []
+
+        try:
+            dropped = await run_db(self.persist, [message for message, _ in batch])
+        except Exception as e:
+            self.failures += 1
+            if self.failures < settings.CHAT_WRITE_BEHIND_MAX_RETRIES:
+                # Batch is kept for the next attempt, writers keep waiting
+                logger.error(f'Error flushing {len(batch)} chat messages: {e}')
+                self.pending = batch + self.pending
+                return 0
+
+            logger.error(f'Dropping {len(batch)} chat messages after {self.failures} failed flushes: {e}')
+            self.failures = 0
+            for _, future in batch:
+                if future is not None:
+                    self._resolve(future, e)
+            return 0
+
+        self.failures = 0
+        for message, future in batch:
+            if future is not None:
+                self._resolve(future, IntegrityError(
+                    'Message could not be saved') if message in dropped else None)
+        return len(batch) - len(dropped)
+
+    @staticmethod
+    def _resolve(future, exception=None):
+        # Writers may wait on another event loop than the one flushing
+        def resolve():
+            if future.done():
+                return
+            if exception:
+                future.set_exception(exception)
+            else:
+                future.set_result(None)
+
+        loop = future.get_loop()
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if loop is running:
+            resolve()
+        elif not loop.is_closed():
+            loop.call_soon_threadsafe(resolve)
+
+    def flush_sync(self):
+        # Called on interpreter shutdown, when there is no event loop to flush from
+        batch, self.pending = self.pending, []
+        if batch:
+            self.persist([message for message, _ in batch])
+
+    @classmethod
+    def persist(cls, batch):
+        """
+        Insert batch in one transaction, ids are set on the message objects.
+        Returns messages, that had to be dropped.
+        """
+        try:
+            with transaction.atomic():
+                cls._insert(batch)
+            return []
+        except IntegrityError:
+            pass
+
+        # One invalid row (e.g. chat deleted meanwhile) must not block the others
+        dropped = []
+        for message in batch:
+            try:
+                with transaction.atomic():
+                    cls._insert([message])
+            except IntegrityError as e:
+                logger.error(f'Dropping chat message {message.uuid}: {e}')
+                dropped.append(message)
+        return dropped
+
+    @staticmethod
+    def _insert(batch):
+        Message.objects.bulk_create(batch)
+
+        # One updated_at bump per chat and one counter update per recipient
+        latest = {}
+        unread = Counter()
+        for message in batch:
+            latest[message.chat_id] = max(
+                latest.get(message.chat_id, message.created_at), message.created_at)
+            unread[recipient_id(message.chat, message.sender_id)] += 1
+
+        for chat_id, updated_at in latest.items():
+            Chat.objects.filter(id=chat_id, updated_at__lt=updated_at).update(
+                updated_at=updated_at)
+        for user_id, count in unread.items():
+            add_unread(user_id, count)
+
+
+message_writer = MessageWriteBehind()
+atexit.register(message_writer.flush_sync)